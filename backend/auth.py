@@ -3,14 +3,84 @@ import time
 import hmac
 import hashlib
 import json
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from urllib.parse import parse_qsl
 import jwt
 from fastapi import HTTPException, Header
 
+# Levelled and never logs tokens or headers (LOG_LEVEL=DEBUG for rejection reasons)
+logger = logging.getLogger("pixelpop.auth")
+
+JWT_CACHE_MAX_ENTRIES = int(os.getenv("JWT_CACHE_MAX_ENTRIES", "10000"))
+
+# Telegram initData: reject logins whose auth_date is older than this (0 = no limit)
+TELEGRAM_AUTH_MAX_AGE_SECONDS = int(os.getenv("TELEGRAM_AUTH_MAX_AGE_SECONDS", "0"))
+# Already validated initData is trusted for this long (the Mini App resends it on every reload)
+TELEGRAM_INITDATA_CACHE_TTL_SECONDS = int(os.getenv("TELEGRAM_INITDATA_CACHE_TTL_SECONDS", "300"))
+TELEGRAM_INITDATA_CACHE_MAX_ENTRIES = int(os.getenv("TELEGRAM_INITDATA_CACHE_MAX_ENTRIES", "10000"))
+
+
+class VerifiedTokenCache:
+    """
+    Bounded LRU of already verified credentials: digest -> (value, expires_at).
+    Keyed by a digest of secret + token, so raw tokens are never held and
+    rotating the secret invalidates every entry.
+    """
+
+    def __init__(self, max_entries: int = JWT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def digest(token: str, secret: str) -> str:
+        return hashlib.sha256(f"{secret}:{token}".encode()).hexdigest()
+
+    def get(self, key: str):
+        with self.lock:
+            cached = self.entries.get(key)
+            if not cached:
+                return None
+            if cached[1] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return cached[0]
+
+    def put(self, key: str, value, expires_at: float):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+token_cache = VerifiedTokenCache(JWT_CACHE_MAX_ENTRIES)
+init_data_cache = VerifiedTokenCache(TELEGRAM_INITDATA_CACHE_MAX_ENTRIES)
+
+
+@lru_cache(maxsize=8)
+def telegram_secret_key(bot_token: str) -> bytes:
+    """
+    HMAC key for initData, derived once per bot token.
+    """
+    return hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+
+
 def validate_telegram_data(init_data: str, bot_token: str) -> dict:
     """
     Validates the Telegram WebApp initData.
     Returns the user dict if valid, raises HTTPException otherwise.
+    Valid initData is cached briefly, so repeated logins skip the HMAC and parsing.
     """
     if not bot_token:
         print("⚠️ No BOT_TOKEN provided to validate_telegram_data")
@@ -20,6 +90,11 @@ def validate_telegram_data(init_data: str, bot_token: str) -> dict:
         pass # Flow continues to try parsing or eventually failing
 
 
+    cache_key = VerifiedTokenCache.digest(init_data, bot_token or "")
+    cached = init_data_cache.get(cache_key)
+    if cached is not None:
+        return dict(cached)
+
     try:
         parsed_data = dict(parse_qsl(init_data))
     except ValueError:
@@ -38,13 +113,26 @@ def validate_telegram_data(init_data: str, bot_token: str) -> dict:
     hash_check = parsed_data.pop("hash")
     data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(parsed_data.items()))
     
-    secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    secret_key = telegram_secret_key(bot_token or "")
     calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
 
-    if calculated_hash != hash_check:
+    if not hmac.compare_digest(calculated_hash, hash_check):
         raise HTTPException(status_code=403, detail="Invalid Telegram signature")
 
-    return json.loads(parsed_data["user"])
+    expires_at = time.time() + TELEGRAM_INITDATA_CACHE_TTL_SECONDS
+    if TELEGRAM_AUTH_MAX_AGE_SECONDS:
+        try:
+            auth_date = int(parsed_data.get("auth_date", 0))
+        except ValueError:
+            auth_date = 0
+        if time.time() - auth_date > TELEGRAM_AUTH_MAX_AGE_SECONDS:
+            raise HTTPException(status_code=401, detail="Telegram auth data expired")
+        # Never trust a cached entry past the freshness window
+        expires_at = min(expires_at, auth_date + TELEGRAM_AUTH_MAX_AGE_SECONDS)
+
+    user = json.loads(parsed_data["user"])
+    init_data_cache.put(cache_key, user, expires_at)
+    return dict(user)
 
 def create_jwt_token(user_id: int, secret: str) -> str:
     payload = {
@@ -61,66 +149,58 @@ def verify_jwt_token(authorization: str = Header(...), secret: str = None) -> in
         if not secret:
              raise HTTPException(status_code=500, detail="Server Error: JWT Config Missing")
     
-    print(f"🔒 Raw Auth Header: {authorization}")
     if not authorization.startswith("Bearer "):
-        print("❌ Invalid Auth Header Format")
+        logger.debug("Rejected auth header: not a Bearer token")
         raise HTTPException(status_code=401, detail="Invalid auth header")
     
     token = authorization.split(" ")[1]
-    print(f"🔒 Verifying Token: {token[:10]}...")
+    key = VerifiedTokenCache.digest(token, secret)
+    user_id = token_cache.get(key)
+    if user_id is not None:
+        return user_id
+
     try:
         payload = jwt.decode(token, secret, algorithms=["HS256"])
-        print(f"✅ Token Valid for User: {payload['sub']}")
-        return int(payload["sub"])
+        user_id = int(payload["sub"])
     except jwt.ExpiredSignatureError:
-        print("❌ Token Expired")
+        logger.debug("Rejected token: expired")
         raise HTTPException(status_code=401, detail="Token expired")
-    except jwt.InvalidTokenError as e:
-        print(f"❌ Invalid Token: {e}")
+    except (jwt.InvalidTokenError, KeyError, ValueError) as e:
+        logger.info("Rejected token: %s", type(e).__name__)
         raise HTTPException(status_code=401, detail="Invalid token")
 
+    # Tokens without exp are verified every time
+    if payload.get("exp"):
+        token_cache.put(key, user_id, payload["exp"])
+    return user_id
+
+def require_user(authorization: str = Header(...)) -> int:
+    """
+    FastAPI dependency for protected routes: `user_id: int = Depends(require_user)`.
+    """
+    return verify_jwt_token(authorization, os.getenv("JWT_SECRET"))
+
 def get_or_create_user(user_data: dict, supabase_client) -> dict:
     """
-    Checks if user exists, creates if not.
-    If created, awards initial credits via Transaction (Trigger handles Balance).
+    Makes sure the user exists with one idempotent ensure_user() call:
+    inserts the user if missing and grants the welcome gift (Trigger handles Balance).
+    Callers skip this entirely for users in the known-user cache.
     """
     user_id = user_data["id"]
     try:
-        # 1. Check existence
-        # Uses count to avoid data transfer overhead
-        res = supabase_client.table("users").select("id", count="exact").eq("id", user_id).execute()
-        exists = res.count > 0
-        
-        if not exists:
-            print(f"🆕 Creating New User: {user_id}")
-            # 2. Insert User
-            new_user = {
-                "id": user_id,
-                "username": user_data.get("username"),
-                "first_name": user_data.get("first_name"),
-                "last_name": user_data.get("last_name"),
-                "language_code": user_data.get("language_code"),
-                "is_premium": user_data.get("is_premium", False)
-            }
-            supabase_client.table("users").insert(new_user).execute()
-            
-            # 3. Grant Initial Gift (3 Credits, Medium Tier)
-            # Trigger 'on_transaction_created' will update user_balances automatically.
-            gift_transaction = {
-                "user_id": user_id,
-                "transaction_type": "GIFT",
-                "amount": 0.0,
-                "credits_change": 1,
-                "description": "Welcome Gift",
-                "reference_id": f"gift_{user_id}_init" # Idempotency Key
-            }
-            supabase_client.table("user_transactions").insert(gift_transaction).execute()
-            print(f"🎁 Initial Gift Granted for {user_id}")
-            
-        return user_data
-
+        res = supabase_client.rpc("ensure_user", {
+            "p_id": user_id,
+            "p_username": user_data.get("username"),
+            "p_first_name": user_data.get("first_name"),
+            "p_last_name": user_data.get("last_name"),
+            "p_language_code": user_data.get("language_code"),
+            "p_is_premium": user_data.get("is_premium", False)
+        }).execute()
+        if res.data:
+            print(f"🆕 Created New User: {user_id} (🎁 Welcome Gift Granted)")
     except Exception as e:
         print(f"❌ User Creation Failed: {e}")
         # Non-blocking for login, but critical for functionality
-        # We might return user_data anyway or raise
         raise e
+
+    return user_data
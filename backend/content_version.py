@@ -0,0 +1,86 @@
+import os
+import time
+import hashlib
+import threading
+import redis
+
+# Per-user content version behind the ETags of /api/gallery, /api/results and
+# /api/user/me. Bumped after every write that changes what those endpoints
+# return, so a matching If-None-Match can be answered without the database.
+# Versions start from the clock, so a lost key never reuses an old value.
+TTL_SECONDS = int(os.getenv("CONTENT_VERSION_TTL_SECONDS", str(30 * 24 * 3600)))
+
+NAMESPACE = "content_version"
+
+
+class ContentVersions:
+    """
+    Redis-backed when REDIS_URL is set (every instance sees every bump),
+    in-process dict otherwise.
+    """
+
+    def __init__(self, redis_client=None, ttl: int = TTL_SECONDS):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.memory = {} # user_id -> version
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        redis_client = None
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url:
+            try:
+                redis_client = redis.from_url(redis_url)
+            except Exception as e:
+                print(f"⚠️ Content Versions: Redis unavailable ({e}). Versioning per process only.")
+        return cls(redis_client)
+
+    def get(self, user_id: int):
+        """
+        Current version, or None if it cannot be read (callers skip the ETag).
+        """
+        if self.redis:
+            key = f"{NAMESPACE}:{user_id}"
+            try:
+                self.redis.set(key, time.time_ns() // 1000, nx=True, ex=self.ttl)
+                return int(self.redis.get(key))
+            except Exception as e:
+                print(f"⚠️ Content Version Lookup Failed: {e}")
+                return None
+
+        with self.lock:
+            return self.memory.setdefault(user_id, time.time_ns() // 1000)
+
+    def bump(self, user_id):
+        """
+        Call after the write is visible in the database, never before.
+        """
+        if user_id is None:
+            return
+        if self.redis:
+            key = f"{NAMESPACE}:{user_id}"
+            try:
+                pipe = self.redis.pipeline()
+                pipe.set(key, time.time_ns() // 1000, nx=True)
+                pipe.incr(key)
+                pipe.expire(key, self.ttl)
+                pipe.execute()
+            except Exception as e:
+                print(f"⚠️ Content Version Bump Failed ({user_id}): {e}")
+            return
+
+        with self.lock:
+            self.memory[user_id] = self.memory.get(user_id, time.time_ns() // 1000) + 1
+
+
+def etag(version: int, *parts) -> str:
+    """
+    Strong validator for one response: the version plus everything that
+    shapes the body (endpoint, limit, cursor, ...).
+    """
+    material = ":".join(str(p) for p in (version, *parts))
+    return '"' + hashlib.sha256(material.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+content_versions = ContentVersions.from_env()
@@ -0,0 +1,297 @@
+import os
+import time
+import threading
+import redis
+
+# Admission control for generations: a credit is held when a job is enqueued,
+# settled when the ledger debit lands and released when the job fails.
+# Balances are cached from user_balances and reconciled periodically;
+# the ledger stays the source of truth.
+BALANCE_TTL_SECONDS = int(os.getenv("CREDIT_BALANCE_TTL_SECONDS", "3600"))
+HOLD_TTL_SECONDS = int(os.getenv("CREDIT_HOLD_TTL_SECONDS", "3600"))
+RECONCILE_SECONDS = float(os.getenv("CREDIT_RECONCILE_SECONDS", "60"))
+
+FIELDS = ("credits", "premium_credits")
+NAMESPACE = "credits"
+
+# Keys per user: credits:{uid} (cached balance hash), credits:{uid}:holds:{field}
+# (ZSET job_id -> hold deadline in ms, so a hold leaked by a lost job expires
+# on its own), credits:{uid}:settling (ZSET of jobs being billed right now)
+# and credits:{uid}:version (bumped by every settle, see prime).
+
+# Returns 1 if the job holds a credit (new or existing hold), 0 if the balance
+# is exhausted, -1 if the balance is not cached yet.
+RESERVE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[3])
+if redis.call('ZSCORE', KEYS[2], ARGV[1]) then return 1 end
+local available = redis.call('HGET', KEYS[1], ARGV[2])
+if not available then return -1 end
+if tonumber(available) - redis.call('ZCARD', KEYS[2]) < 1 then return 0 end
+redis.call('ZADD', KEYS[2], tonumber(ARGV[3]) + tonumber(ARGV[4]), ARGV[1])
+redis.call('PEXPIRE', KEYS[2], tonumber(ARGV[4]))
+return 1
+"""
+
+# The debit is in the ledger now: drop the hold and spend the cached credit
+SETTLE_SCRIPT = """
+redis.call('ZREM', KEYS[4], ARGV[1])
+redis.call('INCR', KEYS[5])
+redis.call('EXPIRE', KEYS[5], tonumber(ARGV[2]))
+local fields = {'credits', 'premium_credits'}
+for i, field in ipairs(fields) do
+    if redis.call('ZREM', KEYS[i + 1], ARGV[1]) == 1 then
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            redis.call('HINCRBY', KEYS[1], field, -1)
+        end
+        return 1
+    end
+end
+return 0
+"""
+
+# Writes a balance read from user_balances, unless a settle landed since the
+# read (version moved) or, for an overwrite, a debit may be committed but not
+# applied to the cache yet (settling). Either way the cache would end up off
+# by one; the next reconcile retries. Returns 1 if written.
+PRIME_SCRIPT = """
+if tonumber(redis.call('GET', KEYS[4]) or '0') ~= tonumber(ARGV[1]) then return 0 end
+if ARGV[2] == '1' then
+    redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', ARGV[3])
+    if redis.call('ZCARD', KEYS[3]) > 0 then return 0 end
+elseif redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'credits', ARGV[5], 'premium_credits', ARGV[6])
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[4]))
+redis.call('SADD', KEYS[2], ARGV[7])
+return 1
+"""
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+class CreditReservations:
+    """
+    Redis-backed when REDIS_URL is set (holds are shared by every API
+    instance and worker), in-process dicts otherwise.
+    """
+
+    def __init__(self, redis_client=None, balance_ttl: int = BALANCE_TTL_SECONDS, hold_ttl: int = HOLD_TTL_SECONDS):
+        self.redis = redis_client
+        self.balance_ttl = balance_ttl
+        self.hold_ttl = hold_ttl
+
+        # In-memory fallback state
+        self.balances = {} # user_id -> {"credits", "premium_credits", "expires_at"}
+        self.holds = {} # user_id -> {job_id: (field, deadline)}
+        self.settling = {} # user_id -> {job_id: deadline}
+        self.versions = {} # user_id -> settle count
+        self.lock = threading.Lock()
+
+        self._reserve_script = None
+        self._settle_script = None
+        self._prime_script = None
+        if self.redis:
+            self._reserve_script = self.redis.register_script(RESERVE_SCRIPT)
+            self._settle_script = self.redis.register_script(SETTLE_SCRIPT)
+            self._prime_script = self.redis.register_script(PRIME_SCRIPT)
+
+    @classmethod
+    def from_env(cls):
+        redis_client = None
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url:
+            try:
+                redis_client = redis.from_url(redis_url)
+            except Exception as e:
+                print(f"⚠️ Credit Reservations: Redis unavailable ({e}). Holding per process only.")
+        return cls(redis_client)
+
+    def key(self, user_id, suffix: str = None) -> str:
+        return f"{NAMESPACE}:{user_id}" + (f":{suffix}" if suffix else "")
+
+    def _live_holds(self, user_id) -> dict:
+        # Caller holds the lock. Expired holds are dropped on the way.
+        holds = self.holds.setdefault(user_id, {})
+        now = time.time()
+        for job_id in [j for j, (_, deadline) in holds.items() if deadline <= now]:
+            del holds[job_id]
+        return holds
+
+    def reserve(self, user_id: int, job_id: str, field: str):
+        """
+        Holds one `field` credit for the job, for at most hold_ttl seconds.
+        Returns True/False, or None when the balance must be loaded first (see prime).
+        """
+        if self.redis:
+            keys = [self.key(user_id), self.key(user_id, f"holds:{field}")]
+            result = int(self._reserve_script(keys=keys, args=[job_id, field, now_ms(), self.hold_ttl * 1000]))
+            return None if result < 0 else bool(result)
+
+        with self.lock:
+            holds = self._live_holds(user_id)
+            if job_id in holds:
+                return True
+            balance = self.balances.get(user_id)
+            if not balance or balance["expires_at"] <= time.time():
+                return None
+            held = sum(1 for f, _ in holds.values() if f == field)
+            if balance.get(field, 0) - held < 1:
+                return False
+            holds[job_id] = (field, time.time() + self.hold_ttl)
+            return True
+
+    def version(self, user_id: int) -> int:
+        """
+        Settle counter: take it before reading user_balances, pass it to prime.
+        """
+        if self.redis:
+            return int(self.redis.get(self.key(user_id, "version")) or 0)
+
+        with self.lock:
+            return self.versions.get(user_id, 0)
+
+    def prime(self, user_id: int, balance: dict, version: int, overwrite: bool = False) -> bool:
+        """
+        Caches a user_balances row read after version() returned `version`.
+        Without `overwrite` an already cached balance wins: it may include
+        debits the row does not show yet. Skipped (False) if the row may
+        already be stale, see PRIME_SCRIPT.
+        """
+        values = {field: int(balance.get(field) or 0) for field in FIELDS}
+        if self.redis:
+            keys = [self.key(user_id), f"{NAMESPACE}:users", self.key(user_id, "settling"), self.key(user_id, "version")]
+            args = [version, int(overwrite), now_ms(), self.balance_ttl, values["credits"], values["premium_credits"], user_id]
+            return bool(self._prime_script(keys=keys, args=args))
+
+        with self.lock:
+            if self.versions.get(user_id, 0) != version:
+                return False
+            if overwrite:
+                settling = self.settling.get(user_id, {})
+                if any(deadline > time.time() for deadline in settling.values()):
+                    return False
+            elif user_id in self.balances:
+                return False
+            self.balances[user_id] = {**values, "expires_at": time.time() + self.balance_ttl}
+            return True
+
+    def begin_settle(self, job: dict):
+        """
+        Call right before billing: until settle/release, the ledger may show
+        the debit while the cache does not, so reconcile must not overwrite.
+        """
+        user_id = job.get("user_id")
+        if self.redis:
+            key = self.key(user_id, "settling")
+            pipe = self.redis.pipeline()
+            pipe.zadd(key, {job["id"]: now_ms() + self.hold_ttl * 1000})
+            pipe.pexpire(key, self.hold_ttl * 1000)
+            pipe.execute()
+            return
+
+        with self.lock:
+            self.settling.setdefault(user_id, {})[job["id"]] = time.time() + self.hold_ttl
+
+    def settle(self, job: dict):
+        """
+        The generation was billed: convert its hold into the debit.
+        """
+        user_id = job.get("user_id")
+        if self.redis:
+            keys = [self.key(user_id)] + [self.key(user_id, f"holds:{field}") for field in FIELDS]
+            keys += [self.key(user_id, "settling"), self.key(user_id, "version")]
+            self._settle_script(keys=keys, args=[job["id"], self.balance_ttl])
+            return
+
+        with self.lock:
+            self.settling.get(user_id, {}).pop(job["id"], None)
+            self.versions[user_id] = self.versions.get(user_id, 0) + 1
+            field, _ = self.holds.get(user_id, {}).pop(job["id"], (None, None))
+            if field and user_id in self.balances:
+                self.balances[user_id][field] -= 1
+
+    def release(self, job: dict):
+        """
+        The job failed (or was never queued or billed): give the credit back.
+        """
+        user_id = job.get("user_id")
+        if self.redis:
+            pipe = self.redis.pipeline()
+            for field in FIELDS:
+                pipe.zrem(self.key(user_id, f"holds:{field}"), job["id"])
+            pipe.zrem(self.key(user_id, "settling"), job["id"])
+            pipe.execute()
+            return
+
+        with self.lock:
+            self.holds.get(user_id, {}).pop(job["id"], None)
+            self.settling.get(user_id, {}).pop(job["id"], None)
+
+    def invalidate(self, user_id: int):
+        """
+        Drops the cached balance after a ledger credit (e.g. a purchase);
+        the next reservation reloads it. Holds are kept.
+        """
+        if self.redis:
+            self.redis.delete(self.key(user_id))
+            return
+
+        with self.lock:
+            self.balances.pop(user_id, None)
+
+    def cached_users(self) -> list:
+        if self.redis:
+            user_ids = []
+            for raw in self.redis.smembers(f"{NAMESPACE}:users"):
+                user_id = int(raw)
+                if self.redis.exists(self.key(user_id)):
+                    user_ids.append(user_id)
+                else:
+                    self.redis.srem(f"{NAMESPACE}:users", user_id)
+            return user_ids
+
+        with self.lock:
+            now = time.time()
+            for user_id in [u for u, b in self.balances.items() if b["expires_at"] <= now]:
+                del self.balances[user_id]
+            return list(self.balances)
+
+    def drop_expired_holds(self, user_ids: list):
+        """
+        Holds of jobs that were lost (process killed, in-memory queue gone)
+        stop counting once their deadline passes; this also frees the memory.
+        """
+        if self.redis:
+            pipe = self.redis.pipeline()
+            for user_id in user_ids:
+                for field in FIELDS:
+                    pipe.zremrangebyscore(self.key(user_id, f"holds:{field}"), "-inf", now_ms())
+            pipe.execute()
+            return
+
+        with self.lock:
+            for user_id in user_ids:
+                if user_id in self.holds:
+                    self._live_holds(user_id)
+
+    def reconcile(self, supabase_client, chunk_size: int = 500) -> int:
+        """
+        Overwrites cached balances with user_balances. Settled debits are
+        already in the table; open holds are kept and still count. A user
+        with a settle racing the read is skipped until the next run.
+        """
+        user_ids = self.cached_users()
+        for i in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[i:i + chunk_size]
+            self.drop_expired_holds(chunk)
+            versions = {user_id: self.version(user_id) for user_id in chunk}
+            res = supabase_client.table("user_balances").select("user_id, credits, premium_credits").in_("user_id", chunk).execute()
+            for row in res.data or []:
+                self.prime(row["user_id"], row, versions.get(row["user_id"], 0), overwrite=True)
+        return len(user_ids)
+
+
+reservations = CreditReservations.from_env()
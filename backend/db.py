@@ -0,0 +1,60 @@
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from supabase import create_client, Client, ClientOptions
+from metrics import Counter
+
+# Shared data access: one Supabase client (one pooled HTTP/2 session to
+# PostgREST) for the API and the worker. supabase-py is synchronous, so
+# calls run on a bounded thread pool and never block the event loop.
+DB_TIMEOUT_SECONDS = float(os.getenv("DB_TIMEOUT_SECONDS", "10"))
+DB_MAX_CONCURRENCY = int(os.getenv("DB_MAX_CONCURRENCY", "16"))
+
+db_timeouts = Counter("pixelpop_db_timeouts_total", "Database calls abandoned after DB_TIMEOUT_SECONDS.")
+
+SUPABASE_URL = os.getenv("SUPABASE_URL") or os.getenv("VITE_SUPABASE_URL")
+# WORKER AUDIT: Must use Service Role (SUPABASE_KEY) in production for reliability
+if os.getenv("APP_ENV") == "development":
+    SUPABASE_KEY = os.getenv("SUPABASE_KEY") or os.getenv("VITE_SUPABASE_KEY") or os.getenv("VITE_SUPABASE_ANON_KEY")
+    if not os.getenv("SUPABASE_KEY"):
+        print("⚠️  DEV WARN: Helper using ANON KEY. Some admin tasks might fail.")
+else:
+    # Production Strictness
+    SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+    if not SUPABASE_KEY:
+        print("❌ CRITICAL: SUPABASE_KEY (Service Role) missing in Production!")
+
+client: Client = None
+if SUPABASE_URL and SUPABASE_KEY:
+    try:
+        # The HTTP timeout also frees the pool thread of an abandoned call
+        client = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(postgrest_client_timeout=DB_TIMEOUT_SECONDS))
+    except Exception as e:
+        print(f"⚠️ Failed to init Supabase: {e}")
+else:
+    print(f"⚠️ Supabase env vars missing! URL={SUPABASE_URL is not None}, KEY={SUPABASE_KEY is not None}")
+
+executor = ThreadPoolExecutor(max_workers=DB_MAX_CONCURRENCY, thread_name_prefix="db")
+
+
+async def run(fn, *args, timeout: float = DB_TIMEOUT_SECONDS):
+    """
+    Runs a blocking database call on the pool. Time spent waiting for a free
+    thread counts towards `timeout` (None = no limit, for background jobs).
+    """
+    future = asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args))
+    if timeout is None:
+        return await future
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        db_timeouts.inc()
+        raise TimeoutError(f"Database call timed out after {timeout:.0f}s")
+
+
+async def execute(query, timeout: float = DB_TIMEOUT_SECONDS):
+    """
+    Awaitable query.execute() for a PostgREST query builder.
+    """
+    return await run(query.execute, timeout=timeout)
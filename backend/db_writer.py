@@ -0,0 +1,143 @@
+import os
+import asyncio
+from postgrest.exceptions import APIError
+import db
+
+FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL_SECONDS", "0.25"))
+MAX_BATCH = int(os.getenv("DB_FLUSH_MAX_BATCH", "500"))
+# Flushes a row may be rejected by the database before it is dropped
+MAX_ATTEMPTS = int(os.getenv("DB_FLUSH_MAX_ATTEMPTS", "5"))
+
+
+def is_rejection(error: Exception) -> bool:
+    """
+    The database refused the rows (missing column, constraint, bad value):
+    retrying the same row will not help. PGRST0xx are connection errors
+    and, like timeouts and transport errors, are retried without limit.
+    """
+    return isinstance(error, APIError) and not (error.code or "").startswith("PGRST0")
+
+
+class StatusWriteBuffer:
+    """
+    Write-behind buffer for generation status upserts.
+
+    Rows are coalesced per id (later fields win) and flushed as batched
+    multi-row upserts every FLUSH_INTERVAL seconds from a worker thread,
+    so the event loop never waits on a PostgREST round trip (db.run pool).
+    PostgREST bulk upserts need identical columns per row, so each flush
+    sends one request per distinct column set.
+    A rejected multi-row upsert is retried row by row, so one bad row
+    cannot hold back the rest of its chunk; it is dropped after
+    MAX_ATTEMPTS rejections.
+    """
+
+    def __init__(self, get_client, table: str = "generations", interval: float = FLUSH_INTERVAL, max_batch: int = MAX_BATCH, max_attempts: int = MAX_ATTEMPTS):
+        self.get_client = get_client
+        self.table = table
+        self.interval = interval
+        self.max_batch = max_batch
+        self.max_attempts = max_attempts
+        self.pending = {} # id -> merged row
+        self.attempts = {} # id -> rejected flushes so far
+        self.lock = asyncio.Lock()
+        self.task = None
+        self.closed = False
+
+    def enqueue(self, row: dict):
+        row_id = row["id"]
+        self.pending[row_id] = {**self.pending.get(row_id, {}), **row}
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        if self.closed or (self.task and not self.task.done()):
+            return
+        try:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+        except RuntimeError:
+            pass # No loop (sync caller): rows go out with the next flush()
+
+    async def _run(self):
+        while self.pending and not self.closed:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, {}
+
+            client = self.get_client()
+            if not client:
+                return
+
+            groups = {}
+            for row in batch.values():
+                groups.setdefault(tuple(sorted(row)), []).append(row)
+
+            for rows in groups.values():
+                for i in range(0, len(rows), self.max_batch):
+                    await self._write(client, rows[i:i + self.max_batch])
+
+    async def _upsert(self, client, rows: list):
+        """
+        Returns None on success, the exception otherwise.
+        """
+        try:
+            await db.execute(client.table(self.table).upsert(rows))
+        except Exception as e:
+            return e
+        for row in rows:
+            self.attempts.pop(row["id"], None)
+        return None
+
+    async def _write(self, client, chunk: list):
+        error = await self._upsert(client, chunk)
+        if error is None:
+            print(f"📦 DB FLUSH: {len(chunk)} {self.table} row(s)")
+            return
+
+        failed = [(row, error) for row in chunk]
+        if len(chunk) > 1 and is_rejection(error):
+            # The multi-row upsert is atomic: isolate the row(s) the database refuses
+            failed = []
+            for row in chunk:
+                row_error = await self._upsert(client, [row])
+                if row_error is not None:
+                    failed.append((row, row_error))
+            print(f"⚠️ Supabase Batch Upsert Rejected ({len(chunk)} rows): {error}. {len(chunk) - len(failed)} written row by row.")
+        else:
+            print(f"❌ Supabase Batch Upsert Failed ({len(chunk)} rows): {error}. Re-queued.")
+
+        for row, row_error in failed:
+            if is_rejection(row_error):
+                self.attempts[row["id"]] = self.attempts.get(row["id"], 0) + 1
+                if self.attempts[row["id"]] >= self.max_attempts:
+                    self.attempts.pop(row["id"], None)
+                    print(f"🚨 DROPPED {self.table} write for {row['id']} after {self.max_attempts} rejected attempts: {row_error} | Row: {row}")
+                    continue
+            # Keep newer values that arrived while we were flushing
+            self.pending[row["id"]] = {**row, **self.pending.get(row["id"], {})}
+
+    async def drop(self, row_id):
+        """
+        Discards pending writes for a row. Waits for an in-flight flush,
+        so a stale buffered status can never land after the caller's own write.
+        """
+        async with self.lock:
+            self.pending.pop(row_id, None)
+            self.attempts.pop(row_id, None)
+
+    async def close(self):
+        """
+        Final flush on shutdown.
+        """
+        self.closed = True
+        if self.task and not self.task.done():
+            # Let an in-flight flush finish rather than cancelling it mid-request
+            await self.task
+        await self.flush()
+        if self.pending:
+            # One retry for rows re-queued by a failed flush
+            await self.flush()
@@ -2,6 +2,7 @@
 import os
 import asyncio
 from supabase import create_client, Client
+from known_users import KnownUsers
 
 # Hardcoded from .env.local
 SUPABASE_URL="https://iatagwwkyojuufbsyfmi.supabase.co"
@@ -41,5 +42,9 @@ def delete_user_data():
         except Exception as e:
             print(f"⚠️ Error cleaning {table}: {e}")
 
+    # Logins skip ensure_user for known ids: forget this one so it is recreated
+    KnownUsers.from_env().remove(int(USER_ID))
+    print(f"✅ Removed {USER_ID} from known users")
+
 if __name__ == "__main__":
     delete_user_data()
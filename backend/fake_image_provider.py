@@ -0,0 +1,77 @@
+import os
+import asyncio
+import base64
+import hashlib
+from io import BytesIO
+from types import SimpleNamespace
+from PIL import Image, ImageDraw
+
+# Local stand-in for the OpenAI images API (IMAGE_PROVIDER=fake).
+# Mirrors the call shapes the worker uses, including stream=True with
+# partial_images, so the streaming path can be exercised without spend.
+FAKE_LATENCY_SECONDS = float(os.getenv("FAKE_IMAGE_LATENCY_SECONDS", "1.5"))
+
+
+def render_frame(prompt: str, size: str, progress: float) -> str:
+    """
+    Deterministic image for a prompt as base64 PNG. Earlier frames are
+    rendered at a lower resolution and upscaled, like a coarse partial.
+    """
+    width, height = map(int, (size if size and size != "auto" else "1024x1024").split("x"))
+    seed = hashlib.sha256(prompt.encode("utf-8")).digest()
+    detail = max(int(min(width, height) * progress), 8)
+
+    image = Image.new("RGB", (detail, detail), tuple(seed[:3]))
+    draw = ImageDraw.Draw(image)
+    for i in range(3, 30, 3):
+        x, y = seed[i] % detail, seed[i + 1] % detail
+        r = max(detail // 6, 2)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(seed[i:i + 3]))
+    image = image.resize((width, height), Image.Resampling.NEAREST)
+
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getbuffer()).decode("ascii")
+
+
+class FakeImages:
+    def __init__(self, latency: float = FAKE_LATENCY_SECONDS):
+        self.latency = latency
+
+    async def generate(self, *, prompt, size="1024x1024", n=1, stream=False, partial_images=0, **kwargs):
+        return await self._respond("image_generation", prompt, size, n, stream, partial_images)
+
+    async def edit(self, *, image, prompt, size="1024x1024", n=1, stream=False, partial_images=0, **kwargs):
+        return await self._respond("image_edit", prompt, size, n, stream, partial_images)
+
+    async def _respond(self, kind, prompt, size, n, stream, partial_images):
+        if stream:
+            return self._stream(kind, prompt, size, partial_images)
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(data=[
+            SimpleNamespace(b64_json=render_frame(f"{prompt}#{i}" if i else prompt, size, 1.0), url=None)
+            for i in range(n)
+        ])
+
+    async def _stream(self, kind, prompt, size, partial_images):
+        steps = partial_images + 1
+        for index in range(partial_images):
+            await asyncio.sleep(self.latency / steps)
+            yield SimpleNamespace(
+                type=f"{kind}.partial_image",
+                partial_image_index=index,
+                b64_json=render_frame(prompt, size, (index + 1) / (steps * 4)),
+                size=size,
+            )
+        await asyncio.sleep(self.latency / steps)
+        yield SimpleNamespace(
+            type=f"{kind}.completed",
+            b64_json=render_frame(prompt, size, 1.0),
+            size=size,
+            usage=SimpleNamespace(input_tokens=len(prompt) // 4, output_tokens=0, total_tokens=len(prompt) // 4),
+        )
+
+
+class FakeImageClient:
+    def __init__(self, latency: float = FAKE_LATENCY_SECONDS):
+        self.images = FakeImages(latency)
@@ -0,0 +1,179 @@
+import os
+import zlib
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Response bodies below this size go out as they are: the framing overhead
+# and CPU cost outweigh the saved bytes.
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4")) # Dynamic content: fast levels only
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "image/svg+xml")
+# Never buffered or compressed: proxies and EventSource need each event as it is written
+STREAMING_TYPES = ("text/event-stream",)
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    Default response class: orjson when installed (several times faster
+    than json.dumps on gallery-sized payloads), stdlib json otherwise.
+    """
+
+    def render(self, content) -> bytes:
+        if orjson:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+        return super().render(content)
+
+
+def negotiate(accept_encoding: str, codings: tuple = None):
+    """
+    Picks the first of `codings` (default: br if available, then gzip)
+    that an Accept-Encoding header allows (q=0 means refused).
+    """
+    offered = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            offered[name.strip().lower()] = q
+    if codings is None:
+        codings = (("br",) if brotli else ()) + ("gzip",)
+    for coding in codings:
+        if offered.get(coding, offered.get("*", 0)) > 0:
+            return coding
+    return None
+
+
+def strip_coding_suffix(tag: str) -> str:
+    """
+    The middleware marks the ETag of a compressed body ("abc" -> "abc-gzip"):
+    strong validators must differ per content coding.
+    """
+    for coding in ("br", "gzip"):
+        suffix = f'-{coding}"'
+        if tag.endswith(suffix):
+            return tag[:-len(suffix)] + '"'
+    return tag
+
+
+class _Compressor:
+    def __init__(self, coding: str):
+        self.coding = coding
+        if coding == "br":
+            self.engine = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self.engine = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def chunk(self, data: bytes) -> bytes:
+        # Flushed per chunk so streamed responses reach the client as they are written
+        if self.coding == "br":
+            return self.engine.process(data) + self.engine.flush()
+        return self.engine.compress(data) + self.engine.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self.engine.finish() if self.coding == "br" else self.engine.flush()
+
+    def whole(self, data: bytes) -> bytes:
+        if self.coding == "br":
+            return self.engine.process(data) + self.engine.finish()
+        return self.engine.compress(data) + self.engine.flush()
+
+
+class CompressionMiddleware:
+    """
+    Negotiated br/gzip for compressible responses of at least COMPRESS_MIN_BYTES.
+    Single-message bodies (JSON responses) are compressed whole with an exact
+    Content-Length; streamed bodies are compressed chunk by chunk. Responses
+    that already carry a Content-Encoding (precompressed assets) pass through.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESS_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        accept = ""
+        for name, value in scope.get("headers", []):
+            if name == b"accept-encoding":
+                accept = value.decode("latin-1")
+        coding = negotiate(accept) if accept else None
+        if not coding:
+            return await self.app(scope, receive, send)
+
+        start = None
+        compressor = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                return await send(message)
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if compressor is None:
+                headers = {k.lower(): v for k, v in start["headers"]}
+                content_type = headers.get(b"content-type", b"").decode("latin-1")
+                skip = (
+                    b"content-encoding" in headers
+                    or start["status"] < 200 or start["status"] in (204, 304)
+                    or not content_type.startswith(COMPRESSIBLE_TYPES)
+                    or content_type.startswith(STREAMING_TYPES)
+                    or (not more_body and len(body) < self.minimum_size)
+                )
+                if skip:
+                    passthrough = True
+                    await send(start)
+                    return await send(message)
+
+                compressor = _Compressor(coding)
+                new_headers = []
+                for name, value in start["headers"]:
+                    lower = name.lower()
+                    if lower == b"content-length":
+                        continue
+                    if lower == b"etag" and value.endswith(b'"'):
+                        value = value[:-1] + f'-{coding}"'.encode("latin-1")
+                    if lower == b"vary":
+                        continue
+                    new_headers.append((name, value))
+                vary = headers.get(b"vary")
+                new_headers.append((b"vary", vary + b", Accept-Encoding" if vary else b"Accept-Encoding"))
+                new_headers.append((b"content-encoding", coding.encode("latin-1")))
+                if not more_body:
+                    payload = compressor.whole(body)
+                    new_headers.append((b"content-length", str(len(payload)).encode("latin-1")))
+                    await send({**start, "headers": new_headers})
+                    return await send({"type": "http.response.body", "body": payload})
+                await send({**start, "headers": new_headers})
+
+            payload = compressor.chunk(body) if body else b""
+            if not more_body:
+                payload += compressor.finish()
+            if payload or not more_body:
+                await send({"type": "http.response.body", "body": payload, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
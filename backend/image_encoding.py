@@ -0,0 +1,76 @@
+import os
+import time
+from io import BytesIO
+from PIL import Image, features
+
+ENCODERS = {
+    "png": {"pil_format": "PNG", "content_type": "image/png"},
+    "webp": {"pil_format": "WEBP", "content_type": "image/webp"},
+    "avif": {"pil_format": "AVIF", "content_type": "image/avif"},
+}
+
+# Output profile per tier.
+# premium  = quality "high", no watermark -> lossless download
+# standard = watermarked output -> high quality lossy
+OUTPUT_PROFILES = {
+    "premium": {
+        "format": os.getenv("OUTPUT_FORMAT_PREMIUM", "png").lower(),
+        "quality": int(os.getenv("OUTPUT_QUALITY_PREMIUM", "100")),
+    },
+    "standard": {
+        "format": os.getenv("OUTPUT_FORMAT_STANDARD", "webp").lower(),
+        "quality": int(os.getenv("OUTPUT_QUALITY_STANDARD", "90")),
+    },
+}
+
+
+def output_tier(model_config: dict) -> str:
+    return "standard" if model_config.get("should_watermark", True) else "premium"
+
+
+def resolve_profile(tier: str) -> dict:
+    profile = dict(OUTPUT_PROFILES.get(tier) or OUTPUT_PROFILES["standard"])
+    fmt = profile["format"]
+    if fmt not in ENCODERS or (fmt != "png" and not features.check(fmt)):
+        print(f"⚠️ Output format '{fmt}' unavailable, using PNG")
+        profile["format"] = "png"
+    return profile
+
+
+def encode_output(image: Image.Image, tier: str, out: BytesIO = None):
+    """
+    Encodes the final image for storage straight into `out` (a new stream if omitted).
+    Returns (stream, info): the stream is rewound and can be handed to the
+    uploader as-is; info has format, content_type, ext, bytes and encode_ms.
+    """
+    profile = resolve_profile(tier)
+    fmt = profile["format"]
+    quality = profile["quality"]
+
+    if fmt == "png":
+        # PNG is always lossless; quality only trades CPU for size
+        save_args = {"optimize": True}
+    elif fmt == "webp" and quality >= 100:
+        save_args = {"lossless": True, "method": 6}
+    else:
+        save_args = {"quality": quality}
+
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+    started = time.perf_counter()
+    stream = out if out is not None else BytesIO()
+    image.save(stream, format=ENCODERS[fmt]["pil_format"], **save_args)
+    size = stream.tell()
+    stream.seek(0)
+    encode_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    info = {
+        "format": fmt,
+        "content_type": ENCODERS[fmt]["content_type"],
+        "ext": fmt,
+        "quality": quality,
+        "bytes": size,
+        "encode_ms": encode_ms,
+    }
+    return stream, info
@@ -0,0 +1,109 @@
+import os
+import base64
+import binascii
+from io import BytesIO
+
+# Pillow is imported where images are rendered: the API only needs pick_variant
+
+# Responsive variants stored next to the original generation.
+# max_side is the longest edge in px; quality is the encoder quality (0-100).
+VARIANT_SPECS = {
+    "thumb": {"max_side": 384, "quality": 70},
+    "preview": {"max_side": 768, "quality": 80},
+}
+
+# Streamed partial frames: tiny and cheap, they are shown blurred behind the spinner
+PARTIAL_PREVIEW_MAX_SIDE = int(os.getenv("PARTIAL_PREVIEW_MAX_SIDE", "256"))
+PARTIAL_PREVIEW_QUALITY = int(os.getenv("PARTIAL_PREVIEW_QUALITY", "50"))
+
+FORMAT_INFO = {
+    "webp": {"pil_format": "WEBP", "content_type": "image/webp"},
+    "avif": {"pil_format": "AVIF", "content_type": "image/avif"},
+}
+
+# Comma separated list, first entry is the preferred format for clients.
+# AVIF is opt-in: it is slower to encode and needs a Pillow build with libavif.
+VARIANT_FORMATS = [f.strip().lower() for f in os.getenv("IMAGE_VARIANT_FORMATS", "webp").split(",") if f.strip()]
+
+
+def enabled_formats() -> list:
+    from PIL import features
+    formats = []
+    for fmt in VARIANT_FORMATS:
+        if fmt not in FORMAT_INFO:
+            print(f"⚠️ Unknown variant format '{fmt}' (Skipping)")
+            continue
+        if not features.check(fmt):
+            print(f"⚠️ Pillow has no {fmt.upper()} support (Skipping)")
+            continue
+        formats.append(fmt)
+    return formats
+
+
+def variant_key(original_key: str, name: str, fmt: str) -> str:
+    """
+    generations/{user_id}/{job_id}.png -> generations/{user_id}/{job_id}_thumb.webp
+    """
+    base, _ = os.path.splitext(original_key)
+    return f"{base}_{name}.{fmt}"
+
+
+def build_variants(image: "Image.Image") -> list:
+    """
+    Renders every (variant, format) pair from the final image.
+    Returns a list of dicts: {name, format, content_type, data, bytes}
+    where data is a rewound stream ready for upload.
+    Images are only ever downscaled.
+    """
+    from PIL import Image
+    formats = enabled_formats()
+    if not formats:
+        return []
+
+    # Keep alpha only if the source actually has it
+    source = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+    variants = []
+    for name, spec in VARIANT_SPECS.items():
+        resized = source.copy()
+        resized.thumbnail((spec["max_side"], spec["max_side"]), Image.Resampling.LANCZOS)
+        for fmt in formats:
+            stream = BytesIO()
+            resized.save(stream, format=FORMAT_INFO[fmt]["pil_format"], quality=spec["quality"])
+            size = stream.tell()
+            stream.seek(0)
+            variants.append({
+                "name": name,
+                "format": fmt,
+                "content_type": FORMAT_INFO[fmt]["content_type"],
+                "data": stream,
+                "bytes": size,
+            })
+    return variants
+
+
+def render_partial_preview(b64_json: str) -> str:
+    """
+    Downscales a full-size partial frame from the images API
+    to a small WebP data URI for the job state.
+    """
+    from PIL import Image
+    image = Image.open(BytesIO(binascii.a2b_base64(b64_json)))
+    image = image.convert("RGB")
+    image.thumbnail((PARTIAL_PREVIEW_MAX_SIDE, PARTIAL_PREVIEW_MAX_SIDE), Image.Resampling.BILINEAR)
+    stream = BytesIO()
+    image.save(stream, format="WEBP", quality=PARTIAL_PREVIEW_QUALITY)
+    return "data:image/webp;base64," + base64.b64encode(stream.getbuffer()).decode("ascii")
+
+
+def pick_variant(variants: dict, name: str):
+    """
+    Returns the URL of the preferred format for a variant, or None.
+    `variants` is the stored shape: {"thumb": {"webp": url, ...}, ...}
+    """
+    urls = (variants or {}).get(name) or {}
+    for fmt in VARIANT_FORMATS:
+        if urls.get(fmt):
+            return urls[fmt]
+    # Stored with a format that is no longer configured
+    return next(iter(urls.values()), None)
@@ -5,6 +5,9 @@ import asyncio
 import redis
 from typing import Optional
 
+# How far into the queue pop_similar() looks for batchable jobs
+BATCH_SCAN_DEPTH = int(os.getenv("BATCH_SCAN_DEPTH", "100"))
+
 class JobManager:
     def __init__(self):
         self.redis_url = os.getenv("REDIS_URL")
@@ -19,9 +22,9 @@ class JobManager:
             except Exception as e:
                 print(f"⚠️ Failed to connect to Redis: {e}. Falling back to In-Memory.")
 
-    async def enqueue_job(self, prompt: str, model_config: dict, user_id: int) -> str:
+    async def enqueue_job(self, prompt: str, model_config: dict, user_id: int, job_id: str = None) -> str:
         print(f"DEBUG: JobManager({id(self)}) Enqueueing job for user {user_id}")
-        job_id = str(uuid.uuid4())
+        job_id = job_id or str(uuid.uuid4())
         job_data = {
             "id": job_id,
             "user_id": user_id,
@@ -64,6 +67,21 @@ class JobManager:
             if job_id in self.memory_jobs:
                 self.memory_jobs[job_id].update(updates)
 
+    async def requeue_job(self, job: dict):
+        """
+        Puts an unfinished job back as PENDING (worker drain on shutdown).
+        Redis: at the head of the queue, so it is the next job any worker picks up.
+        """
+        job_data = dict(job, status="PENDING")
+        if self.redis:
+            self.redis.lpush("generation_queue", json.dumps(job_data))
+            await self.update_job(job["id"], {"status": "PENDING"})
+        else:
+            # The in-memory queue only lives as long as this process
+            if job["id"] in self.memory_jobs:
+                self.memory_jobs[job["id"]].update({"status": "PENDING"})
+            await self.memory_queue.put(job_data)
+
     # For Worker
     async def pop_job(self):
         if self.redis:
@@ -80,3 +98,30 @@ class JobManager:
                 return self.memory_queue.get_nowait()
             except asyncio.QueueEmpty:
                 return None
+
+    async def pop_similar(self, match, limit: int) -> list:
+        """
+        Takes up to `limit` queued jobs for which match(job) is true, oldest first,
+        leaving the others in place. Used to batch identical requests into one call.
+        """
+        if limit <= 0:
+            return []
+        claimed = []
+        if self.redis:
+            for raw in self.redis.lrange("generation_queue", 0, BATCH_SCAN_DEPTH - 1):
+                if len(claimed) >= limit:
+                    break
+                job = json.loads(raw)
+                # LREM is the claim: 0 means another worker took it first
+                if match(job) and self.redis.lrem("generation_queue", 1, raw):
+                    claimed.append(job)
+        else:
+            queued = []
+            while not self.memory_queue.empty():
+                queued.append(self.memory_queue.get_nowait())
+            for job in queued:
+                if len(claimed) < limit and match(job):
+                    claimed.append(job)
+                else:
+                    self.memory_queue.put_nowait(job)
+        return claimed
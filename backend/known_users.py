@@ -0,0 +1,101 @@
+import os
+import threading
+import redis
+
+# Ids of users known to exist in `users`, so logins can skip the DB.
+# In-process set in front of a Redis set shared by every instance.
+REDIS_KEY = "known_users"
+WARM_LOAD_LIMIT = int(os.getenv("KNOWN_USERS_WARM_LOAD_LIMIT", "200000"))
+LOCAL_MAX_ENTRIES = int(os.getenv("KNOWN_USERS_LOCAL_MAX", "500000"))
+PAGE_SIZE = 1000
+
+
+class KnownUsers:
+    def __init__(self, redis_client=None, local_max: int = LOCAL_MAX_ENTRIES):
+        self.redis = redis_client
+        self.local_max = local_max
+        self.local = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        redis_client = None
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url:
+            try:
+                redis_client = redis.from_url(redis_url)
+            except Exception as e:
+                print(f"⚠️ Known Users: Redis unavailable ({e}). Using in-process set only.")
+        return cls(redis_client)
+
+    def _remember(self, user_ids):
+        with self.lock:
+            if len(self.local) + len(user_ids) > self.local_max:
+                # Start over rather than track recency; Redis still has everyone
+                self.local.clear()
+            self.local.update(user_ids)
+
+    def contains(self, user_id: int) -> bool:
+        if user_id in self.local:
+            return True
+        if self.redis:
+            try:
+                if self.redis.sismember(REDIS_KEY, user_id):
+                    self._remember([user_id])
+                    return True
+            except Exception as e:
+                print(f"⚠️ Known Users Lookup Failed: {e}")
+        return False
+
+    def add(self, *user_ids):
+        if not user_ids:
+            return
+        self._remember(user_ids)
+        if self.redis:
+            try:
+                self.redis.sadd(REDIS_KEY, *user_ids)
+            except Exception as e:
+                print(f"⚠️ Known Users Write Failed: {e}")
+
+    def remove(self, *user_ids):
+        """
+        Forgets deleted users, so their next login recreates them.
+        Other instances drop their local copy when they see the user missing.
+        """
+        if not user_ids:
+            return
+        with self.lock:
+            self.local.difference_update(user_ids)
+        if self.redis:
+            try:
+                self.redis.srem(REDIS_KEY, *user_ids)
+            except Exception as e:
+                print(f"⚠️ Known Users Remove Failed: {e}")
+
+    def warm_load(self, supabase_client, limit: int = WARM_LOAD_LIMIT) -> int:
+        """
+        Loads up to `limit` user ids, newest Telegram ids first, using
+        keyset pages on the primary key. Skipped when another instance
+        has already filled the shared set.
+        """
+        if self.redis:
+            try:
+                if self.redis.scard(REDIS_KEY) > 0:
+                    return 0
+            except Exception as e:
+                print(f"⚠️ Known Users: Redis unavailable for warm load ({e})")
+
+        loaded, last_id = 0, None
+        while loaded < limit:
+            query = supabase_client.table("users").select("id").order("id", desc=True).limit(min(PAGE_SIZE, limit - loaded))
+            if last_id is not None:
+                query = query.lt("id", last_id)
+            rows = query.execute().data or []
+            if not rows:
+                break
+            ids = [row["id"] for row in rows]
+            self.add(*ids)
+            loaded += len(ids)
+            last_id = ids[-1]
+        print(f"👥 Known Users: warm-loaded {loaded} ids")
+        return loaded
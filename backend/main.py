@@ -13,15 +13,31 @@ if os.path.exists(dotenv_local_path):
     print(f"Loading local env from {dotenv_local_path}")
     load_dotenv(dotenv_path=dotenv_local_path, override=True)
 
+# Levelled app loggers (pixelpop.*); everything else keeps its own defaults
+import logging
+logging.basicConfig(format="%(levelname)s %(name)s: %(message)s")
+logging.getLogger("pixelpop").setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
 # Fix for ModuleNotFoundError when running from root (uvicorn backend.main:app)
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from auth import validate_telegram_data, create_jwt_token, verify_jwt_token, get_or_create_user
+from auth import validate_telegram_data, create_jwt_token, require_user, get_or_create_user
 from job_manager import JobManager
-from worker import worker_loop
+from known_users import KnownUsers
+from profile_cache import profile_cache
+from credit_reservations import reservations
+from content_version import content_versions, etag
+from payment_queue import payment_queue
+from telegram_api import BotAPI
+from image_variants import pick_variant
+from metrics import render_all
+from fastapi.responses import PlainTextResponse, StreamingResponse, Response
+from http_encoding import FastJSONResponse, CompressionMiddleware, strip_coding_suffix
 import asyncio
+import time
+import uuid
 
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
 
 # Allow CORS
 # Strict CORS
@@ -44,10 +60,14 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
+app.add_middleware(CompressionMiddleware)
 
 # Initialize Job Manager (Global)
 job_manager = JobManager()
+# User ids known to exist: returning users skip the DB on login
+known_users = KnownUsers.from_env()
 
 JWT_SECRET = os.getenv("JWT_SECRET")
 if not JWT_SECRET:
@@ -56,23 +76,85 @@ if not JWT_SECRET:
 # Support both naming conventions to avoid config errors
 # Support both naming conventions to avoid config errors
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN") or os.getenv("BOT_TOKEN") or ""
+# Raw Bot API calls on the webhook path (keep-alive, non-blocking)
+bot_api = BotAPI(BOT_TOKEN)
+
+# APP_ROLE=api: API and frontend only. The generation worker, and the image
+# and storage SDKs it loads, stay out of the process (another replica runs it).
+APP_ROLE = os.getenv("APP_ROLE", "all").lower()
+worker = None
+if APP_ROLE != "api":
+    import worker
 
 @app.on_event("startup")
 async def startup_event():
-    print("🚀 Starting Background Worker...")
-    asyncio.create_task(worker_loop(job_manager))
-
-# Initialize Supabase
-from supabase import create_client, Client
-SUPABASE_URL = os.getenv("SUPABASE_URL") or os.getenv("VITE_SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY") or os.getenv("VITE_SUPABASE_KEY") or os.getenv("VITE_SUPABASE_ANON_KEY")
+    if worker:
+        print("🚀 Starting Background Worker...")
+        asyncio.create_task(worker.worker_loop(job_manager))
+        asyncio.create_task(worker.spool_loop(job_manager))
+        asyncio.create_task(worker.reconcile_loop())
+    else:
+        print(f"🚀 Starting without Background Worker (APP_ROLE={APP_ROLE})")
+    # Payments are fulfilled wherever webhooks are served
+    asyncio.create_task(payment_loop())
+    if supabase:
+        asyncio.create_task(warm_known_users())
 
-supabase: Client = None
-if SUPABASE_URL and SUPABASE_KEY:
+async def warm_known_users():
     try:
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+        await db.run(known_users.warm_load, supabase, timeout=None)
     except Exception as e:
-        print(f"⚠️ Failed to init Supabase in Main: {e}")
+        print(f"⚠️ Known Users Warm Load Failed: {e}")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await bot_api.close()
+    if not worker:
+        return
+    # Finish (or re-queue) in-flight generations before the process exits
+    await worker.drain(job_manager)
+    # Guaranteed flush of buffered generation status writes
+    await worker.status_buffer.close()
+
+@app.get("/api/health")
+async def health():
+    """
+    Liveness + drain state. 503 once draining, so the platform stops routing
+    here and can wait for in_flight to reach 0 (status "drained").
+    """
+    if not worker:
+        return {"status": "ok", "in_flight": 0, "role": APP_ROLE}
+    state = worker.worker_health()
+    return FastJSONResponse(state, status_code=200 if state["status"] == "ok" else 503)
+
+@app.post("/api/worker/drain", status_code=202)
+async def start_drain(authorization: str = Header(None)):
+    """
+    Pre-stop hook: starts draining without stopping the API.
+    Requires DRAIN_TOKEN (disabled when unset).
+    """
+    drain_token = os.getenv("DRAIN_TOKEN")
+    if not drain_token or authorization != f"Bearer {drain_token}":
+        raise HTTPException(status_code=401, detail="Invalid drain token")
+    if not worker:
+        return {"status": "drained", "in_flight": 0, "role": APP_ROLE}
+    asyncio.create_task(worker.drain(job_manager))
+    return {**worker.worker_health(), "status": "draining"}
+
+# Shared Supabase client (see db.py): every call goes through db.run/db.execute
+import db
+from db import client as supabase
+
+@app.get("/metrics")
+async def get_metrics(authorization: str = Header(None)):
+    """
+    Prometheus scrape endpoint (per-process metrics).
+    Protected by METRICS_TOKEN when it is set.
+    """
+    metrics_token = os.getenv("METRICS_TOKEN")
+    if metrics_token and authorization != f"Bearer {metrics_token}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return PlainTextResponse(render_all(), media_type="text/plain; version=0.0.4")
 
 @app.post("/api/auth/login")
 async def login(request: Request):
@@ -91,7 +173,10 @@ async def login(request: Request):
     # Sync with DB (Create if new + Gift)
     if supabase:
         try:
-            get_or_create_user(user, supabase)
+            # Returning users are already known: no DB round trip
+            if not known_users.contains(user["id"]):
+                await db.run(get_or_create_user, user, supabase)
+                known_users.add(user["id"])
         except Exception as e:
             print(f"⚠️ DB Sync Failed: {e}")
             # Decide if block login or allow? Allow for robustness, but log error.
@@ -106,53 +191,72 @@ async def login(request: Request):
         "user": user
     }
 
+def check_etag(request: Request, user_id: int, *parts):
+    """
+    Conditional GET against the user's content version (see content_version.py).
+    Returns (etag, 304 response if If-None-Match matches else None).
+    The version is read before the data, so a concurrent write can only
+    make the tag older than the body, never newer.
+    """
+    version = content_versions.get(user_id)
+    if version is None:
+        return None, None
+    tag = etag(version, request.url.path, *parts)
+    if tag in [strip_coding_suffix(t.strip()) for t in request.headers.get("if-none-match", "").split(",")]:
+        return tag, Response(status_code=304, headers=etag_headers(tag))
+    return tag, None
+
+def etag_headers(tag: str) -> dict:
+    # Browsers revalidate every time and get a body-less 304 while nothing changed
+    return {"ETag": tag, "Cache-Control": "private, no-cache"} if tag else {}
+
 @app.get("/api/user/me")
-async def get_current_user(authorization: str = Header(...)):
-    # Force Redeploy
+async def get_current_user(request: Request, user_id: int = Depends(require_user)):
     """
     Get current user profile and balance.
+    Served from the profile cache; misses cost one get_user_profile() call.
+    Cache entries are keyed on the ETag, so a profile read before a
+    concurrent write is never served under the version that write bumped to.
     """
-    user_id = verify_jwt_token(authorization, JWT_SECRET)
-    
-    # Import locally to avoid issues
-    from worker import supabase
+    tag, not_modified = check_etag(request, user_id)
+    if not_modified:
+        return not_modified
+
+    profile = profile_cache.get(user_id, tag)
+    if profile:
+        return FastJSONResponse(profile, headers=etag_headers(tag))
+
     if not supabase:
         raise HTTPException(status_code=503, detail="Database unavailable")
-        
+
     try:
-        # Fetch balance
-        res = supabase.table("user_balances").select("*").eq("user_id", user_id).execute()
-        balance_data = res.data[0] if res.data else {"credits": 0, "balance": 0.0}
-        
-        # User details (optional, client might have them, but good to refresh)
-        user_res = supabase.table("users").select("*").eq("id", user_id).execute()
-        user_data = user_res.data[0] if user_res.data else {}
-        
-        return {
-            "id": user_id,
-            "credits": balance_data.get("credits", 0),
-            "premium_credits": balance_data.get("premium_credits", 0),
-            "balance": balance_data.get("balance", 0.0),
-            "username": user_data.get("username"),
-            "first_name": user_data.get("first_name"),
-            "is_premium": user_data.get("is_premium", False)
-        }
+        res = await db.execute(supabase.rpc("get_user_profile", {"p_user_id": user_id}))
+        row = res.data[0] if res.data else {}
     except Exception as e:
         print(f"❌ Get User Failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+    profile = {
+        "id": user_id,
+        "credits": row.get("credits", 0),
+        "premium_credits": row.get("premium_credits", 0),
+        "balance": row.get("balance", 0.0),
+        "username": row.get("username"),
+        "first_name": row.get("first_name"),
+        "is_premium": row.get("is_premium", False)
+    }
+    profile_cache.put(user_id, profile, tag)
+    return FastJSONResponse(profile, headers=etag_headers(tag))
 
 
 @app.post("/api/generation", status_code=202)
 async def create_generation_job(
     request: Request, 
-    authorization: str = Header(...)
+    user_id: int = Depends(require_user)
 ):
     """
     Protected Endpoint: Enqueues a generation job.
     """
-    # 1. Verify Auth
-    user_id = verify_jwt_token(authorization, JWT_SECRET)
     
     # 2. Parse Request
     body = await request.json()
@@ -161,34 +265,35 @@ async def create_generation_job(
     
     print(f"📥 Job Request from User {user_id}: {prompt[:30]}...")
 
-    # 3. Check Balance & Determine Watermark
-    # Import locally to use supabase
-    from worker import supabase
-    if not supabase:
-        raise HTTPException(status_code=503, detail="Database unavailable")
-    
-    # Get current balance
-    bal_res = supabase.table("user_balances").select("credits, premium_credits").eq("user_id", user_id).execute()
-    if not bal_res.data:
-         raise HTTPException(status_code=403, detail="User balance not found")
-    
-    balance = bal_res.data[0]
-    basic_creds = balance.get("credits", 0)
-    prem_creds = balance.get("premium_credits", 0)
-
+    # 3. Hold a Credit & Determine Watermark
+    # The hold is atomic, so parallel requests cannot spend the same credit.
+    # Settled by the worker when billing lands, released if the job fails.
     quality = model_config.get("quality", "standard")
-    should_watermark = True
-
-    if quality == "high":
-        # Check Premium Credits
-        if prem_creds < 1:
-             raise HTTPException(status_code=402, detail="Insufficient Premium Credits. Please upgrade your plan.")
-        should_watermark = False
-    else:
-        # Check Basic Credits
-        if basic_creds < 1:
-             raise HTTPException(status_code=402, detail="Insufficient Basic Credits. Please top up.")
-        should_watermark = True
+    credit_field = "premium_credits" if quality == "high" else "credits"
+    job_id = str(uuid.uuid4())
+
+    held = reservations.reserve(user_id, job_id, credit_field)
+    # Balance not cached yet (first job or after a purchase): one DB read.
+    # Read again only if a settle raced it (prime refuses a stale row).
+    for _ in range(3):
+        if held is not None:
+            break
+        if not supabase:
+            raise HTTPException(status_code=503, detail="Database unavailable")
+        version = reservations.version(user_id)
+        bal_res = await db.execute(supabase.table("user_balances").select("credits, premium_credits").eq("user_id", user_id))
+        if not bal_res.data:
+             # Deleted user: the next login must recreate them instead of skipping ensure_user
+             known_users.remove(user_id)
+             raise HTTPException(status_code=403, detail="User balance not found")
+        reservations.prime(user_id, bal_res.data[0], version)
+        held = reservations.reserve(user_id, job_id, credit_field)
+
+    if not held:
+        if quality == "high":
+            raise HTTPException(status_code=402, detail="Insufficient Premium Credits. Please upgrade your plan.")
+        raise HTTPException(status_code=402, detail="Insufficient Basic Credits. Please top up.")
+    should_watermark = quality != "high"
 
     # 4. Enqueue Job
     # We pass should_watermark to the worker via model_config or top-level job args?
@@ -196,7 +301,11 @@ async def create_generation_job(
     # JobManager.enqueue_job just stores the dict. We can add it to model_config.
     model_config["should_watermark"] = should_watermark
     
-    job_id = await job_manager.enqueue_job(prompt, model_config, user_id)
+    try:
+        await job_manager.enqueue_job(prompt, model_config, user_id, job_id=job_id)
+    except Exception:
+        reservations.release({"id": job_id, "user_id": user_id})
+        raise
     
     return {
         "job_id": job_id,
@@ -207,13 +316,11 @@ async def create_generation_job(
 @app.get("/api/generation/{job_id}")
 async def get_generation_status(
     job_id: str,
-    authorization: str = Header(...)
+    user_id: int = Depends(require_user)
 ):
     """
     Protected Endpoint: Poll for job status.
     """
-    # 1. Verify Auth
-    verify_jwt_token(authorization, JWT_SECRET)
     
     # 2. Get Job
     job = await job_manager.get_job(job_id)
@@ -221,25 +328,74 @@ async def get_generation_status(
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
         
+    return generation_status(job)
+
+def generation_status(job: dict) -> dict:
     return {
         "job_id": job["id"],
         "status": job["status"],
         "result": job.get("result"),
-        "error": job.get("error")
+        "error": job.get("error"),
+        "preview": job.get("partial") # Latest streamed partial frame (small data URI)
     }
 
+STREAM_POLL_SECONDS = float(os.getenv("GENERATION_STREAM_POLL_SECONDS", "0.5"))
+STREAM_TIMEOUT_SECONDS = float(os.getenv("GENERATION_STREAM_TIMEOUT_SECONDS", "180"))
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.get("/api/generation/{job_id}/stream")
+async def stream_generation_status(
+    job_id: str,
+    user_id: int = Depends(require_user)
+):
+    """
+    Protected Endpoint: Server-Sent Events for one job.
+    Emits `partial` for each new preview frame, `status` on every status change,
+    and closes after COMPLETED/FAILED. Reads the shared job state, so it works
+    whichever process runs the worker.
+    """
+
+    if not await job_manager.get_job(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def events():
+        last_status, last_partial = None, None
+        deadline = time.monotonic() + STREAM_TIMEOUT_SECONDS
+        while True:
+            job = await job_manager.get_job(job_id)
+            if not job:
+                yield sse_event("error", {"detail": "Job not found"})
+                return
+            partial = job.get("partial")
+            if partial and partial.get("index") != last_partial:
+                last_partial = partial.get("index")
+                yield sse_event("partial", partial)
+            if job["status"] != last_status:
+                last_status = job["status"]
+                yield sse_event("status", generation_status(job))
+            if job["status"] in ("COMPLETED", "FAILED"):
+                return
+            if time.monotonic() > deadline:
+                yield sse_event("timeout", {"job_id": job_id})
+                return
+            await asyncio.sleep(STREAM_POLL_SECONDS)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no" # Don't let proxies buffer the stream
+    })
+
 @app.delete("/api/generation/{job_id}")
 async def delete_generation(
     job_id: str,
-    authorization: str = Header(...)
+    user_id: int = Depends(require_user)
 ):
     """
     Soft-delete (archive) a generation.
     """
-    user_id = verify_jwt_token(authorization, JWT_SECRET)
     
-    # Import locally
-    from worker import supabase
     if not supabase:
         raise HTTPException(status_code=503, detail="Database unavailable")
 
@@ -249,10 +405,10 @@ async def delete_generation(
         # If row doesn't exist or not owned, it returns count 0, which is fine (idempotent)
         # or we might want to know.
         
-        res = supabase.table("generations").update({"is_archived": True})\
+        res = await db.execute(supabase.table("generations").update({"is_archived": True})\
             .eq("id", job_id)\
-            .eq("user_id", user_id)\
-            .execute()
+            .eq("user_id", user_id))
+        content_versions.bump(user_id)
             
         if not res.data:
             # Either ID wrong or User wrong
@@ -271,12 +427,11 @@ async def delete_generation(
 async def submit_feedback(
     job_id: str,
     request: Request,
-    authorization: str = Header(...)
+    user_id: int = Depends(require_user)
 ):
     """
     Submit user feedback (thumbs_up / thumbs_down) for a generation.
     """
-    user_id = verify_jwt_token(authorization, JWT_SECRET)
     
     body = await request.json()
     feedback = body.get("feedback")
@@ -284,17 +439,15 @@ async def submit_feedback(
     if feedback not in ["thumbs_up", "thumbs_down"]:
          raise HTTPException(status_code=400, detail="Invalid feedback value")
          
-    # Import locally
-    from worker import supabase
     if not supabase:
         raise HTTPException(status_code=503, detail="Database unavailable")
 
     try:
         # Update using job_id and user_id for security
-        res = supabase.table("generations").update({"feedback": feedback})\
+        res = await db.execute(supabase.table("generations").update({"feedback": feedback})\
             .eq("id", job_id)\
-            .eq("user_id", user_id)\
-            .execute()
+            .eq("user_id", user_id))
+        content_versions.bump(user_id)
             
         return {"ok": True, "job_id": job_id, "feedback": feedback}
 
@@ -304,120 +457,176 @@ async def submit_feedback(
         # But we assume migration ran or will run.
         raise HTTPException(status_code=500, detail=str(e))
 
+def variant_fields(item: dict) -> dict:
+    """
+    Gallery-sized variants for a generation row.
+    Rows created before variants existed fall back to the full image.
+    """
+    variants = item.get("variants") or {}
+    return {
+        "thumb": pick_variant(variants, "thumb") or item["image_url"],
+        "preview": pick_variant(variants, "preview") or item["image_url"],
+        "variants": variants
+    }
+
+GENERATION_COLUMNS = "id, image_url, variants, prompt, cost, created_at"
+
+RESULTS_PAGE_SIZE = int(os.getenv("RESULTS_PAGE_SIZE", "100"))
+RESULTS_MAX_PAGE_SIZE = 500
+
+def encode_generation_cursor(item: dict) -> str:
+    return b64encode(json.dumps({"created_at": item["created_at"], "id": item["id"]}).encode('utf-8')).decode('utf-8')
+
+def decode_generation_cursor(cursor: str):
+    """
+    Returns (created_at, id). Cursors issued before the id tie-breaker
+    are a bare timestamp: id is None for those.
+    """
+    raw = b64decode(cursor).decode('utf-8')
+    if raw.startswith("{"):
+        data = json.loads(raw)
+        return data["created_at"], data["id"]
+    return raw, None
+
+def fetch_completed_generations(client, user_id: int, limit: int, cursor: str = None) -> list:
+    """
+    One keyset page of a user's rendered generations, newest first.
+    Fetches limit + 1 rows so callers can tell whether there is more.
+    Served by the idx_generations_gallery partial index.
+    """
+    query = client.table("generations")\
+        .select(GENERATION_COLUMNS)\
+        .eq("user_id", user_id)\
+        .eq("status", "COMPLETED")\
+        .eq("is_archived", False)\
+        .not_.is_("image_url", "null")\
+        .order("created_at", desc=True)\
+        .order("id", desc=True)\
+        .limit(limit + 1)
+
+    if cursor:
+        try:
+            last_created_at, last_id = decode_generation_cursor(cursor)
+        except Exception:
+            last_created_at = None # Invalid cursor, ignore
+        if last_created_at and last_id:
+            # The lte is implied by the or_, but Postgres cannot derive an index bound
+            # from an OR: with it the scan starts at the cursor instead of the newest row
+            query = query.lte("created_at", last_created_at)\
+                .or_(f'created_at.lt."{last_created_at}",and(created_at.eq."{last_created_at}",id.lt."{last_id}")')
+        elif last_created_at:
+            query = query.lt("created_at", last_created_at)
+
+    return query.execute().data
+
+def result_item(item: dict) -> dict:
+    return {
+        "id": item["id"],
+        "src": item["image_url"],
+        **variant_fields(item),
+        "prompt": item.get("prompt"),
+        "cost": item.get("cost")
+    }
+
 @app.get("/api/results") # Was generations, but let's check legacy
-async def list_generations(authorization: str = Header(...)):
+async def list_generations(
+    request: Request,
+    user_id: int = Depends(require_user),
+    limit: int = RESULTS_PAGE_SIZE,
+    cursor: str = None,
+    stream: bool = False
+):
     """
-    Protected Endpoint: List list user's processed generations.
+    Protected Endpoint: List user's processed generations, newest first.
+    Pages of `limit` items; X-Next-Cursor carries the cursor of the next page.
+    With stream=true the whole history is sent as one JSON array, written
+    page by page as it is read (for exports).
     """
-    # 1. Verify Auth
-    user_id = verify_jwt_token(authorization, JWT_SECRET)
-    
-    # 2. Query Supabase directly
-    if not job_manager.supabase: # Access supabase client from job_manager or import
-        # We need access to supabase client. 
-        # In worker.py it is global. In main.py we can import it or re-init?
-        # Better: Import from worker or create valid client here.
-        # But worker.py imports main? No.
-        pass
-
-    # Quick fix: Import supabase client from worker
-    from worker import supabase
     
     if not supabase:
         return []
 
-    try:
-        response = supabase.table("generations")\
-            .select("*")\
-            .eq("user_id", user_id)\
-            .eq("is_archived", False)\
-            .order("created_at", desc=True)\
-            .execute()
-        
-        # Map to frontend format
-        results = []
-        for item in response.data:
-            if item.get("status") == "COMPLETED" and item.get("image_url"):
-                 results.append({
-                     "id": item["id"],
-                     "src": item["image_url"],
-                     "prompt": item.get("prompt"),
-                     "cost": item.get("cost")
-                 })
-        return results
+    limit = max(1, min(limit, RESULTS_MAX_PAGE_SIZE))
+    tag, not_modified = check_etag(request, user_id, limit, cursor, stream)
+    if not_modified:
+        return not_modified
 
-    except Exception as e:
-        print(f"❌ Failed to fetch generations: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    if stream:
+        async def export():
+            page_cursor, first = cursor, True
+            yield "["
+            try:
+                while True:
+                    rows = await db.run(fetch_completed_generations, supabase, user_id, RESULTS_MAX_PAGE_SIZE, page_cursor)
+                    page = rows[:RESULTS_MAX_PAGE_SIZE]
+                    for item in page:
+                        yield ("" if first else ",") + json.dumps(result_item(item))
+                        first = False
+                    if len(rows) <= RESULTS_MAX_PAGE_SIZE:
+                        break
+                    page_cursor = encode_generation_cursor(page[-1])
+            except Exception as e:
+                # Headers are gone: abort so the client sees a truncated body, not a short list
+                print(f"❌ Results Export Failed for User {user_id}: {e}")
+                raise
+            yield "]"
+
+        return StreamingResponse(export(), media_type="application/json", headers=etag_headers(tag))
 
+    try:
+        rows = await db.run(fetch_completed_generations, supabase, user_id, limit, cursor)
     except Exception as e:
         print(f"❌ Failed to fetch generations: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+    headers = etag_headers(tag)
+    if len(rows) > limit:
+        rows = rows[:limit]
+        headers["X-Next-Cursor"] = encode_generation_cursor(rows[-1])
+    return FastJSONResponse([result_item(item) for item in rows], headers=headers)
+
 from base64 import b64encode, b64decode
 
 @app.get("/api/gallery")
 async def get_gallery(
-    authorization: str = Header(...),
+    request: Request,
+    user_id: int = Depends(require_user),
     limit: int = 20,
     cursor: str = None
 ):
     """
     Cursor-based pagination for infinite scroll.
-    Cursor = Base64 encoded 'created_at' timestamp of the last item.
+    Keyset on (created_at, id), so rows sharing a timestamp are neither skipped
+    nor repeated.
+    Cursor = Base64 encoded JSON {created_at, id} of the last item.
+    Unchanged pages are answered with 304 (ETag) without touching the database.
     """
-    user_id = verify_jwt_token(authorization, JWT_SECRET)
     
-    # Import locally to avoid circular dep issues if any
-    from worker import supabase
     if not supabase: return {"items": [], "next_cursor": None, "has_more": False}
 
+    tag, not_modified = check_etag(request, user_id, limit, cursor)
+    if not_modified:
+        return not_modified
+
     try:
-        query = supabase.table("generations")\
-            .select("*")\
-            .eq("user_id", user_id)\
-            .eq("status", "COMPLETED")\
-            .eq("is_archived", False)\
-            .order("created_at", desc=True)\
-            .limit(limit + 1) # Fetch one extra to check if there's more
-
-        if cursor:
-            try:
-                # Decode cursor to timestamp
-                last_created_at = b64decode(cursor).decode('utf-8')
-                query = query.lt("created_at", last_created_at)
-            except:
-                pass # Invalid cursor, ignore or error
-
-        response = query.execute()
-        data = response.data
+        data = await db.run(fetch_completed_generations, supabase, user_id, limit, cursor)
         
         has_more = len(data) > limit
         if has_more:
             data = data[:limit] # Remove the extra item
             # Create next cursor from the last item
-            last_item = data[-1]
-            next_cursor = b64encode(last_item["created_at"].encode('utf-8')).decode('utf-8')
+            next_cursor = encode_generation_cursor(data[-1])
         else:
             next_cursor = None
 
-        # Map to frontend format
-        items = []
-        for item in data:
-             if item.get("image_url"):
-                 items.append({
-                     "id": item["id"],
-                     "src": item["image_url"],
-                     "prompt": item.get("prompt"),
-                     "cost": item.get("cost"),
-                     "created_at": item["created_at"]
-                 })
-
-        return {
+        # Map to frontend format (rows without an image are filtered in SQL)
+        items = [{**result_item(item), "created_at": item["created_at"]} for item in data]
+
+        return FastJSONResponse({
             "items": items,
             "next_cursor": next_cursor,
             "has_more": has_more
-        }
+        }, headers=etag_headers(tag))
 
     except Exception as e:
         print(f"❌ Gallery Error: {e}")
@@ -428,12 +637,11 @@ async def get_gallery(
 @app.post("/api/upload")
 async def upload_file(
     file: UploadFile = File(...),
-    authorization: str = Header(...)
+    user_id: int = Depends(require_user)
 ):
     """
     Uploads an image to S3/Supabase Storage and returns the URL.
     """
-    user_id = verify_jwt_token(authorization, JWT_SECRET)
     
     # Import locally
     import boto3
@@ -497,41 +705,37 @@ async def upload_file(
 
 
 # --- Static Files (Must be last) ---
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from static_files import StaticManifest
 
 # Check if dist exists (Production)
 dist_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "frontend", "dist")
 if os.path.exists(dist_path):
-    app.mount("/assets", StaticFiles(directory=os.path.join(dist_path, "assets")), name="assets")
-    
-    # Serve index.html for all other routes (Client-side routing)
+    static_manifest = StaticManifest(dist_path)
+
+    # Files from dist, index.html for all other routes (Client-side routing)
     @app.get("/{full_path:path}")
-    async def serve_react_app(full_path: str):
+    async def serve_react_app(full_path: str, request: Request):
         # API routes are already handled above, this catches non-api
         if full_path.startswith("api/"):
             raise HTTPException(status_code=404, detail="Not Found")
-        
-        # Check if specific file exists in dist (e.g. favicon.ico)
-        file_path = os.path.join(dist_path, full_path)
-        if os.path.exists(file_path) and os.path.isfile(file_path):
-             return FileResponse(file_path)
-             
-        return FileResponse(os.path.join(dist_path, "index.html"))
+
+        entry = static_manifest.lookup(full_path)
+        if not entry:
+            raise HTTPException(status_code=404, detail="Not Found")
+        return static_manifest.response(entry, request.headers.get("accept-encoding", ""), request.headers.get("if-none-match", ""))
 else:
     print("⚠️ 'dist' directory not found. Frontend will not be served (OK for local dev if using Vite server).")
 
 
 # --- Telegram Stars Payment Logic ---
-import requests
-import telegram 
-from telegram.error import TelegramError
+# python-telegram-bot is imported on the first payment, not at startup
 
 # Initialize Bot Instance
 bot_instance = None
 def get_bot():
     global bot_instance
     if not bot_instance and BOT_TOKEN:
+        import telegram
         bot_instance = telegram.Bot(token=BOT_TOKEN)
     return bot_instance
 
@@ -544,9 +748,8 @@ STARS_PRICING = {
 @app.post("/api/payment/create-invoice")
 async def create_invoice(
     request: Request,
-    authorization: str = Header(...)
+    user_id: int = Depends(require_user)
 ):
-    user_id = verify_jwt_token(authorization, JWT_SECRET)
     body = await request.json()
     plan_id = body.get("plan_id")
     
@@ -570,13 +773,14 @@ async def create_invoice(
         if not bot:
              raise Exception("Bot token not configured")
              
+        from telegram import LabeledPrice
         link = await bot.create_invoice_link(
              title=payload["title"],
              description=payload["description"],
              payload=payload["payload"],
              provider_token=payload["provider_token"],
              currency=payload["currency"],
-             prices=[telegram.LabeledPrice(plan["label"], plan["amount"])]
+             prices=[LabeledPrice(plan["label"], plan["amount"])]
         )
         return {"invoice_link": link}
 
@@ -604,19 +808,15 @@ async def telegram_webhook(request: Request):
             
             print(f"💳 Pre-Checkout: {pcq_id}. Token check: {'OK' if BOT_TOKEN else 'MISSING'}")
             
-            # Use raw requests for reliability (avoid async SDK issues)
             try:
-                url = f"https://api.telegram.org/bot{BOT_TOKEN}/answerPreCheckoutQuery"
-                payload = {"pre_checkout_query_id": pcq_id, "ok": True}
-                res = requests.post(url, json=payload, timeout=5)
-                res.raise_for_status()
-                print(f"✅ Answered Pre-Checkout (HTTP): {pcq_id} -> {res.json()}")
+                result = await bot_api.answer_pre_checkout(pcq_id, ok=True)
+                print(f"✅ Answered Pre-Checkout: {pcq_id} -> {result}")
             except Exception as e:
-                print(f"❌ Failed to Answer Pre-Checkout (HTTP): {e}")
+                print(f"❌ Failed to Answer Pre-Checkout: {e}")
                 
             return {"ok": True}
 
-        # 2. Successful Payment
+        # 2. Successful Payment: queued for payment_loop, acked right away
         if "message" in update and "successful_payment" in update["message"]:
             msg = update["message"]
             pay_info = msg["successful_payment"]
@@ -631,54 +831,13 @@ async def telegram_webhook(request: Request):
             user_id = int(user_id_str)
             
             print(f"💰 PAYMENT SUCCESS: User {user_id} bought {plan_id}")
-            
-            # Fulfill Order (DB Update)
-            from worker import supabase
-            if supabase and plan_id in STARS_PRICING:
-                plan = STARS_PRICING[plan_id]
-                ref_id = f"pay_{msg['message_id']}"
-                
-                # Idempotency Check
-                existing = supabase.table("user_transactions").select("id").eq("reference_id", ref_id).execute()
-                if existing.data:
-                    print(f"⚠️ Duplicate Payment Ignored: {ref_id}")
-                    return {"ok": True}
-
-                # Upsert Transaction
-                tx_data = {
-                    "user_id": user_id,
-                    "amount": plan["usd_value"], # Log USD Value (Net Revenue) instead of Stars
-                    "transaction_type": "PURCHASE",
-                    "description": f"Bought {plan_id.upper()}",
-
-                    "credits_change": plan["credits"],
-                    "premium_credits_change": plan["premium_credits"],
-                    "reference_id": ref_id 
-                }
-                supabase.table("user_transactions").insert(tx_data).execute()
-                
-                # Update Balance - REMOVED (Handled by DB Trigger on user_transactions)
-                # Explanation: Inserting into 'user_transactions' fires a trigger that updates 'user_balances'.
-                # Doing it manually here caused Double Credits (Trigger + Manual).
-                # --------------------------------------------------------------------------------
-                # try:
-                #     bal_res = supabase.table("user_balances").select("*").eq("user_id", user_id).execute()
-                #     if bal_res.data:
-                #         cur = bal_res.data[0]
-                #         supabase.table("user_balances").update({
-                #             "credits": cur.get("credits", 0) + plan["credits"],
-                #             "premium_credits": cur.get("premium_credits", 0) + plan["premium_credits"]
-                #         }).eq("user_id", user_id).execute()
-                #     else:
-                #         supabase.table("user_balances").insert({
-                #             "user_id": user_id,
-                #             "credits": plan["credits"],
-                #             "premium_credits": plan["premium_credits"],
-                #             "balance": 0.0
-                #         }).execute()
-                #     print(f"✅ Balance Updated for User {user_id}")
-                # except Exception as e:
-                #     print(f"❌ Balance Update Failed: {e}")
+            payment = {"user_id": user_id, "plan_id": plan_id, "reference_id": f"pay_{msg['message_id']}"}
+            try:
+                payment_queue.push(payment)
+            except Exception as e:
+                # Not acked: Telegram redelivers the update, so the payment is not lost
+                print(f"❌ Payment Enqueue Failed ({payment['reference_id']}): {e}")
+                return FastJSONResponse({"ok": False}, status_code=503)
 
     except Exception as e:
         print(f"❌ Webhook Processing Error: {e}")
@@ -687,6 +846,78 @@ async def telegram_webhook(request: Request):
 
     return {"ok": True}
 
+async def fulfill_payment(payment: dict) -> bool:
+    """
+    Writes the purchase to the ledger (a trigger on user_transactions updates
+    user_balances). Idempotent on reference_id: False if already recorded.
+    """
+    plan = STARS_PRICING.get(payment["plan_id"])
+    if not plan:
+        print(f"❌ Unknown Plan in Payment {payment['reference_id']}: {payment['plan_id']}")
+        return False
+
+    user_id = payment["user_id"]
+    tx_data = {
+        "user_id": user_id,
+        "amount": plan["usd_value"], # Log USD Value (Net Revenue) instead of Stars
+        "transaction_type": "PURCHASE",
+        "description": f"Bought {payment['plan_id'].upper()}",
+
+        "credits_change": plan["credits"],
+        "premium_credits_change": plan["premium_credits"],
+        "reference_id": payment["reference_id"]
+    }
+    # One round trip: the unique reference_id turns a redelivered payment into a no-op
+    res = await db.execute(supabase.table("user_transactions").upsert(tx_data, on_conflict="reference_id", ignore_duplicates=True))
+    if not res.data:
+        print(f"⚠️ Duplicate Payment Ignored: {payment['reference_id']}")
+        return False
+
+    profile_cache.invalidate(user_id)
+    reservations.invalidate(user_id)
+    content_versions.bump(user_id)
+    print(f"✅ Payment Fulfilled: {payment['reference_id']} (User {user_id}, {payment['plan_id']})")
+    return True
+
+async def process_payments() -> int:
+    """
+    Fulfills every queued payment whose backoff has elapsed.
+    Returns the number of entries taken off the queue.
+    """
+    handled = 0
+    # One pass over what is queued now; retries go to the tail for a later pass
+    for _ in range(payment_queue.queued()):
+        claimed = payment_queue.claim()
+        if not claimed:
+            break
+        raw, payment = claimed
+        if payment.get("next_attempt_at", 0) > time.time():
+            payment_queue.defer(raw, payment) # Still backing off
+            continue
+        try:
+            await fulfill_payment(payment)
+        except Exception as e:
+            entry = payment_queue.retry(raw, payment)
+            print(f"⚠️ Payment Fulfillment Retry {entry['attempts']} ({payment['reference_id']}): {e}")
+            continue
+        payment_queue.ack(raw)
+        handled += 1
+    return handled
+
+async def payment_loop(interval: float = 1):
+    if not supabase:
+        print("⚠️ Payment loop disabled: no Supabase client")
+        return
+    recovered = await asyncio.to_thread(payment_queue.recover)
+    if recovered:
+        print(f"♻️ Requeued {recovered} unfinished payment(s)")
+    while True:
+        try:
+            await process_payments()
+        except Exception as e:
+            print(f"⚠️ Payment Loop Error: {e}")
+        await asyncio.sleep(interval)
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
@@ -0,0 +1,157 @@
+import os
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# Minimal in-process metrics rendered in the Prometheus text format.
+# Values are per process; the scraper aggregates across replicas.
+
+REGISTRY = []
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def _label_str(labels: dict) -> str:
+    if not labels:
+        return ""
+    inner = ",".join(f'{k}="{str(v)}"' for k, v in sorted(labels.items()))
+    return "{" + inner + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_label_str(dict(key))} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.series = {} # labels -> {"counts": [...], "sum": float, "count": int}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self.series.items()):
+            labels = dict(key)
+            for bound, count in zip(self.buckets, series["counts"]):
+                lines.append(f"{self.name}_bucket{_label_str({**labels, 'le': bound})} {count}")
+            lines.append(f"{self.name}_bucket{_label_str({**labels, 'le': '+Inf'})} {series['count']}")
+            lines.append(f"{self.name}_sum{_label_str(labels)} {series['sum']}")
+            lines.append(f"{self.name}_count{_label_str(labels)} {series['count']}")
+        return lines
+
+
+def render_all() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Generation pipeline spans ---
+
+SLOW_JOB_SECONDS = float(os.getenv("SLOW_JOB_SECONDS", "30"))
+
+# Diagnostic: peak Python heap growth per stage via tracemalloc.
+# Costs CPU on every allocation, so keep it off outside profiling runs.
+# Peaks are process-wide: read them with one job in flight.
+TRACE_ALLOCATIONS = os.getenv("TRACE_ALLOCATIONS", "false").lower() in ("1", "true", "yes")
+if TRACE_ALLOCATIONS and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+ALLOC_BUCKETS = tuple(2 ** p for p in range(18, 28)) # 256 KiB .. 128 MiB
+
+job_stage_seconds = Histogram("pixelpop_job_stage_seconds", "Duration of each generation pipeline stage.")
+job_duration_seconds = Histogram("pixelpop_job_duration_seconds", "End-to-end generation job duration by final status.")
+job_stage_peak_alloc_bytes = Histogram("pixelpop_job_stage_peak_alloc_bytes", "Peak heap growth per pipeline stage (TRACE_ALLOCATIONS only).", ALLOC_BUCKETS)
+
+
+class StageTimer:
+    """
+    Records per-stage durations for one job:
+
+        timer = StageTimer(job_id)
+        with timer.stage("openai"):
+            ...
+
+    Every span is exported to the stage histogram as it closes (also on
+    failure) and kept on the timer so it can be attached to the job record.
+    With TRACE_ALLOCATIONS the peak heap growth of each stage is recorded too.
+    """
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.started = time.perf_counter()
+        self.spans = {} # stage -> ms (repeated stages accumulate)
+        self.allocs = {} # stage -> peak KiB (TRACE_ALLOCATIONS only)
+
+    @contextmanager
+    def stage(self, name: str):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.spans[name] = round(self.spans.get(name, 0) + elapsed * 1000, 1)
+            job_stage_seconds.observe(elapsed, stage=name)
+            if tracing:
+                peak = max(tracemalloc.get_traced_memory()[1] - baseline, 0)
+                self.allocs[name] = max(self.allocs.get(name, 0), round(peak / 1024, 1))
+                job_stage_peak_alloc_bytes.observe(peak, stage=name)
+
+    def total_ms(self) -> float:
+        return round((time.perf_counter() - self.started) * 1000, 1)
+
+    def as_dict(self) -> dict:
+        timings = {**self.spans, "total": self.total_ms()}
+        if self.allocs:
+            timings["peak_alloc_kb"] = dict(self.allocs)
+        return timings
+
+    def finish(self, status: str) -> dict:
+        """
+        Exports the job total and prints a breakdown for slow jobs.
+        Returns the spans for the job record.
+        """
+        timings = self.as_dict()
+        job_duration_seconds.observe(timings["total"] / 1000, status=status)
+        if timings["total"] >= SLOW_JOB_SECONDS * 1000:
+            breakdown = " | ".join(f"{stage} {ms / 1000:.2f}s" for stage, ms in sorted(self.spans.items(), key=lambda kv: -kv[1]))
+            print(f"🐢 Slow Job {self.job_id} ({status}): {timings['total'] / 1000:.2f}s total | {breakdown}")
+        return timings
@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+import redis
+
+# Successful Telegram payments waiting to be written to the ledger. The
+# webhook only enqueues (one Redis call) and acks; payment_loop fulfills.
+# Entries are moved to a processing list while being fulfilled and only
+# removed once the ledger write is done, so a crash never loses a payment.
+QUEUE_KEY = "payment_queue"
+PROCESSING_KEY = "payment_queue:processing"
+
+RETRY_BASE_SECONDS = float(os.getenv("PAYMENT_RETRY_BASE_SECONDS", "2"))
+RETRY_MAX_SECONDS = float(os.getenv("PAYMENT_RETRY_MAX_SECONDS", "300"))
+
+
+def backoff_seconds(attempts: int) -> float:
+    return min(RETRY_BASE_SECONDS * (2 ** attempts), RETRY_MAX_SECONDS)
+
+
+class PaymentQueue:
+    """
+    Redis lists when REDIS_URL is set (survives restarts, shared by every
+    replica), in-process deque otherwise (dev only: lost on restart).
+    """
+
+    def __init__(self, redis_client=None):
+        self.redis = redis_client
+        self.memory = deque()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        redis_client = None
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url:
+            try:
+                redis_client = redis.from_url(redis_url)
+            except Exception as e:
+                print(f"⚠️ Payment Queue: Redis unavailable ({e}). Payments queued in memory only.")
+        return cls(redis_client)
+
+    def push(self, payment: dict):
+        entry = dict(payment, attempts=payment.get("attempts", 0), next_attempt_at=payment.get("next_attempt_at", 0))
+        if self.redis:
+            self.redis.rpush(QUEUE_KEY, json.dumps(entry))
+            return
+        with self.lock:
+            self.memory.append(entry)
+
+    def claim(self):
+        """
+        Oldest queued payment as (raw, payment), or None. Redis: moved to the
+        processing list, so it is still there if this process dies mid-way.
+        """
+        if self.redis:
+            raw = self.redis.lmove(QUEUE_KEY, PROCESSING_KEY, "LEFT", "RIGHT")
+            return (raw, json.loads(raw)) if raw else None
+        with self.lock:
+            if not self.memory:
+                return None
+            entry = self.memory.popleft()
+            return entry, entry
+
+    def ack(self, raw):
+        if self.redis:
+            self.redis.lrem(PROCESSING_KEY, 1, raw)
+
+    def defer(self, raw, payment: dict):
+        """
+        Back to the tail of the queue (out of processing).
+        """
+        if self.redis:
+            pipe = self.redis.pipeline()
+            pipe.rpush(QUEUE_KEY, json.dumps(payment))
+            pipe.lrem(PROCESSING_KEY, 1, raw)
+            pipe.execute()
+            return
+        with self.lock:
+            self.memory.append(payment)
+
+    def retry(self, raw, payment: dict) -> dict:
+        """
+        Deferred with exponential backoff after a failed attempt.
+        """
+        attempts = payment.get("attempts", 0) + 1
+        entry = dict(payment, attempts=attempts, next_attempt_at=time.time() + backoff_seconds(attempts))
+        self.defer(raw, entry)
+        return entry
+
+    def recover(self) -> int:
+        """
+        Requeues payments left in processing by a crashed process (startup).
+        May also requeue one another replica is fulfilling right now; that is
+        harmless, the ledger insert is idempotent on reference_id.
+        """
+        if not self.redis:
+            return 0
+        count = 0
+        while self.redis.lmove(PROCESSING_KEY, QUEUE_KEY, "LEFT", "RIGHT"):
+            count += 1
+        return count
+
+    def queued(self) -> int:
+        if self.redis:
+            return self.redis.llen(QUEUE_KEY)
+        with self.lock:
+            return len(self.memory)
+
+
+payment_queue = PaymentQueue.from_env()
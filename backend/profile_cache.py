@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+import redis
+from metrics import Counter
+
+# Per-user cache of the /api/user/me payload. Every ledger write for a user
+# (generation billing, purchases) invalidates it; the TTL only bounds staleness
+# if an invalidation is lost. Entries carry the ETag (content version) they
+# were read under: a fill that raced a write is stored under the old tag and
+# is a miss once the version moves, so it is never served under the new one.
+TTL_SECONDS = int(os.getenv("PROFILE_CACHE_TTL_SECONDS", "120"))
+MAX_ENTRIES = int(os.getenv("PROFILE_CACHE_MAX_ENTRIES", "10000"))
+
+NAMESPACE = "profile"
+
+profile_cache_requests = Counter("pixelpop_profile_cache_requests_total", "Profile cache lookups by outcome (hit/miss/invalidate).")
+
+
+class ProfileCache:
+    """
+    Redis-backed when REDIS_URL is set (invalidations reach every instance),
+    LRU dict otherwise.
+    """
+
+    def __init__(self, redis_client=None, ttl: int = TTL_SECONDS, max_entries: int = MAX_ENTRIES):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory = OrderedDict() # user_id -> (expires_at, tag, profile)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        redis_client = None
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url:
+            try:
+                redis_client = redis.from_url(redis_url)
+            except Exception as e:
+                print(f"⚠️ Profile Cache: Redis unavailable ({e}). Using in-process cache.")
+        return cls(redis_client)
+
+    def get(self, user_id: int, tag):
+        """
+        Cached profile if it was stored under `tag`, else None.
+        """
+        profile = None
+        if self.redis:
+            try:
+                raw = self.redis.get(f"{NAMESPACE}:{user_id}")
+                entry = json.loads(raw) if raw else {}
+                if entry.get("tag") == tag:
+                    profile = entry.get("profile")
+            except Exception as e:
+                print(f"⚠️ Profile Cache Lookup Failed: {e}")
+        else:
+            with self.lock:
+                cached = self.memory.get(user_id)
+                if cached and cached[0] > time.time():
+                    self.memory.move_to_end(user_id)
+                    if cached[1] == tag:
+                        profile = dict(cached[2])
+                elif cached:
+                    del self.memory[user_id]
+
+        profile_cache_requests.inc(result="hit" if profile else "miss")
+        return profile
+
+    def put(self, user_id: int, profile: dict, tag):
+        """
+        `tag` is the ETag computed before the profile was read (check_etag).
+        """
+        if self.redis:
+            try:
+                self.redis.set(f"{NAMESPACE}:{user_id}", json.dumps({"tag": tag, "profile": profile}), ex=self.ttl)
+            except Exception as e:
+                print(f"⚠️ Profile Cache Write Failed: {e}")
+            return
+
+        with self.lock:
+            self.memory[user_id] = (time.time() + self.ttl, tag, dict(profile))
+            self.memory.move_to_end(user_id)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """
+        Call after every user_transactions write for the user.
+        """
+        if user_id is None:
+            return
+        profile_cache_requests.inc(result="invalidate")
+        if self.redis:
+            try:
+                self.redis.delete(f"{NAMESPACE}:{user_id}")
+            except Exception as e:
+                print(f"⚠️ Profile Cache Invalidation Failed ({user_id}): {e}")
+        else:
+            with self.lock:
+                self.memory.pop(user_id, None)
+
+
+profile_cache = ProfileCache.from_env()
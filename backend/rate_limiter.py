@@ -0,0 +1,203 @@
+import os
+import time
+import uuid
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+import redis
+
+WINDOW_MS = 60_000
+
+# Atomically: honor cooldown, trim the RPM window and the expired slots,
+# then either take a slot (returns 0) or return how long to wait in ms.
+# Slots carry their own expiry so a crashed worker cannot leak concurrency.
+ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local cooldown = redis.call('PTTL', KEYS[3])
+if cooldown > 0 then return cooldown end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[5]))
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+if redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[2]) then return tonumber(ARGV[6]) end
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    return math.max(tonumber(oldest[2]) + tonumber(ARGV[5]) - now, 1)
+end
+redis.call('ZADD', KEYS[1], now, ARGV[3])
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[4]), ARGV[3])
+redis.call('PEXPIRE', KEYS[1], tonumber(ARGV[5]))
+redis.call('PEXPIRE', KEYS[2], tonumber(ARGV[4]))
+return 0
+"""
+
+# Only ever extends an existing cooldown
+PENALIZE_SCRIPT = """
+local current = redis.call('PTTL', KEYS[1])
+if current < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], '1', 'PX', ARGV[1])
+end
+return 1
+"""
+
+
+def parse_duration(value: str):
+    """
+    Parses OpenAI reset headers: "20ms", "1s", "6m0s", "1h2m3.5s".
+    Returns seconds or None.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    total, number = 0.0, ""
+    i = 0
+    try:
+        while i < len(value):
+            ch = value[i]
+            if ch.isdigit() or ch == ".":
+                number += ch
+                i += 1
+                continue
+            unit = "ms" if value[i:i + 2] == "ms" else ch
+            i += len(unit)
+            total += float(number) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+            number = ""
+        if number:
+            total += float(number) # Bare number means seconds
+    except (KeyError, ValueError):
+        return None
+    return total
+
+
+def retry_after_seconds(headers) -> float:
+    """
+    Extracts the wait from a 429 response.
+    Prefers retry-after-ms, then retry-after (seconds or HTTP date),
+    then the request-bucket reset hint.
+    """
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+            except (TypeError, ValueError):
+                pass
+    return parse_duration(headers.get("x-ratelimit-reset-requests"))
+
+
+class ImageRateLimiter:
+    """
+    Shared limiter for OpenAI image calls: requests-per-minute, max
+    in-flight requests and a cooldown set from 429 responses.
+    Coordinated through Redis when REDIS_URL is set, in-process otherwise.
+    """
+
+    def __init__(self, rpm: int, max_concurrency: int, redis_client=None, namespace: str = "ratelimit:openai:images",
+                 slot_ttl: float = 180, poll_interval: float = 0.25):
+        self.rpm = rpm
+        self.max_concurrency = max_concurrency
+        self.redis = redis_client
+        self.namespace = namespace
+        self.slot_ttl = slot_ttl
+        self.poll_interval = poll_interval
+
+        # In-memory fallback state
+        self.window = deque()
+        self.slots = set()
+        self.cooldown_until = 0.0
+
+        self._acquire_script = None
+        self._penalize_script = None
+        if self.redis:
+            self._acquire_script = self.redis.register_script(ACQUIRE_SCRIPT)
+            self._penalize_script = self.redis.register_script(PENALIZE_SCRIPT)
+
+    @classmethod
+    def from_env(cls):
+        redis_client = None
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url:
+            try:
+                redis_client = redis.from_url(redis_url)
+            except Exception as e:
+                print(f"⚠️ Rate Limiter: Redis unavailable ({e}). Limiting per process only.")
+        return cls(
+            rpm=int(os.getenv("OPENAI_IMAGES_RPM", "50")),
+            max_concurrency=int(os.getenv("OPENAI_IMAGES_MAX_CONCURRENCY", "5")),
+            redis_client=redis_client,
+        )
+
+    @property
+    def keys(self):
+        return [f"{self.namespace}:window", f"{self.namespace}:slots", f"{self.namespace}:cooldown"]
+
+    def _try_acquire(self, token: str) -> float:
+        """
+        Returns 0 if a slot was taken, else seconds to wait before retrying.
+        """
+        if self.redis:
+            wait_ms = self._acquire_script(
+                keys=self.keys,
+                args=[self.rpm, self.max_concurrency, token, int(self.slot_ttl * 1000), WINDOW_MS, int(self.poll_interval * 1000)],
+            )
+            return int(wait_ms) / 1000
+
+        now = time.monotonic()
+        if self.cooldown_until > now:
+            return self.cooldown_until - now
+        while self.window and self.window[0] <= now - WINDOW_MS / 1000:
+            self.window.popleft()
+        if len(self.slots) >= self.max_concurrency:
+            return self.poll_interval
+        if len(self.window) >= self.rpm:
+            return max(self.window[0] + WINDOW_MS / 1000 - now, 0.001)
+        self.window.append(now)
+        self.slots.add(token)
+        return 0
+
+    async def acquire(self) -> str:
+        token = str(uuid.uuid4())
+        waited = 0.0
+        while True:
+            wait = self._try_acquire(token)
+            if wait <= 0:
+                if waited:
+                    print(f"⏳ Rate Limiter: Waited {waited:.1f}s for an image slot")
+                return token
+            waited += wait
+            await asyncio.sleep(wait)
+
+    def release(self, token: str):
+        if self.redis:
+            self.redis.zrem(self.keys[1], token)
+        else:
+            self.slots.discard(token)
+
+    @asynccontextmanager
+    async def slot(self):
+        token = await self.acquire()
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    def penalize(self, seconds: float):
+        """
+        Blocks all callers (every worker, with Redis) for `seconds`.
+        """
+        if not seconds or seconds <= 0:
+            return
+        print(f"🚦 Rate Limiter: Cooling down for {seconds:.1f}s")
+        if self.redis:
+            self._penalize_script(keys=[self.keys[2]], args=[int(seconds * 1000)])
+        else:
+            self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
@@ -0,0 +1,176 @@
+import os
+import re
+import json
+import time
+import hashlib
+from collections import OrderedDict
+import redis
+from metrics import Counter
+
+# Opt-in cache of finished generations for deterministic catalog jobs
+# (text-to-image, no init image). Entries point at the already stored
+# S3 objects; hits are served by copying them to the new job's keys.
+ENABLED = os.getenv("RESULT_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "5000"))
+
+# model_config keys that change the stored output. Everything else
+# (style_id, slug, ...) is metadata and must not split the cache.
+KEY_FIELDS = ("model", "size", "quality", "should_watermark")
+
+# Catalog styles shipped with the frontend: only their prompts are cached,
+# so a user's free-form prompt is never answered with someone else's image.
+CATALOG_DIR = os.getenv("RESULT_CACHE_CATALOG_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "frontend", "src", "content"))
+
+NAMESPACE = "result_cache"
+
+cache_requests = Counter("pixelpop_result_cache_requests_total", "Result cache lookups by outcome (hit/miss/store/evict).")
+
+_catalog = None
+
+
+def normalize_prompt(prompt: str) -> str:
+    # Whitespace only: case changes the output (text rendered in the image)
+    return re.sub(r"\s+", " ", (prompt or "").strip())
+
+
+def load_catalog(content_dir: str = CATALOG_DIR) -> dict:
+    """
+    Catalog identifier (style title, file slug, header CTA) -> normalized prompt,
+    as the frontend sends them in model_config.style_id / slug.
+    """
+    catalog = {}
+    for section in ("styles", "discover"):
+        directory = os.path.join(content_dir, section)
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(directory, name), encoding="utf-8") as f:
+                    item = json.load(f)
+            except Exception as e:
+                print(f"⚠️ Unreadable Catalog Entry {section}/{name}: {e}")
+                continue
+            if item.get("prompt"):
+                for ident in (item.get("title"), name[:-len(".json")]):
+                    if ident:
+                        catalog[ident] = normalize_prompt(item["prompt"])
+    try:
+        with open(os.path.join(content_dir, "header.json"), encoding="utf-8") as f:
+            special = json.load(f).get("specialPrompt")
+        if special:
+            catalog["header-special"] = normalize_prompt(special)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"⚠️ Unreadable Catalog Header: {e}")
+    return catalog
+
+
+def catalog() -> dict:
+    global _catalog
+    if _catalog is None:
+        _catalog = load_catalog()
+        print(f"📚 Result Cache Catalog: {len(_catalog)} identifiers from {CATALOG_DIR}")
+    return _catalog
+
+
+def cache_key(prompt: str, model_config: dict):
+    """
+    Content address of a job, or None if the job is not cacheable:
+    only catalog jobs (text-to-image, a catalog identifier and exactly
+    that entry's prompt) are.
+    """
+    if not ENABLED or model_config.get("init_image"):
+        return None
+    normalized = normalize_prompt(prompt)
+    entries = catalog()
+    if not any(entries.get(ident) == normalized for ident in (model_config.get("style_id"), model_config.get("slug")) if ident):
+        return None
+    material = {
+        "prompt": normalized,
+        "config": {k: model_config.get(k) for k in KEY_FIELDS},
+    }
+    digest = hashlib.sha256(json.dumps(material, sort_keys=True).encode("utf-8")).hexdigest()
+    return digest
+
+
+class ResultCache:
+    """
+    Redis-backed when REDIS_URL is set (shared by all workers), LRU dict otherwise.
+    Redis entries expire by TTL; an index sorted by last use trims the
+    least recently used entries beyond MAX_ENTRIES.
+    """
+
+    def __init__(self, redis_client=None, ttl: int = TTL_SECONDS, max_entries: int = MAX_ENTRIES):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory = OrderedDict() # key -> (expires_at, entry)
+
+    @classmethod
+    def from_env(cls):
+        redis_client = None
+        redis_url = os.getenv("REDIS_URL")
+        if ENABLED and redis_url:
+            try:
+                redis_client = redis.from_url(redis_url)
+            except Exception as e:
+                print(f"⚠️ Result Cache: Redis unavailable ({e}). Using in-process cache.")
+        return cls(redis_client)
+
+    def get(self, key: str):
+        entry = None
+        if self.redis:
+            raw = self.redis.get(f"{NAMESPACE}:{key}")
+            if raw:
+                entry = json.loads(raw)
+                self.redis.zadd(f"{NAMESPACE}:index", {key: time.time()})
+            else:
+                self.redis.zrem(f"{NAMESPACE}:index", key)
+        else:
+            cached = self.memory.get(key)
+            if cached and cached[0] > time.time():
+                self.memory.move_to_end(key)
+                entry = cached[1]
+            elif cached:
+                del self.memory[key]
+
+        cache_requests.inc(result="hit" if entry else "miss")
+        return entry
+
+    def put(self, key: str, entry: dict):
+        cache_requests.inc(result="store")
+        if self.redis:
+            pipe = self.redis.pipeline()
+            pipe.set(f"{NAMESPACE}:{key}", json.dumps(entry), ex=self.ttl)
+            pipe.zadd(f"{NAMESPACE}:index", {key: time.time()})
+            pipe.execute()
+            overflow = self.redis.zcard(f"{NAMESPACE}:index") - self.max_entries
+            if overflow > 0:
+                evicted = self.redis.zpopmin(f"{NAMESPACE}:index", overflow)
+                if evicted:
+                    self.redis.delete(*[f"{NAMESPACE}:{k.decode() if isinstance(k, bytes) else k}" for k, _ in evicted])
+                    cache_requests.inc(len(evicted), result="evict")
+            return
+
+        self.memory[key] = (time.time() + self.ttl, entry)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+            cache_requests.inc(result="evict")
+
+    def invalidate(self, key: str):
+        if self.redis:
+            self.redis.delete(f"{NAMESPACE}:{key}")
+            self.redis.zrem(f"{NAMESPACE}:index", key)
+        else:
+            self.memory.pop(key, None)
+
+
+def hit_rate() -> float:
+    hits = cache_requests.get(result="hit")
+    lookups = hits + cache_requests.get(result="miss")
+    return hits / lookups if lookups else 0.0
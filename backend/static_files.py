@@ -0,0 +1,90 @@
+import os
+import re
+import mimetypes
+from fastapi.responses import FileResponse, Response
+from http_encoding import negotiate
+
+# Frontend build served from memory-resident metadata: the dist tree is
+# scanned once at startup, so a request costs a dict lookup, not stat calls.
+# Precompressed siblings (.br/.gz, see frontend/scripts/precompress.js)
+# are served when the client accepts them.
+INDEX_MAX_AGE_SECONDS = int(os.getenv("STATIC_INDEX_MAX_AGE_SECONDS", "60"))
+OTHER_MAX_AGE_SECONDS = int(os.getenv("STATIC_MAX_AGE_SECONDS", "3600"))
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+# Vite content hash in the file name: assets/index-B4x_9fQe.js
+HASHED_NAME = re.compile(r"-[A-Za-z0-9_-]{8,}\.[A-Za-z0-9]+$")
+
+ENCODED_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+class StaticManifest:
+    def __init__(self, root: str):
+        self.root = root
+        self.files = {} # url path (no leading slash) -> entry
+        self.scan()
+
+    def scan(self):
+        files = {}
+        for dirpath, _, names in os.walk(self.root):
+            names = set(names)
+            for name in names:
+                if name.endswith((".br", ".gz")) and name[:-3] in names:
+                    continue # Served as a variant of the original
+                path = os.path.join(dirpath, name)
+                rel = os.path.relpath(path, self.root).replace(os.sep, "/")
+                stat = os.stat(path)
+                variants = {}
+                for coding, suffix in ENCODED_SUFFIXES.items():
+                    if name + suffix in names:
+                        variants[coding] = (path + suffix, os.stat(path + suffix))
+                files[rel] = {
+                    "path": path,
+                    "stat": stat,
+                    "media_type": mimetypes.guess_type(name)[0] or "application/octet-stream",
+                    "etag": f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+                    "cache_control": self.cache_control(rel),
+                    "variants": variants,
+                }
+        self.files = files
+        precompressed = sum(1 for entry in files.values() if entry["variants"])
+        print(f"🗂️ Static Manifest: {len(files)} files ({precompressed} precompressed) from {self.root}")
+
+    @staticmethod
+    def cache_control(rel: str) -> str:
+        if rel == "index.html":
+            # Short-lived: a deploy must reach clients quickly (hashed assets change names)
+            return f"public, max-age={INDEX_MAX_AGE_SECONDS}, must-revalidate"
+        if rel.startswith("assets/") and HASHED_NAME.search(rel):
+            return IMMUTABLE
+        return f"public, max-age={OTHER_MAX_AGE_SECONDS}"
+
+    def lookup(self, url_path: str):
+        """
+        Entry for a request path: the file itself, index.html for client-side
+        routes, or None for missing assets (a 404 instead of HTML served as JS).
+        """
+        rel = url_path.lstrip("/")
+        entry = self.files.get(rel)
+        if entry:
+            return entry
+        if rel.startswith("assets/") or not self.files.get("index.html"):
+            return None
+        return self.files["index.html"]
+
+    def response(self, entry: dict, accept_encoding: str = "", if_none_match: str = ""):
+        # Precompressed files need no encoder here: br is offered even without the brotli module
+        coding = negotiate(accept_encoding, tuple(c for c in ENCODED_SUFFIXES if c in entry["variants"])) if entry["variants"] and accept_encoding else None
+        etag = entry["etag"] if coding not in entry["variants"] else entry["etag"][:-1] + f'-{coding}"'
+        headers = {"Cache-Control": entry["cache_control"], "ETag": etag}
+        if entry["variants"]:
+            headers["Vary"] = "Accept-Encoding"
+
+        if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+
+        if coding in entry["variants"]:
+            path, stat = entry["variants"][coding]
+            headers["Content-Encoding"] = coding
+            return FileResponse(path, media_type=entry["media_type"], headers=headers, stat_result=stat)
+        return FileResponse(entry["path"], media_type=entry["media_type"], headers=headers, stat_result=entry["stat"])
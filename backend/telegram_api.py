@@ -0,0 +1,56 @@
+import os
+import httpx
+
+# Bot API calls from the event loop through one keep-alive client: the
+# pre-checkout answer has a hard 10 s deadline, so it must not wait for a
+# fresh TLS handshake or block the loop behind image work.
+API_BASE = "https://api.telegram.org"
+API_TIMEOUT_SECONDS = float(os.getenv("TELEGRAM_API_TIMEOUT_SECONDS", "5"))
+
+
+class TelegramAPIError(Exception):
+    pass
+
+
+class BotAPI:
+    def __init__(self, token: str, timeout: float = API_TIMEOUT_SECONDS, transport=None):
+        self.token = token
+        self.timeout = timeout
+        self.transport = transport # httpx transport override (tests)
+        self.client = None
+
+    def http(self) -> httpx.AsyncClient:
+        # Created on first use, inside the running loop
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                base_url=f"{API_BASE}/bot{self.token}/",
+                timeout=self.timeout,
+                limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=120),
+                transport=self.transport,
+            )
+        return self.client
+
+    async def call(self, method: str, **params):
+        if not self.token:
+            raise TelegramAPIError("Bot token not configured")
+        res = await self.http().post(method, json=params)
+        try:
+            body = res.json()
+        except ValueError:
+            res.raise_for_status()
+            raise
+        # Errors come back as {"ok": false, "description": ...} with a 4xx
+        if not body.get("ok"):
+            raise TelegramAPIError(f"{method}: {body.get('description') or res.status_code}")
+        return body.get("result")
+
+    async def answer_pre_checkout(self, query_id: str, ok: bool = True, error_message: str = None):
+        params = {"pre_checkout_query_id": query_id, "ok": ok}
+        if error_message:
+            params["error_message"] = error_message
+        return await self.call("answerPreCheckoutQuery", **params)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
@@ -3,7 +3,10 @@ import os
 import jwt
 import time
 from fastapi.testclient import TestClient
+import main
+import asyncio
 from main import app
+from payment_queue import PaymentQueue
 from unittest.mock import patch, MagicMock, AsyncMock
 
 client = TestClient(app)
@@ -31,10 +34,17 @@ def test_generation_endpoint_unauthorized():
     assert response.status_code == 401
 
 def test_generation_endpoint_success():
+    from credit_reservations import CreditReservations
+    mock_supabase = MagicMock()
+    balance_query = mock_supabase.table.return_value.select.return_value.eq.return_value
+    balance_query.execute.return_value.data = [{"credits": 0, "premium_credits": 1}]
+
     # Mock the Queue/JobManager
-    with patch("main.job_manager") as mock_jm:
+    with patch("main.job_manager") as mock_jm, \
+         patch("main.supabase", mock_supabase), \
+         patch("main.reservations", CreditReservations()):
         # MUST use AsyncMock because it is awaited
-        mock_jm.enqueue_job = AsyncMock(return_value="test-job-id")
+        mock_jm.enqueue_job = AsyncMock(return_value="ignored")
         
         token = create_valid_token()
         headers = {"Authorization": f"Bearer {token}"}
@@ -47,8 +57,23 @@ def test_generation_endpoint_success():
         
         assert response.status_code == 202
         data = response.json()
-        assert data["job_id"] == "test-job-id"
+        # The endpoint picks the id (the credit hold is keyed on it) and hands it to the queue
+        assert data["job_id"] == mock_jm.enqueue_job.await_args.kwargs["job_id"]
         assert data["status"] == "PENDING"
+        mock_supabase.table.assert_called_once_with("user_balances")
+
+        # The only premium credit is held: the next job is refused without another read
+        response = client.post("/api/generation", json=payload, headers=headers)
+        assert response.status_code == 402
+        assert "Premium" in response.json()["detail"]
+        assert mock_jm.enqueue_job.await_count == 1
+        assert balance_query.execute.call_count == 1
+
+        # No basic credits at all
+        response = client.post("/api/generation", json={"prompt": "A cat"}, headers=headers)
+        assert response.status_code == 402
+        assert "Basic" in response.json()["detail"]
+        assert mock_jm.enqueue_job.await_count == 1
 
 
 from util_telegram_signer import generate_test_init_data
@@ -73,3 +98,217 @@ def test_auth_login_real():
         data = response.json()
         assert "access_token" in data
         assert data["user"]["id"] == 555666
+
+def test_generation_stream_relays_partials():
+    pending = {"id": "job-1", "status": "PROCESSING", "partial": {"index": 0, "image": "data:image/webp;base64,AAAA"}}
+    done = dict(pending, status="COMPLETED", result={"image_url": "https://x/y.webp"})
+    with patch("main.job_manager") as mock_jm, patch("main.STREAM_POLL_SECONDS", 0):
+        mock_jm.get_job = AsyncMock(side_effect=[pending, pending, pending, done])
+        headers = {"Authorization": f"Bearer {create_valid_token()}"}
+        response = client.get("/api/generation/job-1/stream", headers=headers)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [block.split("\n")[0] for block in response.text.strip().split("\n\n")]
+    # One partial (not repeated while unchanged), then the status changes
+    assert events == ["event: partial", "event: status", "event: status"]
+    assert '"COMPLETED"' in response.text
+
+def test_health_and_drain_endpoints(monkeypatch):
+    response = client.get("/api/health")
+    assert response.status_code == 200
+    assert response.json()["status"] == "ok"
+
+    # Drain is token protected (and disabled without DRAIN_TOKEN)
+    monkeypatch.delenv("DRAIN_TOKEN", raising=False)
+    assert client.post("/api/worker/drain").status_code == 401
+
+    with patch("worker.drain_state", {"draining": True, "drained": False, "requeued": 0}):
+        response = client.get("/api/health")
+        assert response.status_code == 503
+        assert response.json()["status"] == "draining"
+
+def test_metrics_endpoint():
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "pixelpop_result_cache_requests_total" in response.text
+
+def test_profile_cached_until_ledger_write():
+    from profile_cache import ProfileCache
+    mock_supabase = MagicMock()
+    mock_supabase.rpc.return_value.execute.return_value.data = [
+        {"username": "cat", "first_name": "Cat", "is_premium": False, "credits": 3, "premium_credits": 1, "balance": 0.0}
+    ]
+    headers = {"Authorization": f"Bearer {create_valid_token(777)}"}
+    cache = ProfileCache()
+
+    with patch("main.supabase", mock_supabase), \
+         patch("main.profile_cache", cache):
+        for _ in range(2):
+            response = client.get("/api/user/me", headers=headers)
+            assert response.status_code == 200
+            assert response.json()["credits"] == 3
+        # One combined query, then served from the cache
+        mock_supabase.rpc.assert_called_once_with("get_user_profile", {"p_user_id": 777})
+        mock_supabase.table.assert_not_called()
+
+        # A purchase writes the ledger and drops the cached profile
+        mock_supabase.table.return_value.upsert.return_value.execute.return_value.data = [{"id": 1}]
+        update = {"message": {"message_id": 1, "successful_payment": {"invoice_payload": "777:starter"}}}
+        with patch("main.payment_queue", PaymentQueue()):
+            assert client.post("/api/telegram/webhook", json=update).status_code == 200
+            assert asyncio.run(main.process_payments()) == 1
+        assert cache.get(777, None) is None
+
+        client.get("/api/user/me", headers=headers)
+        assert mock_supabase.rpc.call_count == 2
+
+def test_profile_fill_racing_a_write_is_not_served_under_the_new_etag():
+    from profile_cache import ProfileCache
+    from content_version import ContentVersions
+    cache = ProfileCache()
+    versions = ContentVersions()
+    rows = iter([{"credits": 3}, {"credits": 2}])
+
+    def rpc_execute():
+        row = next(rows)
+        if row["credits"] == 3:
+            # Billing commits while the pre-billing row is in flight (record_completion)
+            cache.invalidate(778)
+            versions.bump(778)
+        return MagicMock(data=[row])
+
+    mock_supabase = MagicMock()
+    mock_supabase.rpc.return_value.execute.side_effect = rpc_execute
+    headers = {"Authorization": f"Bearer {create_valid_token(778)}"}
+
+    with patch("main.supabase", mock_supabase), \
+         patch("main.profile_cache", cache), \
+         patch("main.content_versions", versions):
+        first = client.get("/api/user/me", headers=headers)
+        assert first.json()["credits"] == 3
+
+        # The old row was stored under the old tag: a miss, not a stale hit
+        second = client.get("/api/user/me", headers=headers)
+        assert second.json()["credits"] == 2
+        assert second.headers["etag"] != first.headers["etag"]
+        assert mock_supabase.rpc.call_count == 2
+
+        # The fresh row is cached, and its tag revalidates to 304
+        third = client.get("/api/user/me", headers={**headers, "If-None-Match": second.headers["etag"]})
+        assert third.status_code == 304
+        assert client.get("/api/user/me", headers=headers).json()["credits"] == 2
+        assert mock_supabase.rpc.call_count == 2
+
+def test_gallery_keyset_cursor():
+    from base64 import b64encode
+    mock_supabase = MagicMock()
+    query = mock_supabase.table.return_value.select.return_value.eq.return_value.eq.return_value.eq.return_value \
+        .not_.is_.return_value.order.return_value.order.return_value.limit.return_value
+    rows = [{"id": f"g{i}", "image_url": f"https://img/{i}.png", "created_at": "2025-12-30T10:00:00+00:00"} for i in (3, 2, 1)]
+    query.execute.return_value.data = rows
+    headers = {"Authorization": f"Bearer {create_valid_token()}"}
+
+    with patch("main.supabase", mock_supabase):
+        page = client.get("/api/gallery?limit=2", headers=headers).json()
+        assert [item["id"] for item in page["items"]] == ["g3", "g2"]
+        assert page["has_more"]
+        mock_supabase.table.return_value.select.assert_called_once_with("id, image_url, variants, prompt, cost, created_at")
+
+        # Equal timestamps: the id breaks the tie
+        query.lte.return_value.or_.return_value.execute.return_value.data = rows[2:]
+        client.get(f"/api/gallery?limit=2&cursor={page['next_cursor']}", headers=headers)
+        # The lte is the index range start; the or_ alone would scan from the newest row
+        query.lte.assert_called_once_with("created_at", "2025-12-30T10:00:00+00:00")
+        query.lte.return_value.or_.assert_called_once_with('created_at.lt."2025-12-30T10:00:00+00:00",and(created_at.eq."2025-12-30T10:00:00+00:00",id.lt."g2")')
+
+        # Cursors issued before the tie-breaker still work
+        query.lt.return_value.execute.return_value.data = []
+        legacy_cursor = b64encode(b"2025-12-30T10:00:00+00:00").decode()
+        assert client.get("/api/gallery", params={"cursor": legacy_cursor}, headers=headers).status_code == 200
+        query.lt.assert_called_once_with("created_at", "2025-12-30T10:00:00+00:00")
+
+def test_results_paginated_and_streamed():
+    mock_supabase = MagicMock()
+    query = mock_supabase.table.return_value.select.return_value.eq.return_value.eq.return_value.eq.return_value \
+        .not_.is_.return_value.order.return_value.order.return_value.limit.return_value
+    rows = [{"id": f"g{i}", "image_url": f"https://img/{i}.png", "created_at": f"2025-12-30T10:00:0{i}+00:00"} for i in (3, 2, 1)]
+    query.execute.return_value.data = rows
+    headers = {"Authorization": f"Bearer {create_valid_token()}"}
+
+    with patch("main.supabase", mock_supabase):
+        response = client.get("/api/results?limit=2", headers=headers)
+        assert [item["id"] for item in response.json()] == ["g3", "g2"]
+        assert response.headers["X-Next-Cursor"]
+        # Status, archive and image filters run in SQL, with a bounded page
+        query_root = mock_supabase.table.return_value.select
+        query_root.assert_called_once_with("id, image_url, variants, prompt, cost, created_at")
+        query_root.return_value.eq.return_value.eq.assert_called_once_with("status", "COMPLETED")
+        mock_supabase.table.return_value.select.return_value.eq.return_value.eq.return_value.eq.return_value \
+            .not_.is_.return_value.order.return_value.order.return_value.limit.assert_called_with(3)
+
+        # Export: one JSON array across pages
+        exported = client.get("/api/results?stream=true", headers=headers)
+        assert exported.headers["content-type"].startswith("application/json")
+        assert [item["id"] for item in exported.json()] == ["g3", "g2", "g1"]
+
+def test_gallery_etag_revalidation():
+    from content_version import ContentVersions
+    mock_supabase = MagicMock()
+    query = mock_supabase.table.return_value.select.return_value.eq.return_value.eq.return_value.eq.return_value \
+        .not_.is_.return_value.order.return_value.order.return_value.limit.return_value
+    query.execute.return_value.data = [{"id": "g1", "image_url": "https://img/1.png", "created_at": "2025-12-30T10:00:00+00:00"}]
+    versions = ContentVersions()
+    headers = {"Authorization": f"Bearer {create_valid_token(321)}"}
+
+    with patch("main.supabase", mock_supabase), patch("main.content_versions", versions):
+        first = client.get("/api/gallery?limit=20", headers=headers)
+        tag = first.headers["ETag"]
+        assert first.headers["Cache-Control"] == "private, no-cache"
+
+        again = client.get("/api/gallery?limit=20", headers={**headers, "If-None-Match": tag})
+        assert again.status_code == 304
+        assert query.execute.call_count == 1 # Answered without the database
+
+        # Other pages have their own validators
+        assert client.get("/api/gallery?limit=10", headers={**headers, "If-None-Match": tag}).status_code == 200
+
+        # An archive bumps the version: the old tag no longer matches
+        assert client.delete("/api/generation/g1", headers=headers).status_code == 200
+        refreshed = client.get("/api/gallery?limit=20", headers={**headers, "If-None-Match": tag})
+        assert refreshed.status_code == 200
+        assert refreshed.headers["ETag"] != tag
+
+def test_payment_webhook_acks_before_fulfillment():
+    mock_supabase = MagicMock()
+    queue = PaymentQueue()
+    update = {"message": {"message_id": 42, "successful_payment": {"invoice_payload": "555:creator"}}}
+
+    with patch("main.supabase", mock_supabase), \
+         patch("main.payment_queue", queue), \
+         patch.object(main.bot_api, "answer_pre_checkout", new_callable=AsyncMock, return_value=True) as mock_answer:
+        # Pre-checkout is answered through the shared Bot API client
+        assert client.post("/api/telegram/webhook", json={"pre_checkout_query": {"id": "pcq-1"}}).status_code == 200
+        mock_answer.assert_awaited_once_with("pcq-1", ok=True)
+
+        # Acked without touching the database; the ledger write is queued
+        assert client.post("/api/telegram/webhook", json=update).json() == {"ok": True}
+        mock_supabase.table.assert_not_called()
+        assert queue.queued() == 1
+
+        # Database down: kept with a backoff instead of being dropped
+        mock_supabase.table.return_value.upsert.return_value.execute.side_effect = RuntimeError("db down")
+        assert asyncio.run(main.process_payments()) == 0
+        assert queue.queued() == 1
+        assert asyncio.run(main.process_payments()) == 0 # Not due yet
+        assert mock_supabase.table.return_value.upsert.return_value.execute.call_count == 1
+
+        queue.memory[0]["next_attempt_at"] = 0
+        mock_supabase.table.return_value.upsert.return_value.execute.side_effect = None
+        mock_supabase.table.return_value.upsert.return_value.execute.return_value.data = [{"id": 9}]
+        assert asyncio.run(main.process_payments()) == 1
+        assert queue.queued() == 0
+        tx_data = mock_supabase.table.return_value.upsert.call_args
+        assert tx_data.args[0]["reference_id"] == "pay_42"
+        assert tx_data.args[0]["credits_change"] == 15
+        assert tx_data.kwargs == {"on_conflict": "reference_id", "ignore_duplicates": True}
@@ -40,3 +40,70 @@ def test_telegram_real_validation():
     
     assert user["id"] == 999888
     assert user["first_name"] == "RealTest"
+
+def test_jwt_verification_is_cached_until_exp(capsys, monkeypatch):
+    import jwt
+    import time
+    import auth
+    auth.token_cache.clear()
+    secret = "test-secret"
+    token = create_jwt_token(42, secret)
+
+    decode_calls = []
+    real_decode = jwt.decode
+    monkeypatch.setattr(auth.jwt, "decode", lambda *a, **k: decode_calls.append(1) or real_decode(*a, **k))
+
+    for _ in range(3):
+        assert verify_jwt_token(f"Bearer {token}", secret) == 42
+    assert len(decode_calls) == 1 # Later polls hit the cache
+
+    # A different secret never reuses the entry
+    with pytest.raises(HTTPException):
+        verify_jwt_token(f"Bearer {token}", "rotated-secret")
+
+    # Entries die at the token's exp (PyJWT then rejects it with its own clock)
+    decode_calls.clear()
+    now = time.time()
+    monkeypatch.setattr(auth.time, "time", lambda: now + 8 * 24 * 3600)
+    verify_jwt_token(f"Bearer {token}", secret)
+    assert len(decode_calls) == 1
+
+    # Tokens and headers never reach stdout
+    assert token[:10] not in capsys.readouterr().out
+
+def test_token_cache_is_bounded():
+    import time
+    from auth import VerifiedTokenCache
+    cache = VerifiedTokenCache(max_entries=2)
+    far = time.time() + 3600
+    for key in ("a", "b", "c"):
+        cache.put(key, 1, far)
+    assert cache.get("a") is None # Least recently used went first
+    assert cache.get("c") == 1
+
+def test_telegram_validation_is_cached(monkeypatch):
+    import auth
+    auth.init_data_cache.clear()
+    init_data = generate_test_init_data(TEST_BOT_TOKEN, {"id": 555, "first_name": "Cached"})
+
+    assert validate_telegram_data(init_data, TEST_BOT_TOKEN)["id"] == 555
+    # Repeat login with the same initData: no parsing or HMAC work
+    monkeypatch.setattr(auth, "parse_qsl", lambda *_: pytest.fail("initData re-parsed"))
+    user = validate_telegram_data(init_data, TEST_BOT_TOKEN)
+    assert user == {"id": 555, "first_name": "Cached"}
+
+    # Never served for another bot token
+    monkeypatch.undo()
+    with pytest.raises(HTTPException) as exc:
+        validate_telegram_data(init_data, "123:other-bot")
+    assert exc.value.status_code == 403
+
+def test_telegram_auth_date_freshness(monkeypatch):
+    import auth
+    auth.init_data_cache.clear()
+    monkeypatch.setattr(auth, "TELEGRAM_AUTH_MAX_AGE_SECONDS", 3600)
+    # The test signer uses a fixed auth_date from 2023
+    stale = generate_test_init_data(TEST_BOT_TOKEN, {"id": 777, "first_name": "Stale"})
+    with pytest.raises(HTTPException) as exc:
+        validate_telegram_data(stale, TEST_BOT_TOKEN)
+    assert exc.value.status_code == 401
@@ -0,0 +1,127 @@
+import pytest
+from unittest.mock import MagicMock, AsyncMock, patch
+from fastapi.testclient import TestClient
+from credit_reservations import CreditReservations
+
+def test_one_credit_admits_one_job():
+    reservations = CreditReservations()
+    assert reservations.reserve(1, "job-0", "credits") is None # Balance not loaded yet
+    reservations.prime(1, {"credits": 1, "premium_credits": 0}, 0)
+
+    admitted = [reservations.reserve(1, f"job-{i}", "credits") for i in range(10)]
+    assert admitted.count(True) == 1
+    assert reservations.reserve(1, "job-0", "credits") # Re-reserving the same job is idempotent
+    assert not reservations.reserve(1, "job-x", "premium_credits")
+
+def test_settle_spends_and_release_returns():
+    reservations = CreditReservations()
+    reservations.prime(1, {"credits": 2}, 0)
+    assert reservations.reserve(1, "a", "credits")
+    assert reservations.reserve(1, "b", "credits")
+    assert not reservations.reserve(1, "c", "credits")
+
+    reservations.release({"id": "a", "user_id": 1})
+    reservations.settle({"id": "b", "user_id": 1})
+    assert reservations.balances[1]["credits"] == 1
+    assert reservations.reserve(1, "c", "credits") # The released credit is available again
+    reservations.settle({"id": "b", "user_id": 1}) # Settling twice is a no-op
+    assert reservations.balances[1]["credits"] == 1
+
+def test_reconcile_overwrites_cached_balances():
+    reservations = CreditReservations()
+    reservations.prime(1, {"credits": 5}, 0)
+    reservations.prime(1, {"credits": 9}, 0) # Cached value wins without overwrite
+    assert reservations.balances[1]["credits"] == 5
+
+    client = MagicMock()
+    client.table.return_value.select.return_value.in_.return_value.execute.return_value.data = [
+        {"user_id": 1, "credits": 3, "premium_credits": 2}
+    ]
+    assert reservations.reconcile(client) == 1
+    client.table.return_value.select.return_value.in_.assert_called_once_with("user_id", [1])
+    assert reservations.balances[1]["credits"] == 3
+    assert reservations.balances[1]["premium_credits"] == 2
+
+def test_leaked_hold_expires_while_user_stays_active():
+    reservations = CreditReservations(hold_ttl=60)
+    reservations.prime(1, {"credits": 1}, 0)
+    assert reservations.reserve(1, "lost-job", "credits") # Job never settles nor releases
+    assert not reservations.reserve(1, "next", "credits")
+
+    # New holds by the same user do not extend the lost one
+    field, deadline = reservations.holds[1]["lost-job"]
+    reservations.holds[1]["lost-job"] = (field, deadline - 61)
+    assert reservations.reserve(1, "next", "credits")
+    assert "lost-job" not in reservations.holds[1]
+
+def test_reconcile_skips_balances_raced_by_a_settle():
+    reservations = CreditReservations()
+    reservations.prime(1, {"credits": 2}, 0)
+    job = {"id": "job-1", "user_id": 1}
+    assert reservations.reserve(1, job["id"], "credits")
+    client = MagicMock()
+    select = client.table.return_value.select.return_value.in_.return_value.execute
+
+    # Read before the debit commits, settle lands before the write: not 1 too high
+    def read_then_settle():
+        reservations.begin_settle(job)
+        reservations.settle(job)
+        return MagicMock(data=[{"user_id": 1, "credits": 2, "premium_credits": 0}])
+    select.side_effect = read_then_settle
+    reservations.reconcile(client)
+    assert reservations.balances[1]["credits"] == 1
+
+    # Debit committed and read, settle still pending: not 1 too low either
+    assert reservations.reserve(1, "job-2", "credits")
+    reservations.begin_settle({"id": "job-2", "user_id": 1})
+    select.side_effect = None
+    select.return_value.data = [{"user_id": 1, "credits": 0, "premium_credits": 0}]
+    reservations.reconcile(client)
+    reservations.settle({"id": "job-2", "user_id": 1})
+    assert reservations.balances[1]["credits"] == 0
+
+    # Quiet again: the next run applies the table
+    select.return_value.data = [{"user_id": 1, "credits": 5, "premium_credits": 0}]
+    reservations.reconcile(client)
+    assert reservations.balances[1]["credits"] == 5
+
+def test_enqueue_reads_balance_once_and_blocks_overspend():
+    import main
+    from test_api import create_valid_token
+    client = TestClient(main.app)
+    mock_supabase = MagicMock()
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value.data = [
+        {"credits": 1, "premium_credits": 0}
+    ]
+    reservations = CreditReservations()
+    headers = {"Authorization": f"Bearer {create_valid_token(55)}"}
+
+    with patch("main.supabase", mock_supabase), \
+         patch("main.reservations", reservations), \
+         patch("main.job_manager") as mock_jm:
+        mock_jm.enqueue_job = AsyncMock(return_value="ignored")
+        first = client.post("/api/generation", json={"prompt": "A cat"}, headers=headers)
+        second = client.post("/api/generation", json={"prompt": "A cat"}, headers=headers)
+
+    assert first.status_code == 202
+    assert second.status_code == 402
+    mock_supabase.table.assert_called_once_with("user_balances") # Second request never hit the DB
+    job_id = first.json()["job_id"]
+    assert mock_jm.enqueue_job.call_args.kwargs["job_id"] == job_id
+    assert list(reservations.holds[55]) == [job_id]
+    assert reservations.holds[55][job_id][0] == "credits"
+
+@pytest.mark.asyncio
+async def test_failed_job_releases_its_hold():
+    from worker import process_job
+    reservations = CreditReservations()
+    reservations.prime(7, {"credits": 1}, 0)
+    job = {"id": "job-fail", "user_id": 7, "prompt": "A cat", "model_config": {}, "status": "PENDING"}
+    assert reservations.reserve(7, job["id"], "credits")
+
+    with patch("worker.reservations", reservations), \
+         patch("worker.generate_with_retry", new_callable=AsyncMock, side_effect=RuntimeError("boom")):
+        await process_job(AsyncMock(), job)
+
+    assert reservations.holds[7] == {}
+    assert reservations.balances[7]["credits"] == 1
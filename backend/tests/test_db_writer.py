@@ -0,0 +1,111 @@
+import pytest
+import asyncio
+from unittest.mock import MagicMock
+from db_writer import StatusWriteBuffer
+
+def upserted_batches(client):
+    return [c[0][0] for c in client.table.return_value.upsert.call_args_list]
+
+@pytest.mark.asyncio
+async def test_coalesces_per_job_and_batches():
+    client = MagicMock()
+    buffer = StatusWriteBuffer(lambda: client, interval=0.01)
+
+    buffer.enqueue({"id": "a", "status": "PROCESSING", "user_id": 1})
+    buffer.enqueue({"id": "b", "status": "PROCESSING", "user_id": 2})
+    buffer.enqueue({"id": "a", "status": "COMPLETED", "user_id": 1})
+    await asyncio.wait_for(buffer.task, timeout=5) # Flusher exits once the buffer is drained
+
+    batches = upserted_batches(client)
+    assert len(batches) == 1 # One multi-row upsert
+    rows = {r["id"]: r for r in batches[0]}
+    assert rows["a"]["status"] == "COMPLETED"
+    assert rows["b"]["status"] == "PROCESSING"
+
+@pytest.mark.asyncio
+async def test_groups_by_column_set_and_flushes_on_close():
+    client = MagicMock()
+    buffer = StatusWriteBuffer(lambda: client, interval=60)
+
+    buffer.enqueue({"id": "a", "status": "FAILED"})
+    buffer.enqueue({"id": "b", "status": "COMPLETED", "image_url": "https://x"})
+    await buffer.close() # Must not wait for the interval
+
+    batches = upserted_batches(client)
+    assert sorted(len(b) for b in batches) == [1, 1]
+    assert not buffer.pending
+
+@pytest.mark.asyncio
+async def test_failed_flush_requeues_without_clobbering_newer_rows():
+    client = MagicMock()
+    client.table.return_value.upsert.return_value.execute.side_effect = [Exception("PostgREST down"), MagicMock()]
+    buffer = StatusWriteBuffer(lambda: client, interval=60)
+
+    buffer.enqueue({"id": "a", "status": "PROCESSING"})
+    await buffer.flush()
+    assert buffer.pending["a"]["status"] == "PROCESSING"
+
+    buffer.enqueue({"id": "a", "status": "COMPLETED"})
+    await buffer.flush()
+    assert upserted_batches(client)[-1] == [{"id": "a", "status": "COMPLETED"}]
+
+@pytest.mark.asyncio
+async def test_rejected_row_is_isolated_then_dropped():
+    from postgrest.exceptions import APIError
+    client = MagicMock()
+    written = []
+
+    def upsert(rows):
+        query = MagicMock()
+        if any(r["id"] == "bad" for r in rows):
+            query.execute.side_effect = APIError({"code": "PGRST204", "message": "Could not find the 'stage_timings' column"})
+        else:
+            query.execute.side_effect = lambda: written.extend(r["id"] for r in rows)
+        return query
+    client.table.return_value.upsert.side_effect = upsert
+    buffer = StatusWriteBuffer(lambda: client, interval=60, max_attempts=3)
+
+    for row_id in ("a", "bad", "b"):
+        buffer.enqueue({"id": row_id, "status": "COMPLETED"})
+    await buffer.flush()
+    # The good rows of the chunk are written row by row; only the bad one waits
+    assert sorted(written) == ["a", "b"]
+    assert list(buffer.pending) == ["bad"]
+
+    await buffer.flush()
+    await buffer.flush()
+    assert not buffer.pending # Dropped after 3 rejections, not retried forever
+    assert not buffer.attempts
+
+@pytest.mark.asyncio
+async def test_outage_requeues_without_dropping():
+    client = MagicMock()
+    client.table.return_value.upsert.return_value.execute.side_effect = TimeoutError("down")
+    buffer = StatusWriteBuffer(lambda: client, interval=60, max_attempts=2)
+
+    buffer.enqueue({"id": "a", "status": "PROCESSING"})
+    buffer.enqueue({"id": "b", "status": "PROCESSING"})
+    for _ in range(5):
+        await buffer.flush()
+    assert sorted(buffer.pending) == ["a", "b"]
+    assert client.table.return_value.upsert.call_count == 5 # No row-by-row probing during an outage
+
+@pytest.mark.asyncio
+async def test_db_calls_time_out_without_blocking_the_loop(monkeypatch):
+    import time
+    import db
+    from concurrent.futures import ThreadPoolExecutor
+    monkeypatch.setattr(db, "executor", ThreadPoolExecutor(max_workers=1))
+
+    ticks = 0
+    async def heartbeat():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    beat = asyncio.create_task(heartbeat())
+    with pytest.raises(TimeoutError):
+        await db.run(time.sleep, 0.5, timeout=0.1)
+    beat.cancel()
+    assert ticks >= 5 # The loop kept serving while the call was stuck
@@ -0,0 +1,64 @@
+import gzip
+import json
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse, Response
+from fastapi.testclient import TestClient
+from http_encoding import FastJSONResponse, CompressionMiddleware, negotiate, strip_coding_suffix
+
+ITEMS = [{"id": i, "prompt": "A cute cat " * 5, "src": f"https://bucket/{i}.png"} for i in range(50)]
+
+app = FastAPI(default_response_class=FastJSONResponse)
+app.add_middleware(CompressionMiddleware)
+
+@app.get("/big")
+async def big():
+    return FastJSONResponse(ITEMS, headers={"ETag": '"v1"'})
+
+@app.get("/small")
+async def small():
+    return {"ok": True}
+
+@app.get("/events")
+async def events():
+    return StreamingResponse(iter(["event: status\ndata: {}\n\n"] * 100), media_type="text/event-stream")
+
+@app.get("/export")
+async def export():
+    return StreamingResponse((json.dumps(item) for item in ITEMS), media_type="application/json")
+
+@app.get("/image")
+async def image():
+    return Response(b"\x89PNG" + b"\0" * 4096, media_type="image/png")
+
+client = TestClient(app)
+
+def test_negotiate():
+    assert negotiate("gzip, deflate") == "gzip"
+    assert negotiate("gzip;q=0, identity") is None
+    assert negotiate("identity") is None
+
+def test_large_json_is_gzipped_with_marked_etag():
+    response = client.get("/big", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.headers["etag"] == '"v1-gzip"'
+    assert strip_coding_suffix(response.headers["etag"]) == '"v1"'
+    assert int(response.headers["content-length"]) < len(json.dumps(ITEMS)) / 4
+    assert response.json() == ITEMS # httpx decodes the body
+
+def test_small_and_binary_bodies_pass_through():
+    for path in ("/small", "/image"):
+        response = client.get(path, headers={"Accept-Encoding": "gzip"})
+        assert "content-encoding" not in response.headers
+    assert "content-encoding" not in client.get("/big", headers={"Accept-Encoding": "identity"}).headers
+
+def test_streams_compressed_incrementally_but_not_sse():
+    exported = client.get("/export", headers={"Accept-Encoding": "gzip"})
+    assert exported.headers["content-encoding"] == "gzip"
+    assert "content-length" not in exported.headers
+    sse = client.get("/events", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in sse.headers
+
+def test_fast_json_matches_stdlib():
+    body = FastJSONResponse({"a": [1, 2.5, None, "ü"], 3: True}).body
+    assert json.loads(body) == {"a": [1, 2.5, None, "ü"], "3": True}
@@ -0,0 +1,79 @@
+import pytest
+from unittest.mock import MagicMock, patch
+from fastapi.testclient import TestClient
+from known_users import KnownUsers
+from auth import get_or_create_user
+from util_telegram_signer import generate_test_init_data
+
+TEST_BOT_TOKEN = "7751667220:AAEqF_a9T2AZ0TlUqo1LnCiYXLl4yLvEhXU"
+
+def test_ensure_user_is_a_single_rpc():
+    client = MagicMock()
+    client.rpc.return_value.execute.return_value.data = True
+
+    get_or_create_user({"id": 42, "first_name": "New"}, client)
+
+    client.rpc.assert_called_once()
+    name, params = client.rpc.call_args[0]
+    assert name == "ensure_user"
+    assert params["p_id"] == 42
+    client.table.assert_not_called() # No count query, no separate gift insert
+
+def test_warm_load_pages_by_id():
+    client = MagicMock()
+    query = client.table.return_value.select.return_value.order.return_value.limit.return_value
+    query.execute.return_value.data = [{"id": 9}, {"id": 7}]
+    query.lt.return_value.execute.return_value.data = []
+
+    known = KnownUsers()
+    assert known.warm_load(client) == 2
+    query.lt.assert_called_once_with("id", 7) # Keyset, not offset
+    assert known.contains(9) and known.contains(7)
+    assert not known.contains(8)
+
+def test_login_skips_db_for_known_users():
+    import main
+    client = TestClient(main.app)
+    mock_supabase = MagicMock()
+    mock_supabase.rpc.return_value.execute.return_value.data = True
+    init_data = generate_test_init_data(TEST_BOT_TOKEN, {"id": 4242, "first_name": "Returning"})
+
+    with patch("main.BOT_TOKEN", TEST_BOT_TOKEN), \
+         patch("main.supabase", mock_supabase), \
+         patch("main.known_users", KnownUsers()):
+        for _ in range(3):
+            assert client.post("/api/auth/login", json={"initData": init_data}).status_code == 200
+
+    # Only the first login touched the database
+    assert mock_supabase.rpc.call_count == 1
+    mock_supabase.table.assert_not_called()
+
+def test_deleted_user_is_recreated_on_next_login():
+    import main
+    from credit_reservations import CreditReservations
+    from test_api import create_valid_token
+    client = TestClient(main.app)
+    mock_supabase = MagicMock()
+    mock_supabase.rpc.return_value.execute.return_value.data = True
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value.data = [] # Row deleted
+    init_data = generate_test_init_data(TEST_BOT_TOKEN, {"id": 4343, "first_name": "Deleted"})
+    known = KnownUsers()
+    known.add(4343)
+
+    with patch("main.BOT_TOKEN", TEST_BOT_TOKEN), \
+         patch("main.supabase", mock_supabase), \
+         patch("main.reservations", CreditReservations()), \
+         patch("main.known_users", known):
+        headers = {"Authorization": f"Bearer {create_valid_token(4343)}"}
+        assert client.post("/api/generation", json={"prompt": "A cat"}, headers=headers).status_code == 403
+        assert not known.contains(4343)
+        assert client.post("/api/auth/login", json={"initData": init_data}).status_code == 200
+
+    mock_supabase.rpc.assert_called_once() # ensure_user ran again
+    assert known.contains(4343)
+
+def test_remove_forgets_ids():
+    known = KnownUsers()
+    known.add(1, 2)
+    known.remove(1)
+    assert not known.contains(1) and known.contains(2)
@@ -24,3 +24,16 @@ async def test_memory_queue_enqueue_dequeue():
     await manager.update_job(job_id, {"status": "PROCESSING"})
     updated = await manager.get_job(job_id)
     assert updated["status"] == "PROCESSING"
+
+@pytest.mark.asyncio
+async def test_requeue_job_resets_status():
+    manager = JobManager()
+    manager.redis = None
+
+    job_id = await manager.enqueue_job("test prompt", {}, 123)
+    job = await manager.pop_job()
+    await manager.update_job(job_id, {"status": "PROCESSING"})
+
+    await manager.requeue_job(job)
+    assert (await manager.get_job(job_id))["status"] == "PENDING"
+    assert (await manager.pop_job())["id"] == job_id
@@ -0,0 +1,47 @@
+import time
+import pytest
+import asyncio
+from rate_limiter import ImageRateLimiter, parse_duration, retry_after_seconds
+
+@pytest.mark.asyncio
+async def test_concurrency_limit_in_memory():
+    limiter = ImageRateLimiter(rpm=100, max_concurrency=2, poll_interval=0.01)
+    in_flight = 0
+    peak = 0
+
+    async def call():
+        nonlocal in_flight, peak
+        async with limiter.slot():
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.02)
+            in_flight -= 1
+
+    await asyncio.gather(*(call() for _ in range(6)))
+    assert peak == 2
+    assert not limiter.slots
+
+@pytest.mark.asyncio
+async def test_rpm_limit_in_memory():
+    limiter = ImageRateLimiter(rpm=3, max_concurrency=10)
+    for _ in range(3):
+        limiter.release(await limiter.acquire())
+    # Window is full: the next call must wait for the oldest entry to age out
+    assert limiter._try_acquire("probe") > 50
+
+@pytest.mark.asyncio
+async def test_penalize_blocks_callers():
+    limiter = ImageRateLimiter(rpm=100, max_concurrency=10)
+    limiter.penalize(0.1)
+    started = time.monotonic()
+    limiter.release(await limiter.acquire())
+    assert time.monotonic() - started >= 0.09
+
+def test_retry_after_parsing():
+    assert retry_after_seconds({"retry-after-ms": "1500"}) == 1.5
+    assert retry_after_seconds({"retry-after": "7"}) == 7
+    assert retry_after_seconds({"x-ratelimit-reset-requests": "6m0s"}) == 360
+    assert retry_after_seconds({}) is None
+    assert parse_duration("20ms") == pytest.approx(0.02)
+    assert parse_duration("1m30.5s") == pytest.approx(90.5)
+    assert parse_duration("bogus") is None
@@ -0,0 +1,29 @@
+import os
+import sys
+import json
+import subprocess
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules an API-only replica must not pay for at startup
+HEAVY_MODULES = ["worker", "openai", "boto3", "botocore", "telegram", "PIL", "requests"]
+
+def imported_modules(role: str) -> set:
+    # Fresh interpreter: this test process has already imported everything
+    code = "import sys, json, main; print(json.dumps(sorted(sys.modules)))"
+    env = {**os.environ, "APP_ROLE": role}
+    env.setdefault("JWT_SECRET", "test-secret")
+    proc = subprocess.run([sys.executable, "-c", code], cwd=BACKEND_DIR, env=env, capture_output=True, text=True, timeout=60)
+    assert proc.returncode == 0, proc.stderr[-2000:]
+    return set(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+def test_api_role_skips_worker_dependencies():
+    modules = imported_modules("api")
+    assert "fastapi" in modules
+    assert sorted(m for m in HEAVY_MODULES if m in modules) == []
+
+def test_worker_clients_built_on_first_use():
+    modules = imported_modules("all")
+    assert "worker" in modules
+    assert "boto3" not in modules # S3 client is created by the first upload
+    assert "telegram" not in modules
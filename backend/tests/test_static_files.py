@@ -0,0 +1,41 @@
+import gzip
+from static_files import StaticManifest, IMMUTABLE
+
+def build_dist(tmp_path):
+    (tmp_path / "assets").mkdir()
+    (tmp_path / "index.html").write_text("<html>app</html>")
+    js = b"console.log('pixelpop');" * 100
+    (tmp_path / "assets" / "index-B4x_9fQe.js").write_bytes(js)
+    (tmp_path / "assets" / "index-B4x_9fQe.js.gz").write_bytes(gzip.compress(js))
+    (tmp_path / "assets" / "index-B4x_9fQe.js.br").write_bytes(b"br-bytes")
+    (tmp_path / "favicon.ico").write_bytes(b"\0" * 10)
+    return StaticManifest(str(tmp_path))
+
+def test_manifest_lookup_and_cache_policy(tmp_path):
+    manifest = build_dist(tmp_path)
+    assert set(manifest.files) == {"index.html", "assets/index-B4x_9fQe.js", "favicon.ico"}
+
+    asset = manifest.lookup("assets/index-B4x_9fQe.js")
+    assert asset["cache_control"] == IMMUTABLE
+    assert manifest.lookup("gallery/123") is manifest.files["index.html"] # Client-side route
+    assert "max-age=60" in manifest.files["index.html"]["cache_control"]
+    assert manifest.lookup("assets/missing-AAAAAAAA.js") is None # Never HTML for a missing asset
+    assert manifest.lookup("../backend/main.py") is manifest.files["index.html"] # No filesystem access
+
+def test_precompressed_variant_negotiation(tmp_path):
+    manifest = build_dist(tmp_path)
+    asset = manifest.lookup("assets/index-B4x_9fQe.js")
+
+    br = manifest.response(asset, "gzip, deflate, br")
+    assert br.headers["content-encoding"] == "br"
+    assert br.headers["etag"].endswith('-br"')
+    assert br.headers["vary"] == "Accept-Encoding"
+    assert br.path.endswith(".js.br")
+
+    assert manifest.response(asset, "gzip").path.endswith(".js.gz")
+    plain = manifest.response(asset, "")
+    assert "content-encoding" not in plain.headers
+    assert plain.media_type in ("text/javascript", "application/javascript")
+
+    # Revalidation per representation
+    assert manifest.response(asset, "gzip", if_none_match=manifest.response(asset, "gzip").headers["etag"]).status_code == 304
@@ -0,0 +1,31 @@
+import json
+import httpx
+import pytest
+from telegram_api import BotAPI, TelegramAPIError
+
+@pytest.mark.asyncio
+async def test_bot_api_reuses_client_and_surfaces_errors():
+    calls = []
+
+    def handler(request: httpx.Request):
+        calls.append((request.url.path, json.loads(request.content)))
+        if len(calls) == 1:
+            return httpx.Response(200, json={"ok": True, "result": True})
+        return httpx.Response(400, json={"ok": False, "description": "Bad Request: query is too old"})
+
+    api = BotAPI("123:abc", transport=httpx.MockTransport(handler))
+    assert await api.answer_pre_checkout("pcq-1") is True
+    client = api.client
+    with pytest.raises(TelegramAPIError, match="query is too old"):
+        await api.answer_pre_checkout("pcq-2", ok=False, error_message="Sold out")
+    assert api.client is client # One keep-alive client for every call
+
+    assert calls[0] == ("/bot123:abc/answerPreCheckoutQuery", {"pre_checkout_query_id": "pcq-1", "ok": True})
+    assert calls[1][1]["error_message"] == "Sold out"
+    await api.close()
+    assert api.client is None
+
+@pytest.mark.asyncio
+async def test_bot_api_requires_token():
+    with pytest.raises(TelegramAPIError):
+        await BotAPI("").answer_pre_checkout("pcq-1")
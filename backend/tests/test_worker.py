@@ -55,3 +55,425 @@ async def test_worker_retry_failure():
         call_args = job_manager.update_job.call_args_list[-1]
         assert call_args[0][1]["status"] == "FAILED"
         assert "error" in call_args[0][1]
+
+def make_png(size=(1024, 1024)):
+    from io import BytesIO
+    from PIL import Image
+    buf = BytesIO()
+    Image.new("RGB", size, (200, 40, 90)).save(buf, format="PNG")
+    return buf.getvalue()
+
+@pytest.mark.asyncio
+async def test_worker_uploads_gallery_variants():
+    job_manager = AsyncMock()
+
+    with patch("worker.generate_with_retry", new_callable=AsyncMock) as mock_gen, \
+         patch("worker.requests.get") as mock_http, \
+         patch("worker.s3_client") as mock_s3:
+
+        mock_response_obj = MagicMock()
+        mock_response_obj.url = "https://openai.com/image.png"
+        mock_response_obj.b64_json = None
+        mock_gen.return_value = mock_response_obj
+        mock_http.return_value.content = make_png()
+
+        await process_job(job_manager, sample_job)
+
+        keys = [c[0][2] for c in mock_s3.upload_fileobj.call_args_list]
+        # Watermarked (standard tier) output is stored as WebP
+        assert "generations/123/test-job-123.webp" in keys
+        assert "generations/123/test-job-123_thumb.webp" in keys
+        assert "generations/123/test-job-123_preview.webp" in keys
+
+        result = job_manager.update_job.call_args_list[-1][0][1]["result"]
+        assert result["variants"]["thumb"]["webp"].endswith("test-job-123_thumb.webp")
+
+def test_build_variants_downscales_only():
+    from PIL import Image
+    from image_variants import build_variants
+
+    variants = {v["name"]: v for v in build_variants(Image.new("RGB", (1024, 1536)))}
+    assert variants["thumb"]["bytes"] == variants["thumb"]["data"].getbuffer().nbytes
+    thumb = Image.open(variants["thumb"]["data"])
+    assert thumb.format == "WEBP"
+    assert max(thumb.size) == 384
+    assert thumb.size[0] < thumb.size[1] # Aspect ratio kept
+
+    small = {v["name"]: v for v in build_variants(Image.new("RGB", (200, 200)))}
+    assert Image.open(small["preview"]["data"]).size == (200, 200)
+
+def test_encode_output_per_tier():
+    from PIL import Image
+    from image_encoding import encode_output, output_tier
+
+    assert output_tier({"should_watermark": True}) == "standard"
+    assert output_tier({"should_watermark": False}) == "premium"
+
+    image = Image.new("RGB", (512, 512), (10, 120, 200))
+    stream, info = encode_output(image, "standard")
+    assert info["format"] == "webp"
+    assert info["content_type"] == "image/webp"
+    assert info["bytes"] == stream.getbuffer().nbytes
+    assert stream.tell() == 0 # Rewound, ready to upload
+    assert Image.open(stream).format == "WEBP"
+
+    stream, info = encode_output(image, "premium")
+    assert info["format"] == "png"
+    assert Image.open(stream).tobytes() == image.tobytes() # Lossless
+
+@pytest.mark.asyncio
+async def test_s3_failure_spools_and_recovers(tmp_path, monkeypatch):
+    import upload_spool
+    from worker import spool_loop
+    monkeypatch.setattr(upload_spool, "SPOOL_DIR", str(tmp_path))
+    monkeypatch.setattr(upload_spool, "RETRY_BASE_SECONDS", 0) # Retry immediately
+
+    job_manager = AsyncMock()
+
+    with patch("worker.generate_with_retry", new_callable=AsyncMock) as mock_gen, \
+         patch("worker.requests.get") as mock_http, \
+         patch("worker.s3_client") as mock_s3:
+
+        mock_response_obj = MagicMock()
+        mock_response_obj.url = "https://openai.com/image.png"
+        mock_response_obj.b64_json = None
+        mock_gen.return_value = mock_response_obj
+        mock_http.return_value.content = make_png((64, 64))
+        mock_s3.upload_fileobj.side_effect = Exception("S3 Down")
+
+        await process_job(job_manager, sample_job)
+
+        result = job_manager.update_job.call_args_list[-1][0][1]["result"]
+        assert result["image_url"] == upload_spool.PLACEHOLDER_URL
+        assert result["pending_upload"] is True
+        assert upload_spool.pending_count() == 1
+
+        # S3 is back: the watcher re-uploads and swaps the URL in,
+        # surviving a Redis blip on the first swap
+        mock_s3.upload_fileobj.side_effect = None
+        job_manager.get_job.side_effect = [Exception("Redis blip"), {"id": "test-job-123", "result": result}]
+        loop_task = asyncio.create_task(spool_loop(job_manager, interval=0.01))
+        await asyncio.sleep(0.2)
+        assert not loop_task.done()
+        loop_task.cancel()
+
+        assert job_manager.get_job.await_count == 2
+        assert upload_spool.pending_count() == 0
+        recovered = job_manager.update_job.call_args_list[-1][0][1]["result"]
+        assert recovered["image_url"].endswith("generations/123/test-job-123.webp")
+        assert recovered["pending_upload"] is False
+
+def make_openai_error(cls, status, code, message="error"):
+    import httpx
+    request = httpx.Request("POST", "https://api.openai.com/v1/images/generations")
+    response = httpx.Response(status, request=request, headers={"retry-after": "2"})
+    return cls(message, response=response, body={"code": code, "message": message})
+
+@pytest.mark.asyncio
+async def test_generate_error_classification():
+    import openai
+    from worker import image_client, image_rate_limiter
+    openai_client = image_client()
+
+    # Safety rejection -> SAFETY_CHECK, no retries
+    safety = make_openai_error(openai.BadRequestError, 400, "moderation_blocked", "Rejected by the safety system")
+    with patch.object(openai_client.images, "generate", new_callable=AsyncMock, side_effect=safety) as mock_gen:
+        with pytest.raises(ValueError, match="SAFETY_CHECK"):
+            await generate_with_retry("prompt", {})
+        assert mock_gen.await_count == 1
+
+    # Any other 400 is surfaced as-is, not as a safety error
+    bad_size = make_openai_error(openai.BadRequestError, 400, "invalid_value", "Invalid size")
+    with patch.object(openai_client.images, "generate", new_callable=AsyncMock, side_effect=bad_size):
+        with pytest.raises(openai.BadRequestError):
+            await generate_with_retry("prompt", {})
+
+    # 429 -> limiter cooldown from retry-after
+    quota = make_openai_error(openai.RateLimitError, 429, "insufficient_quota")
+    with patch.object(openai_client.images, "generate", new_callable=AsyncMock, side_effect=quota), \
+         patch.object(image_rate_limiter, "penalize") as mock_penalize:
+        with pytest.raises(openai.RateLimitError):
+            await generate_with_retry("prompt", {})
+        mock_penalize.assert_called_once_with(2.0)
+
+@pytest.mark.asyncio
+async def test_result_cache_hit_copies_objects(monkeypatch):
+    import result_cache
+    from worker import result_cache_store
+    monkeypatch.setattr(result_cache, "ENABLED", True)
+    monkeypatch.setattr(result_cache, "_catalog", {"a": "A cute cat", "b": "A cute cat"})
+    result_cache_store.memory.clear()
+
+    job_manager = AsyncMock()
+    catalog_job = dict(sample_job, model_config={"quality": "standard", "size": "1024x1024", "style_id": "a"})
+
+    with patch("worker.generate_with_retry", new_callable=AsyncMock) as mock_gen, \
+         patch("worker.requests.get") as mock_http, \
+         patch("worker.s3_client") as mock_s3:
+
+        mock_response_obj = MagicMock()
+        mock_response_obj.url = "https://openai.com/image.png"
+        mock_response_obj.b64_json = None
+        mock_gen.return_value = mock_response_obj
+        mock_http.return_value.content = make_png((64, 64))
+
+        # Miss: generates and stores
+        await process_job(job_manager, catalog_job)
+        assert mock_gen.await_count == 1
+
+        # Hit: same prompt (different whitespace/style_id) is copied, not generated
+        repeat_job = dict(catalog_job, id="test-job-456", prompt="  A cute   cat ",
+                          model_config=dict(catalog_job["model_config"], style_id="b"))
+        await process_job(job_manager, repeat_job)
+        assert mock_gen.await_count == 1
+
+        copied = [c.kwargs["Key"] for c in mock_s3.copy_object.call_args_list]
+        assert "generations/123/test-job-456.webp" in copied
+        assert "generations/123/test-job-456_thumb.webp" in copied
+
+        result = job_manager.update_job.call_args_list[-1][0][1]["result"]
+        assert result["image_url"].endswith("test-job-456.webp")
+        assert result["cost"] == 0.0
+        assert result_cache.hit_rate() > 0
+
+def test_result_cache_key_rules(monkeypatch):
+    import result_cache
+    monkeypatch.setattr(result_cache, "ENABLED", True)
+    monkeypatch.setattr(result_cache, "_catalog", {"Doodle": "A cat", "doodle": "A cat", "Sign": "A sign that says HI"})
+    base = result_cache.cache_key("A cat", {"size": "1024x1024", "style_id": "Doodle"})
+    assert base is not None
+    assert base == result_cache.cache_key(" A  cat", {"size": "1024x1024", "slug": "doodle"})
+    assert base != result_cache.cache_key("A cat", {"size": "1024x1536", "style_id": "Doodle"})
+    assert result_cache.cache_key("A cat", {"init_image": "https://x/y.png", "style_id": "Doodle"}) is None
+    # Free-form prompts are never shared between users, even with a catalog id
+    assert result_cache.cache_key("A cat", {"size": "1024x1024"}) is None
+    assert result_cache.cache_key("My own cat", {"style_id": "Doodle"}) is None
+    # Case is part of the prompt (text rendered in the image)
+    assert result_cache.cache_key("A sign that says hi", {"style_id": "Sign"}) is None
+
+    # The shipped catalog maps titles and slugs to their prompts
+    shipped = result_cache.load_catalog()
+    assert shipped["Doodle"] == shipped["doodle"]
+    assert "header-special" in shipped
+
+    cache = result_cache.ResultCache(max_entries=2)
+    for k in ("a", "b", "c"):
+        cache.put(k, {"s3_key": k})
+    assert cache.get("a") is None # Evicted (LRU)
+    assert cache.get("c") == {"s3_key": "c"}
+
+@pytest.mark.asyncio
+async def test_completion_is_single_rpc():
+    job_manager = AsyncMock()
+    mock_supabase = MagicMock()
+    mock_supabase.rpc.return_value.execute.return_value.data = "tx-uuid"
+
+    with patch("worker.generate_with_retry", new_callable=AsyncMock) as mock_gen, \
+         patch("worker.requests.get") as mock_http, \
+         patch("worker.s3_client"), \
+         patch("worker.supabase", mock_supabase), \
+         patch("worker.profile_cache") as mock_profiles:
+
+        mock_response_obj = MagicMock()
+        mock_response_obj.url = "https://openai.com/image.png"
+        mock_response_obj.b64_json = None
+        mock_gen.return_value = mock_response_obj
+        mock_http.return_value.content = make_png((64, 64))
+
+        await process_job(job_manager, sample_job)
+
+        mock_supabase.rpc.assert_called_once()
+        mock_profiles.invalidate.assert_called_once_with(123) # Billing changed the balance
+        name, params = mock_supabase.rpc.call_args[0]
+        assert name == "complete_generation"
+        assert params["p_generation_id"] == "test-job-123"
+        assert params["p_premium_credits_change"] == -1 # quality=high
+        assert params["p_credits_change"] == 0
+        assert params["p_extra"]["model_tier"] == "high"
+        # No separate ledger insert
+        assert not any(c[0] == ("user_transactions",) for c in mock_supabase.table.call_args_list)
+
+@pytest.mark.asyncio
+async def test_stage_timings_attached_to_job(capsys, monkeypatch):
+    import metrics
+    monkeypatch.setattr(metrics, "SLOW_JOB_SECONDS", 0) # Every job is "slow"
+    job_manager = AsyncMock()
+
+    with patch("worker.generate_with_retry", new_callable=AsyncMock) as mock_gen, \
+         patch("worker.requests.get") as mock_http, \
+         patch("worker.s3_client"):
+
+        mock_response_obj = MagicMock()
+        mock_response_obj.url = "https://openai.com/image.png"
+        mock_response_obj.b64_json = None
+        mock_gen.return_value = mock_response_obj
+        mock_http.return_value.content = make_png((64, 64))
+
+        await process_job(job_manager, sample_job)
+
+    final = job_manager.update_job.call_args_list[-1][0][1]
+    assert final["status"] == "COMPLETED"
+    for stage in ("db_mark", "openai", "download", "decode", "watermark", "encode", "upload", "total"):
+        assert stage in final["timings"]
+    assert 'pixelpop_job_stage_seconds_count{stage="openai"}' in metrics.render_all()
+    assert "🐢 Slow Job test-job-123" in capsys.readouterr().out
+
+@pytest.mark.asyncio
+async def test_store_result_uploads_encoder_stream(tmp_path, monkeypatch):
+    import tracemalloc
+    import upload_spool
+    from io import BytesIO
+    from PIL import Image
+    from metrics import StageTimer
+    from worker import store_result
+    monkeypatch.setattr(upload_spool, "SPOOL_DIR", str(tmp_path))
+
+    job = dict(sample_job, model_config={"should_watermark": True})
+    timer = StageTimer(job["id"])
+    tracemalloc.start()
+    try:
+        with patch("worker.s3_client") as mock_s3:
+            mock_s3.upload_fileobj.side_effect = Exception("S3 Down")
+            stored = await store_result(job, make_png((256, 256)), timer)
+    finally:
+        tracemalloc.stop()
+
+    # The encoder's stream is what gets uploaded, and spooled as-is on failure
+    uploaded = mock_s3.upload_fileobj.call_args[0][0]
+    assert isinstance(uploaded, BytesIO)
+    with upload_spool.open_data(job["id"]) as f:
+        assert f.read() == uploaded.getvalue()
+    assert stored["encoding"]["bytes"] == len(uploaded.getvalue())
+    assert Image.open(uploaded).format == "WEBP"
+
+    # Allocation peaks are recorded per stage while tracing
+    alloc = timer.as_dict()["peak_alloc_kb"]
+    assert alloc["decode"] > 0 and "encode" in alloc
+
+@pytest.mark.asyncio
+async def test_drain_finishes_or_requeues_in_flight_jobs(monkeypatch):
+    import worker
+    from worker import worker_loop, drain
+
+    async def run(job_seconds, timeout):
+        monkeypatch.setattr(worker, "drain_state", {"draining": False, "drained": False, "requeued": 0})
+        job_manager = AsyncMock()
+        job_manager.pop_job.side_effect = [sample_job] + [None] * 10
+        job_manager.pop_similar.return_value = []
+        started = asyncio.Event()
+
+        async def fake_process_job(jm, job):
+            started.set()
+            await asyncio.sleep(job_seconds)
+
+        with patch("worker.process_job", side_effect=fake_process_job):
+            loop_task = asyncio.create_task(worker_loop(job_manager))
+            await started.wait()
+            assert worker.worker_health()["in_flight"] == 1
+            state = await drain(job_manager, timeout=timeout)
+            await asyncio.wait_for(loop_task, timeout=2) # Loop exits instead of popping more
+        return job_manager, state
+
+    # Finishes within the deadline: nothing re-queued
+    job_manager, state = await run(job_seconds=0.05, timeout=2)
+    job_manager.requeue_job.assert_not_awaited()
+    assert state == {"status": "drained", "in_flight": 0, "requeued": 0}
+
+    # Misses the deadline: cancelled and put back on the queue
+    job_manager, state = await run(job_seconds=10, timeout=0.05)
+    job_manager.requeue_job.assert_awaited_once_with(sample_job)
+    assert state == {"status": "drained", "in_flight": 0, "requeued": 1}
+
+@pytest.mark.asyncio
+async def test_drain_requeues_only_unfinished_jobs_of_a_batch(monkeypatch):
+    import worker
+    from worker import worker_loop, drain
+    monkeypatch.setattr(worker, "drain_state", {"draining": False, "drained": False, "requeued": 0})
+    batch = [dict(sample_job, id=f"batch-{i}") for i in range(3)]
+    job_manager = AsyncMock()
+    job_manager.pop_job.side_effect = [batch[0]] + [None] * 10
+    job_manager.pop_similar.return_value = batch[1:]
+    first_done = asyncio.Event()
+
+    async def fake_process_job(jm, job, **kwargs):
+        if job["id"] == "batch-0":
+            first_done.set()
+            return
+        await asyncio.sleep(10) # Second image still being stored when the drain deadline hits
+
+    with patch("worker.batchable", return_value=True), \
+         patch("worker.generate_with_retry", new_callable=AsyncMock, return_value=[b"img"] * 3), \
+         patch("worker.mark_processing", new_callable=AsyncMock), \
+         patch("worker.process_job", side_effect=fake_process_job):
+        loop_task = asyncio.create_task(worker_loop(job_manager))
+        await first_done.wait()
+        await asyncio.sleep(0)
+        state = await drain(job_manager, timeout=0.05)
+        await asyncio.wait_for(loop_task, timeout=2)
+
+    # The completed (and billed) job is not generated a second time
+    requeued = [c.args[0]["id"] for c in job_manager.requeue_job.await_args_list]
+    assert requeued == ["batch-1", "batch-2"]
+    assert state == {"status": "drained", "in_flight": 0, "requeued": 2}
+
+@pytest.mark.asyncio
+async def test_partial_frames_streamed_from_fake_provider():
+    from fake_image_provider import FakeImageClient
+    job_manager = AsyncMock()
+
+    fake = FakeImageClient(latency=0)
+    streamed_job = dict(sample_job, model_config=dict(sample_job["model_config"], stream_partials=True))
+
+    with patch("worker.openai_client", fake), \
+         patch.object(fake.images, "generate", wraps=fake.images.generate) as mock_gen, \
+         patch("worker.s3_client"):
+        await process_job(job_manager, sample_job)
+        # Nobody streams this job: no partial frames requested (they are billed)
+        assert "partial_images" not in mock_gen.await_args.kwargs
+        await process_job(job_manager, streamed_job)
+        assert mock_gen.await_args.kwargs["partial_images"] == 2
+
+    updates = [c[0][1] for c in job_manager.update_job.call_args_list]
+    partials = [u["partial"] for u in updates if "partial" in u]
+    assert [p["index"] for p in partials] == [0, 1]
+    # The frames are part of the output token estimate
+    completed = [u for u in updates if u.get("status") == "COMPLETED"]
+    assert completed[1]["result"]["cost"] > completed[0]["result"]["cost"]
+    # Small encoded thumbnails, not full frames
+    assert all(p["image"].startswith("data:image/webp;base64,") for p in partials)
+    assert all(len(p["image"]) < 20_000 for p in partials)
+    assert updates[-1]["status"] == "COMPLETED"
+
+@pytest.mark.asyncio
+async def test_identical_jobs_share_one_n_call():
+    from job_manager import JobManager
+    from fake_image_provider import FakeImageClient
+    from worker import process_batch, batch_key, batchable
+
+    job_manager = JobManager()
+    job_manager.redis = None
+    config = {"quality": "standard", "size": "1024x1024"}
+    ids = [await job_manager.enqueue_job("A cute cat", dict(config, should_watermark=(i != 1)), 123) for i in range(3)]
+    await job_manager.enqueue_job("A dog", dict(config), 123)
+
+    lead = await job_manager.pop_job()
+    assert batchable(lead)
+    siblings = await job_manager.pop_similar(lambda j: batch_key(j) == batch_key(lead), 3)
+    assert [j["id"] for j in [lead] + siblings] == ids # The dog job stays queued
+
+    fake = FakeImageClient(latency=0)
+    with patch("worker.openai_client", fake), \
+         patch.object(fake.images, "generate", wraps=fake.images.generate) as mock_gen, \
+         patch("worker.s3_client") as mock_s3:
+        await process_batch(job_manager, [lead] + siblings)
+
+    mock_gen.assert_awaited_once()
+    assert mock_gen.await_args.kwargs["n"] == 3
+    # Fanned out: every job completed with its own object
+    keys = {c[0][2] for c in mock_s3.upload_fileobj.call_args_list}
+    for job_id in ids:
+        assert (await job_manager.get_job(job_id))["status"] == "COMPLETED"
+    # Watermarking is per image: the unwatermarked job is stored as premium PNG
+    assert f"generations/123/{ids[1]}.png" in keys
+    assert f"generations/123/{ids[0]}.webp" in keys
+    assert (await job_manager.pop_job())["prompt"] == "A dog"
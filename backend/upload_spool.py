@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import tempfile
+
+# Local disk spool for generations whose S3 upload failed.
+# Each entry is two files: {job_id}.bin (image bytes) and {job_id}.json (metadata).
+SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "pixelpop-spool"))
+
+# Served as image_url until the re-upload succeeds (lives in frontend/public)
+PLACEHOLDER_URL = os.getenv("UPLOAD_PLACEHOLDER_URL", "/images/placeholder/pending-upload.webp")
+
+RETRY_BASE_SECONDS = float(os.getenv("UPLOAD_RETRY_BASE_SECONDS", "5"))
+RETRY_MAX_SECONDS = float(os.getenv("UPLOAD_RETRY_MAX_SECONDS", "600"))
+
+
+def _paths(job_id: str):
+    return os.path.join(SPOOL_DIR, f"{job_id}.bin"), os.path.join(SPOOL_DIR, f"{job_id}.json")
+
+
+def _write_atomic(path: str, data):
+    # Write + rename so a crash never leaves a half-written entry behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def backoff_seconds(attempts: int) -> float:
+    return min(RETRY_BASE_SECONDS * (2 ** attempts), RETRY_MAX_SECONDS)
+
+
+def spool_upload(job_id: str, user_id, s3_key: str, data, content_type: str) -> dict:
+    """
+    Persists a failed upload to disk. `data` is any bytes-like object
+    (a memoryview of the upload stream is written without copying).
+    The bytes are written before the metadata, so an entry only becomes
+    visible once it is complete.
+    """
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    bin_path, meta_path = _paths(job_id)
+    meta = {
+        "job_id": job_id,
+        "user_id": user_id,
+        "s3_key": s3_key,
+        "content_type": content_type,
+        "attempts": 0,
+        "spooled_at": time.time(),
+        "next_attempt_at": time.time() + backoff_seconds(0),
+    }
+    _write_atomic(bin_path, data)
+    _write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+    print(f"💾 Spooled Upload: {s3_key} ({memoryview(data).nbytes} bytes) -> {bin_path}")
+    return meta
+
+
+def due_entries(now: float = None) -> list:
+    """
+    Returns metadata of spooled uploads whose backoff has elapsed.
+    """
+    if not os.path.isdir(SPOOL_DIR):
+        return []
+    now = now or time.time()
+    entries = []
+    for name in os.listdir(SPOOL_DIR):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(SPOOL_DIR, name), "rb") as f:
+                meta = json.loads(f.read())
+        except Exception as e:
+            print(f"⚠️ Unreadable Spool Entry {name}: {e}")
+            continue
+        if meta.get("next_attempt_at", 0) <= now:
+            entries.append(meta)
+    return sorted(entries, key=lambda m: m.get("spooled_at", 0))
+
+
+def open_data(job_id: str):
+    """
+    Opens the spooled bytes for streaming (callers close the file).
+    """
+    bin_path, _ = _paths(job_id)
+    return open(bin_path, "rb")
+
+
+def reschedule(meta: dict) -> dict:
+    meta["attempts"] = meta.get("attempts", 0) + 1
+    meta["next_attempt_at"] = time.time() + backoff_seconds(meta["attempts"])
+    _, meta_path = _paths(meta["job_id"])
+    _write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+    return meta
+
+
+def remove(job_id: str):
+    # Metadata first: a leftover .bin without .json is never picked up again
+    for path in reversed(_paths(job_id)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def pending_count() -> int:
+    if not os.path.isdir(SPOOL_DIR):
+        return 0
+    return sum(1 for name in os.listdir(SPOOL_DIR) if name.endswith(".json"))
@@ -1,51 +1,106 @@
 import os
 import time
 import json
-print(f"DEBUG ENV KEYS: {[k for k in os.environ.keys() if 'SUPA' in k or 'VITE' in k]}")
 import asyncio
-import boto3
+import binascii
+from contextlib import ExitStack
 import requests
 from io import BytesIO
-from tenacity import retry, stop_after_attempt, wait_exponential
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+import openai
 from openai import AsyncOpenAI
 from job_manager import JobManager
+from image_variants import build_variants, variant_key, render_partial_preview
+from image_encoding import encode_output, output_tier
+import upload_spool
+from rate_limiter import ImageRateLimiter, retry_after_seconds
+import result_cache
+from db_writer import StatusWriteBuffer
+from profile_cache import profile_cache
+from credit_reservations import reservations, RECONCILE_SECONDS
+from content_version import content_versions
+from metrics import StageTimer
+from fake_image_provider import FakeImageClient
+from PIL import Image, ImageDraw, ImageFont
 
-from supabase import create_client, Client
-
-# Initialize Services
-# Supabase
-SUPABASE_URL = os.getenv("SUPABASE_URL") or os.getenv("VITE_SUPABASE_URL")
-# WORKER AUDIT: Must use Service Role (SUPABASE_KEY) in production for reliability
-if os.getenv("APP_ENV") == "development":
-    SUPABASE_KEY = os.getenv("SUPABASE_KEY") or os.getenv("VITE_SUPABASE_KEY") or os.getenv("VITE_SUPABASE_ANON_KEY")
-    if not os.getenv("SUPABASE_KEY"):
-        print("⚠️  DEV WARN: Helper using ANON KEY. Some admin tasks might fail.")
-else:
-    # Production Strictness
-    SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-    if not SUPABASE_KEY:
-        print("❌ CRITICAL: SUPABASE_KEY (Service Role) missing in Production!")
-supabase: Client = None
-if SUPABASE_URL and SUPABASE_KEY:
-    try:
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-    except Exception as e:
-        print(f"⚠️ Failed to init Supabase: {e}")
-else:
-    print(f"⚠️ Supabase env vars missing! URL={SUPABASE_URL is not None}, KEY={SUPABASE_KEY is not None}")
-
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-    region_name=os.getenv("AWS_REGION", "us-east-1")
-)
-print(f"🔑 AWS Key ID in Env: {os.getenv('AWS_ACCESS_KEY_ID')[:4] if os.getenv('AWS_ACCESS_KEY_ID') else 'NONE'}")
-print(f"🪣 AWS Bucket: {os.getenv('AWS_BUCKET_NAME')}")
+import db
+from db import client as supabase
+
+# Clients are built on first use: importing this module stays cheap
+s3_client = None
+openai_client = None
+
+
+def s3():
+    global s3_client
+    if s3_client is None:
+        import boto3
+        s3_client = boto3.client(
+            's3',
+            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+            region_name=os.getenv("AWS_REGION", "us-east-1")
+        )
+    return s3_client
 
 BUCKET_NAME = os.getenv("AWS_BUCKET_NAME", "pixelpop")
 
-openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+status_buffer = StatusWriteBuffer(lambda: supabase)
+
+# IMAGE_PROVIDER=fake swaps in a local stand-in for the images API (dev/testing)
+IMAGE_PROVIDER = os.getenv("IMAGE_PROVIDER", "openai").lower()
+# Partial frames streamed per generation (API allows 0-3, 0 = no streaming).
+# Only for jobs enqueued with model_config.stream_partials (the client
+# streams the job): each frame is billed as extra output tokens.
+STREAM_PARTIAL_IMAGES = int(os.getenv("IMAGE_STREAM_PARTIALS", "2"))
+PARTIAL_IMAGE_OUTPUT_TOKENS = 100
+
+
+def partial_image_count(on_partial, n: int = 1) -> int:
+    return STREAM_PARTIAL_IMAGES if on_partial and n == 1 and STREAM_PARTIAL_IMAGES > 0 else 0
+
+
+def image_client():
+    global openai_client
+    if openai_client is None:
+        if IMAGE_PROVIDER == "fake":
+            print("🧪 Using fake image provider")
+            openai_client = FakeImageClient()
+        else:
+            # SDK-internal retries would bypass the shared limiter; tenacity retries instead
+            openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "0")))
+    return openai_client
+
+image_rate_limiter = ImageRateLimiter.from_env()
+result_cache_store = result_cache.ResultCache.from_env()
+
+# Max images per batched call for identical queued requests (1 = no batching)
+IMAGE_BATCH_MAX = int(os.getenv("IMAGE_BATCH_MAX", "4"))
+
+# Graceful drain: on shutdown stop popping, let in-flight jobs finish
+# within the deadline (platform grace period minus a margin), re-queue the rest.
+DRAIN_TIMEOUT_SECONDS = float(os.getenv("WORKER_DRAIN_TIMEOUT_SECONDS", "25"))
+drain_state = {"draining": False, "drained": False, "requeued": 0}
+in_flight = {} # job_id -> (task, job)
+
+SAFETY_CODES = ("content_policy_violation", "moderation_blocked")
+
+def is_safety_error(e):
+    if not isinstance(e, openai.BadRequestError):
+        return False
+    err_str = str(e).lower()
+    return getattr(e, "code", None) in SAFETY_CODES or any(c in err_str for c in SAFETY_CODES) or "safety_system" in err_str
+
+def is_retryable(e):
+    """
+    Safety rejections, malformed requests, auth problems and exhausted quota
+    fail the same way on every attempt. Everything else (429, 5xx, network) is retried.
+    """
+    if isinstance(e, (ValueError, openai.BadRequestError, openai.AuthenticationError, openai.PermissionDeniedError, openai.NotFoundError)):
+        return False
+    if isinstance(e, openai.RateLimitError) and getattr(e, "code", None) == "insufficient_quota":
+        return False
+    return True
 
 async def update_db_status(job_id, status, result_url=None, job_details=None, cost=None, extra_stats=None):
     """
@@ -82,17 +137,23 @@ async def update_db_status(job_id, status, result_url=None, job_details=None, co
         if extra_stats:
             data.update(extra_stats) # Merge input_tokens, output_tokens, etc.
             
-        # Supabase-py is synchronous
-        supabase.table("generations").upsert(data).execute()
+        # Supabase-py is synchronous: coalesced and flushed in batches off the loop
+        status_buffer.enqueue(data)
         
     except Exception as e:
         print(f"❌ Supabase Update Failed: {e}")
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-async def generate_with_retry(prompt, model_config):
+@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10), retry=retry_if_exception(is_retryable), reraise=True)
+async def generate_with_retry(prompt, model_config, on_partial=None, n=1):
+    """
+    Returns the generated image object, or a list of n image objects when n > 1.
+    """
     quality = model_config.get('quality', 'standard')
     # gpt-image-1.5 supports: low, medium, high, auto
     quality_param = "high" if quality == "high" else "medium"
+    # Stream partial frames only when a caller publishes them (single image only)
+    partial_images = partial_image_count(on_partial, n)
+    stream_args = {"stream": True, "partial_images": partial_images} if partial_images else {}
     
     try:
         if 'init_image' in model_config:
@@ -136,201 +197,468 @@ async def generate_with_retry(prompt, model_config):
             image_bytes = input_byte_arr
             image_bytes.name = "input_image.png"
 
-            print(f"🎨 Calling OpenAI Edit (gpt-image-1.5): {prompt[:30]}...")
-            response = await openai_client.images.edit(
-                model="gpt-image-1.5",
-                image=image_bytes,
-                prompt=prompt,
-                n=1,
-                size=target_size_str,
-                # output_format="png" # Optional, defaults to png usually
-            )
+            async with image_rate_limiter.slot():
+                print(f"🎨 Calling OpenAI Edit (gpt-image-1.5): {prompt[:30]}...")
+                response = await image_client().images.edit(
+                    model="gpt-image-1.5",
+                    image=image_bytes,
+                    prompt=prompt,
+                    n=n,
+                    size=target_size_str,
+                    # output_format="png" # Optional, defaults to png usually
+                    **stream_args
+                )
+                if stream_args:
+                    return await consume_image_stream(response, on_partial)
         else:
             # Text-to-Image Mode
             # Use gpt-image-1.5
-            print(f"🎨 Calling OpenAI Generate (gpt-image-1.5): {prompt[:30]}...")
-            response = await openai_client.images.generate(
-                model="gpt-image-1.5",
-                prompt=prompt,
-                n=1,
-                size=model_config.get("size", "1024x1024"),
-                quality=quality_param,
-            )
+            async with image_rate_limiter.slot():
+                print(f"🎨 Calling OpenAI Generate (gpt-image-1.5): {prompt[:30]}...")
+                response = await image_client().images.generate(
+                    model="gpt-image-1.5",
+                    prompt=prompt,
+                    n=n,
+                    size=model_config.get("size", "1024x1024"),
+                    quality=quality_param,
+                    **stream_args
+                )
+                if stream_args:
+                    return await consume_image_stream(response, on_partial)
             
-        return response.data[0]
+        return response.data[0] if n == 1 else response.data
 
     except Exception as e:
         print(f"❌ OpenAI API Error: {e}")
-        # Detect Content Policy Violation (HTTP 400 from OpenAI)
-        err_str = str(e).lower()
-        if "content_policy_violation" in err_str or "safety_system" in err_str or (hasattr(e, 'status_code') and e.status_code == 400):
+        # Detect Content Policy Violation (HTTP 400 with a safety code, not any 400)
+        if is_safety_error(e):
              print("⚠️ Safety Check Triggered")
              raise ValueError("SAFETY_CHECK: Your prompt was flagged by the safety system.")
+
+        # 429: hold every worker back for as long as OpenAI asks
+        if isinstance(e, openai.RateLimitError):
+             wait = retry_after_seconds(e.response.headers if e.response is not None else None)
+             image_rate_limiter.penalize(wait if wait is not None else 5)
              
         # If available, print full response info
         if hasattr(e, 'response') and e.response:
              print(f"❌ Error Response Body: {e.response.text}")
         raise e
 
-async def process_job(job_manager: JobManager, job: dict):
-    job_id = job["id"]
-    try:
-        await job_manager.update_job(job_id, {"status": "PROCESSING"})
-        # Pass job details to create the row if it doesn't exist
-        await update_db_status(job_id, "PROCESSING", job_details=job)
+async def consume_image_stream(stream, on_partial):
+    """
+    Reads an images API event stream: partial frames go to on_partial(index, b64_json),
+    the completed event is returned (same b64_json shape as response.data[0]).
+    """
+    final = None
+    async for event in stream:
+        if event.type.endswith(".partial_image"):
+            try:
+                await on_partial(event.partial_image_index, event.b64_json)
+            except Exception as e:
+                print(f"⚠️ Partial Preview Failed (Skipping): {e}")
+        elif event.type.endswith(".completed"):
+            final = event
+    if final is None:
+        raise RuntimeError("Image stream ended without a completed image")
+    return final
 
-        # 1. Generate
-        print(f"🖼️ Model Config: {job.get('model_config', {})}")
-        image_data_obj = await generate_with_retry(job["prompt"], job.get("model_config", {}))
-        
-        # 2. Extract Image Data (URL or Base64)
-        image_url = getattr(image_data_obj, 'url', None)
-        b64_json = getattr(image_data_obj, 'b64_json', None)
-        
-        import base64
-        if b64_json:
-            print("📦 Processing Base64 Image Data...")
-            img_data = base64.b64decode(b64_json)
-        elif image_url:
-            print(f"⬇️ Downloading from OpenAI: {image_url}")
-            img_data = requests.get(image_url).content
-        else:
-             raise ValueError(f"No image data found (url={image_url}, b64_json={'YES' if b64_json else 'None'})")
+def apply_watermark(image):
+    """
+    Stamps the vertical "Generated with PIXEL POP" label on the right edge.
+    Returns a new RGB image.
+    """
+    orig_image = image.convert("RGBA")
+    width, height = orig_image.size
+    
+    # Create Watermark Layer
+    txt_layer = Image.new("RGBA", orig_image.size, (255, 255, 255, 0))
+    draw = ImageDraw.Draw(txt_layer)
+    
+    # Font Settings
+    text = "Generated with PIXEL POP • @pixel_pop_bot"
+    font_size = 24 # Increased from 20 for visibility (V1 style)
+    font = ImageFont.load_default() # Fallback
 
-        # --- Watermark Logic ---
-        should_watermark = job.get("model_config", {}).get("should_watermark", True)
-        
-        if should_watermark:
-            try:
-                from PIL import Image, ImageDraw, ImageFont
-                
-                print("💧 Applying Watermark...")
-                
-                # Load Image
-                orig_image = Image.open(BytesIO(img_data)).convert("RGBA")
-                width, height = orig_image.size
-                
-                # Create Watermark Layer
-                txt_layer = Image.new("RGBA", orig_image.size, (255, 255, 255, 0))
-                draw = ImageDraw.Draw(txt_layer)
-                
-                # Font Settings
-                text = "Generated with PIXEL POP • @pixel_pop_bot"
-                font_size = 24 # Increased from 20 for visibility (V1 style)
-                font = ImageFont.load_default() # Fallback
+    # Try to load a nicer font if available (common linux paths)
+    possible_fonts = [
+        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+        "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+        "/app/fonts/Roboto-Regular.ttf", # Custom path if needed
+    ]
     
-                # Try to load a nicer font if available (common linux paths)
-                possible_fonts = [
-                    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-                    "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
-                    "/app/fonts/Roboto-Regular.ttf", # Custom path if needed
-                ]
-                
-                font_path = None
-                for p in possible_fonts:
-                    if os.path.exists(p):
-                        font_path = p
-                        break
-                
-                # Fallback: Download Roboto to local dir if not found locally
-                if not font_path:
-                    try:
-                        # Use raw.githubusercontent correct repo
-                        font_url = "https://raw.githubusercontent.com/googlefonts/roboto/main/src/hinted/Roboto-Regular.ttf"
-                        temp_font_path = "Roboto-Regular.ttf" # Save in CWD
-                        
-                        if not os.path.exists(temp_font_path) or os.path.getsize(temp_font_path) < 1000:
-                            print(f"⬇️ Downloading Font from {font_url}...")
-                            import requests
-                            # Add headers to avoid bot blocking
-                            r = requests.get(font_url, headers={'User-Agent': 'Mozilla/5.0'}, timeout=10)
-                            r.raise_for_status()
-                            with open(temp_font_path, "wb") as f:
-                                f.write(r.content)
-                            print(f"✅ Font downloaded: {os.path.getsize(temp_font_path)} bytes")
-                        
-                        font_path = temp_font_path
-                    except Exception as dl_err:
-                        print(f"⚠️ Font Download Failed: {dl_err}")
+    font_path = None
+    for p in possible_fonts:
+        if os.path.exists(p):
+            font_path = p
+            break
     
-                if font_path:
-                    try:
-                        font = ImageFont.truetype(font_path, font_size)
-                        print(f"✅ Loaded Font: {font_path}")
-                    except Exception as font_err:
-                        print(f"⚠️ Failed to load TrueType font ({font_path}): {font_err}")
-                        print("⚠️ Falling back to default font (bitmap)")
-                
-                # Rotate Text: Create temporary image for text to rotate it
-                # Text size
-                bbox = draw.textbbox((0, 0), text, font=font)
-                text_w = bbox[2] - bbox[0]
-                text_h = bbox[3] - bbox[1]
-                
-                # Create separate image for text with GENEROUS padding to prevent any clipping
-                safe_padding = 20 # 10px on each side
-                text_img = Image.new('RGBA', (text_w + safe_padding, text_h + safe_padding), (255, 255, 255, 0)) 
-                text_draw = ImageDraw.Draw(text_img)
-                
-                # V1 Style: No stroke, 90% opacity white, Bullet point restored
-                # Use offset with padding to ensure no clipping
-                draw_x = (safe_padding // 2) - bbox[0]
-                draw_y = (safe_padding // 2) - bbox[1]
-                text_draw.text((draw_x, draw_y), text, font=font, fill=(255, 255, 255, 230)) 
-                
-                # Rotate 90 degrees counter-clockwise
-                rotated_text = text_img.rotate(90, expand=True) 
-                
-                # Position: Right edge, bottom
-                padding_right = 20 
-                padding_bottom = 40
-                
-                x = width - rotated_text.width - padding_right
-                y = height - rotated_text.height - padding_bottom
-                
-                # Draw rotated text onto layer
-                txt_layer.paste(rotated_text, (x, y), rotated_text)
-                
-                # Composite
-                watermarked = Image.alpha_composite(orig_image, txt_layer)
-                
-                # Save back to bytes
-                out_buffer = BytesIO()
-                watermarked.convert("RGB").save(out_buffer, format="PNG")
-                img_data = out_buffer.getvalue()
-                print("✅ Watermark Applied Successfully (Stroked)")
+    # Fallback: Download Roboto to local dir if not found locally
+    if not font_path:
+        try:
+            # Use raw.githubusercontent correct repo
+            font_url = "https://raw.githubusercontent.com/googlefonts/roboto/main/src/hinted/Roboto-Regular.ttf"
+            temp_font_path = "Roboto-Regular.ttf" # Save in CWD
             
-            except Exception as e:
-                print(f"⚠️ Watermark Failed (Skipping): {e}")
+            if not os.path.exists(temp_font_path) or os.path.getsize(temp_font_path) < 1000:
+                print(f"⬇️ Downloading Font from {font_url}...")
+                # Add headers to avoid bot blocking
+                r = requests.get(font_url, headers={'User-Agent': 'Mozilla/5.0'}, timeout=10)
+                r.raise_for_status()
+                with open(temp_font_path, "wb") as f:
+                    f.write(r.content)
+                print(f"✅ Font downloaded: {os.path.getsize(temp_font_path)} bytes")
             
-        else:
-             print("✨ Premium Generation: Watermark Skipped")
+            font_path = temp_font_path
+        except Exception as dl_err:
+            print(f"⚠️ Font Download Failed: {dl_err}")
+
+    if font_path:
+        try:
+            font = ImageFont.truetype(font_path, font_size)
+            print(f"✅ Loaded Font: {font_path}")
+        except Exception as font_err:
+            print(f"⚠️ Failed to load TrueType font ({font_path}): {font_err}")
+            print("⚠️ Falling back to default font (bitmap)")
+    
+    # Rotate Text: Create temporary image for text to rotate it
+    # Text size
+    bbox = draw.textbbox((0, 0), text, font=font)
+    text_w = bbox[2] - bbox[0]
+    text_h = bbox[3] - bbox[1]
+    
+    # Create separate image for text with GENEROUS padding to prevent any clipping
+    safe_padding = 20 # 10px on each side
+    text_img = Image.new('RGBA', (text_w + safe_padding, text_h + safe_padding), (255, 255, 255, 0)) 
+    text_draw = ImageDraw.Draw(text_img)
+    
+    # V1 Style: No stroke, 90% opacity white, Bullet point restored
+    # Use offset with padding to ensure no clipping
+    draw_x = (safe_padding // 2) - bbox[0]
+    draw_y = (safe_padding // 2) - bbox[1]
+    text_draw.text((draw_x, draw_y), text, font=font, fill=(255, 255, 255, 230)) 
+    
+    # Rotate 90 degrees counter-clockwise
+    rotated_text = text_img.rotate(90, expand=True) 
+    
+    # Position: Right edge, bottom
+    padding_right = 20 
+    padding_bottom = 40
+    
+    x = width - rotated_text.width - padding_right
+    y = height - rotated_text.height - padding_bottom
+    
+    # Draw rotated text onto layer
+    txt_layer.paste(rotated_text, (x, y), rotated_text)
+    
+    # Composite
+    watermarked = Image.alpha_composite(orig_image, txt_layer)
+    return watermarked.convert("RGB")
 
-        # 3. Upload to S3
-        s3_key = f"generations/{job['user_id']}/{job_id}.png"
-        print(f"⬆️ Uploading to S3: {s3_key}")
+def upload_variants(s3_key, image):
+    """
+    Renders and uploads the gallery variants next to the original object.
+    Returns {"thumb": {"webp": url}, "preview": {"webp": url}}.
+    A failed variant is skipped: clients fall back to the original URL.
+    """
+    variants = {}
+    try:
+        rendered = build_variants(image)
+    except Exception as e:
+        print(f"⚠️ Variant Rendering Failed (Skipping): {e}")
+        return variants
+
+    for variant in rendered:
+        key = variant_key(s3_key, variant["name"], variant["format"])
+        try:
+            s3().upload_fileobj(
+                variant["data"],
+                BUCKET_NAME,
+                key,
+                # Keys are unique per job, so variants never change
+                ExtraArgs={'ContentType': variant["content_type"], 'CacheControl': "public, max-age=31536000, immutable"}
+            )
+        except Exception as e:
+            print(f"⚠️ Variant Upload Failed ({key}): {e}")
+            continue
+        variants.setdefault(variant["name"], {})[variant["format"]] = f"https://{BUCKET_NAME}.s3.amazonaws.com/{key}"
+        print(f"🖼️ Variant Uploaded: {key} ({variant['bytes']} bytes)")
+    return variants
+
+def fetch_image_bytes(image_data_obj):
+    """
+    Returns the raw image bytes from an OpenAI image object (b64_json or url).
+    """
+    image_url = getattr(image_data_obj, 'url', None)
+    b64_json = getattr(image_data_obj, 'b64_json', None)
+    
+    if b64_json:
+        print("📦 Processing Base64 Image Data...")
+        # a2b_base64 reads the ASCII str in place (b64decode would first copy it to bytes)
+        return binascii.a2b_base64(b64_json)
+    elif image_url:
+        print(f"⬇️ Downloading from OpenAI: {image_url}")
+        return requests.get(image_url).content
+    else:
+         raise ValueError(f"No image data found (url={image_url}, b64_json={'YES' if b64_json else 'None'})")
+
+async def store_result(job, img_data, timer=None):
+    """
+    Decode -> watermark -> encode -> upload (original + variants).
+    The encoder writes into the stream that is uploaded (and spooled on
+    failure), so the output bytes are never copied between stages.
+    Returns {public_url, s3_key, variants, encoding, pending_upload}.
+    """
+    job_id = job["id"]
+    timer = timer or StageTimer(job_id)
+    # --- Decode ---
+    model_config = job.get("model_config", {})
+    try:
+        with timer.stage("decode"):
+            # BytesIO over bytes shares the buffer until written to
+            image = Image.open(BytesIO(img_data))
+            image.load()
+    except Exception as e:
+        print(f"⚠️ Image Decode Failed: {e}. Storing raw bytes.")
+        image = None
+
+    # --- Watermark Logic ---
+    should_watermark = model_config.get("should_watermark", True)
+    
+    if should_watermark and image is not None:
+        try:
+            print("💧 Applying Watermark...")
+            with timer.stage("watermark"):
+                image = apply_watermark(image)
+            print("✅ Watermark Applied Successfully (Stroked)")
+        except Exception as e:
+            print(f"⚠️ Watermark Failed (Skipping): {e}")
         
+    elif not should_watermark:
+         print("✨ Premium Generation: Watermark Skipped")
+
+    # --- Output Encoding ---
+    # Raw bytes are stored as-is if the image could not be decoded
+    payload = BytesIO(img_data)
+    encoding = {"format": "png", "content_type": "image/png", "ext": "png", "bytes": len(img_data), "encode_ms": 0.0}
+    if image is not None:
+        tier = output_tier(model_config)
         try:
-            s3_client.upload_fileobj(
-                BytesIO(img_data), 
+            with timer.stage("encode"):
+                payload, encoding = await asyncio.to_thread(encode_output, image, tier)
+            print(f"🗜️ Encoded {tier} output: {encoding['format'].upper()} q{encoding['quality']}, {encoding['bytes']} bytes in {encoding['encode_ms']} ms")
+        except Exception as e:
+            print(f"⚠️ Output Encoding Failed (Storing original bytes): {e}")
+
+    # 3. Upload to S3
+    variants = {}
+    pending_upload = False
+    s3_key = f"generations/{job['user_id']}/{job_id}.{encoding['ext']}"
+    print(f"⬆️ Uploading to S3: {s3_key}")
+    
+    try:
+        with timer.stage("upload"):
+            s3().upload_fileobj(
+                payload,
                 BUCKET_NAME, 
                 s3_key, 
-                ExtraArgs={'ContentType': "image/png"} # 'ACL': 'public-read' if needed
+                ExtraArgs={'ContentType': encoding["content_type"]} # 'ACL': 'public-read' if needed
             )
-            # Construct public URL (assuming not using pre-signed for public assets)
-            # Or use CloudFront domain if configured
-            public_url = f"https://{BUCKET_NAME}.s3.amazonaws.com/{s3_key}"
-        except Exception as e:
-            print(f"⚠️ S3 Upload Failed: {e}. Falling back to Data URI.")
-            if 'img_data' in locals() and img_data:
-                import base64
-                b64_str = base64.b64encode(img_data).decode('utf-8')
-                public_url = f"data:image/png;base64,{b64_str}"
-            else:
-                public_url = image_url
+        # Construct public URL (assuming not using pre-signed for public assets)
+        # Or use CloudFront domain if configured
+        public_url = f"https://{BUCKET_NAME}.s3.amazonaws.com/{s3_key}"
+        # Thumbnails / previews for the gallery grid (CPU-bound, keep off the loop)
+        if image is not None:
+            with timer.stage("variants"):
+                variants = await asyncio.to_thread(upload_variants, s3_key, image)
+    except Exception as e:
+        print(f"⚠️ S3 Upload Failed: {e}. Spooling for background re-upload.")
+        try:
+            with payload.getbuffer() as view:
+                upload_spool.spool_upload(job_id, job["user_id"], s3_key, view, encoding["content_type"])
+            public_url = upload_spool.PLACEHOLDER_URL
+            pending_upload = True
+        except Exception as spool_err:
+            print(f"❌ Spool Write Failed: {spool_err}")
+            public_url = upload_spool.PLACEHOLDER_URL
+
+    return {
+        "public_url": public_url,
+        "s3_key": s3_key,
+        "variants": variants,
+        "encoding": encoding,
+        "pending_upload": pending_upload
+    }
+
+def serve_cached_result(entry, job):
+    """
+    Serves a result cache hit by server-side copying the cached objects
+    to this job's keys (no egress, no OpenAI call).
+    Returns the same shape as store_result, or None if the source is gone.
+    """
+    encoding = entry["encoding"]
+    s3_key = f"generations/{job['user_id']}/{job['id']}.{encoding['ext']}"
+    try:
+        s3().copy_object(
+            Bucket=BUCKET_NAME,
+            Key=s3_key,
+            CopySource={"Bucket": BUCKET_NAME, "Key": entry["s3_key"]}
+        )
+    except Exception as e:
+        print(f"⚠️ Cache Hit Copy Failed ({entry['s3_key']}): {e}. Regenerating.")
+        return None
+
+    variants = {}
+    for name, formats in (entry.get("variants") or {}).items():
+        for fmt in formats:
+            key = variant_key(s3_key, name, fmt)
+            try:
+                s3().copy_object(
+                    Bucket=BUCKET_NAME,
+                    Key=key,
+                    CopySource={"Bucket": BUCKET_NAME, "Key": variant_key(entry["s3_key"], name, fmt)}
+                )
+                variants.setdefault(name, {})[fmt] = f"https://{BUCKET_NAME}.s3.amazonaws.com/{key}"
+            except Exception as e:
+                print(f"⚠️ Cache Hit Variant Copy Failed ({key}): {e}")
+
+    print(f"♻️ Result Cache Hit: {entry['s3_key']} -> {s3_key}")
+    return {
+        "public_url": f"https://{BUCKET_NAME}.s3.amazonaws.com/{s3_key}",
+        "s3_key": s3_key,
+        "variants": variants,
+        "encoding": encoding,
+        "pending_upload": False,
+        "cache_hit": True
+    }
+
+@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=0.5, min=0.5, max=4), reraise=True)
+def call_complete_generation(params):
+    # Idempotent on the job id (ledger reference_id), so retrying is safe
+    return supabase.rpc("complete_generation", params).execute()
+
+async def record_completion(job, public_url, cost, credits_change, premium_credits_change, description, extra_stats):
+    """
+    Bills the generation and saves the COMPLETED row in a single round trip
+    via the complete_generation() Postgres function.
+    Returns the ledger transaction id (None if billing could not be recorded).
+    """
+    if not supabase:
+        return None
+
+    job_id = job["id"]
+    # The RPC writes the full row; make sure a buffered PROCESSING can't land after it
+    await status_buffer.drop(job_id)
+
+    params = {
+        "p_generation_id": job_id,
+        "p_user_id": job.get("user_id"),
+        "p_prompt": job.get("slug") or job.get("prompt"),
+        "p_parameters": job.get("model_config", {}),
+        "p_image_url": public_url,
+        "p_cost": cost,
+        "p_credits_change": credits_change,
+        "p_premium_credits_change": premium_credits_change,
+        "p_description": description,
+        "p_extra": extra_stats
+    }
+    try:
+        # Retries included: no pool timeout, the per-request HTTP timeout bounds each attempt
+        res = await db.run(call_complete_generation, params, timeout=None)
+        transaction_id = res.data
+        print(f"📦 DB COMPLETE: Job {job_id} (Transaction: {transaction_id})")
+        profile_cache.invalidate(job.get("user_id"))
+        content_versions.bump(job.get("user_id"))
+        return transaction_id
+    except Exception as e:
+        # Nothing was written (the function is atomic). Keep the image visible; billing is flagged.
+        print(f"⚠️ Billing Transaction Failed: {e}")
+        await update_db_status(job_id, "COMPLETED", public_url, cost=cost, job_details=job, extra_stats=extra_stats)
+        # The gallery must see the row before clients are told it changed
+        await status_buffer.flush()
+        content_versions.bump(job.get("user_id"))
+        return None
+
+async def mark_processing(job_manager: JobManager, job: dict, timer: StageTimer):
+    with timer.stage("db_mark"):
+        await job_manager.update_job(job["id"], {"status": "PROCESSING"})
+        # Pass job details to create the row if it doesn't exist
+        await update_db_status(job["id"], "PROCESSING", job_details=job)
+
+async def fail_job(job_manager: JobManager, job: dict, timer: StageTimer, error: Exception):
+    job_id = job["id"]
+    print(f"❌ Job {job_id} Failed: {error}")
+    reservations.release(job) # Nothing was billed: the held credit goes back
+    timings = timer.finish("FAILED")
+    await job_manager.update_job(job_id, {"status": "FAILED", "error": str(error), "timings": timings})
+    await update_db_status(job_id, "FAILED", extra_stats={"stage_timings": timings})
+
+async def process_job(job_manager: JobManager, job: dict, generated=None, timer=None, batch_size: int = 1):
+    """
+    Runs one job end to end. With `generated` (an image object from a batched
+    n>1 call, see process_batch) the job is already marked PROCESSING and
+    only the per-image steps run: watermark, encode, upload, billing.
+    """
+    job_id = job["id"]
+    timer = timer or StageTimer(job_id)
+    try:
+        if generated is None:
+            await mark_processing(job_manager, job, timer)
+
+        model_config = job.get("model_config", {})
+        print(f"🖼️ Model Config: {model_config}")
+
+        # 0. Result Cache (opt-in, catalog prompts without init image)
+        cache_key = result_cache.cache_key(job["prompt"], model_config)
+        stored = None
+        if cache_key and generated is None:
+            with timer.stage("cache"):
+                entry = result_cache_store.get(cache_key)
+                if entry:
+                    stored = await asyncio.to_thread(serve_cached_result, entry, job)
+                    if stored is None:
+                        result_cache_store.invalidate(cache_key)
+
+        partial_images = 0
+        if generated is not None:
+            image_data_obj = generated
+        elif stored is None:
+            async def publish_partial(index, b64_json):
+                # Small WebP data URI: polled/streamed to the client while the final image renders
+                preview = await asyncio.to_thread(render_partial_preview, b64_json)
+                await job_manager.update_job(job_id, {"partial": {"index": index, "image": preview}})
+                print(f"🌓 Partial Preview {index} for Job {job_id} ({len(preview)} chars)")
+
+            # Partials cost output tokens: only requested when the client streams this job
+            on_partial = publish_partial if model_config.get("stream_partials") else None
+            partial_images = partial_image_count(on_partial)
+
+            # 1. Generate
+            with timer.stage("openai"):
+                image_data_obj = await generate_with_retry(job["prompt"], model_config, on_partial=on_partial)
+
+        if stored is None:
+            # 2. Extract Image Data (URL or Base64)
+            with timer.stage("download"):
+                img_data = fetch_image_bytes(image_data_obj)
+
+            # 3. Watermark, Encode, Upload
+            stored = await store_result(job, img_data, timer)
+            if cache_key and not stored["pending_upload"]:
+                result_cache_store.put(cache_key, {
+                    "s3_key": stored["s3_key"],
+                    "encoding": stored["encoding"],
+                    "variants": {name: list(urls) for name, urls in stored["variants"].items()}
+                })
+
+        public_url = stored["public_url"]
+        variants = stored["variants"]
+        encoding = stored["encoding"]
+        pending_upload = stored["pending_upload"]
 
         # 4. Calculate Tokens & Cost (DDD Pricing Logic)
-        input_tokens_est = len(job.get("prompt", "")) // 4
+        # A batched call sends the prompt once for all of its images
+        input_tokens_est = len(job.get("prompt", "")) // 4 // batch_size
         
         quality = job.get("model_config", {}).get("quality", "standard")
         tier_map = {
@@ -343,66 +671,259 @@ async def process_job(job_manager: JobManager, job: dict):
         if quality == "low": model_tier = "low"
         if quality == "high": model_tier = "high"
         
-        output_tokens_est = tier_map[model_tier]["tokens"]
+        output_tokens_est = tier_map[model_tier]["tokens"] + partial_images * PARTIAL_IMAGE_OUTPUT_TOKENS
         
         # Formula: (Input * 8 + Output * 32) / 1M
         input_cost = (input_tokens_est / 1_000_000) * 8.00
         output_cost = (output_tokens_est / 1_000_000) * 32.00
         cost = round(input_cost + output_cost, 6)
+        if stored.get("cache_hit"):
+            # Served from the result cache: no OpenAI spend (credits are still used)
+            input_tokens_est = output_tokens_est = 0
+            cost = 0.0
         
-        # 5. Record Transaction (Billing Domain)
-        # The Trigger will handle balance update
-        transaction_id = None
-        if supabase:
-            try:
-                tx_data = {
-                    "user_id": job.get("user_id"),
-                    "amount": -cost, # Negative for usage
-                    "transaction_type": "GENERATION_USAGE",
-                    "description": f"Gen {model_tier.upper()}",
-                    "reference_id": job_id # Idempotency Key
-                }
-                
-                # Determine which credit to deduct based on what was authorized in main.py
-                # Re-check quality/watermark config
-                qual_check = job.get("model_config", {}).get("quality", "standard")
-                if qual_check == "high":
-                    tx_data["premium_credits_change"] = -1
-                    tx_data["credits_change"] = 0
-                else:
-                    tx_data["premium_credits_change"] = 0
-                    tx_data["credits_change"] = -1
-
-                tx_res = supabase.table("user_transactions").insert(tx_data).execute()
-                if tx_res.data:
-                    transaction_id = tx_res.data[0]["id"]
-            except Exception as e:
-                print(f"⚠️ Billing Transaction Failed: {e}")
+        # 5. Record Usage + Save Result (Billing & Generation Domains)
+        # One atomic RPC: ledger insert (trigger updates balance), generation upsert, link
+        # Determine which credit to deduct based on what was authorized in main.py
+        if job.get("model_config", {}).get("quality", "standard") == "high":
+            credits_change, premium_credits_change = 0, -1
+        else:
+            credits_change, premium_credits_change = -1, 0
 
-        # 6. Save Result (Generation Domain)
-        # Update job_details with new stats for update_db_status
         extra_stats = {
             "input_tokens": input_tokens_est,
             "output_tokens": output_tokens_est,
             "model_tier": model_tier,
-            "transaction_id": transaction_id
+            "output_format": encoding["format"],
+            "output_bytes": encoding["bytes"]
         }
+        if variants:
+            extra_stats["variants"] = variants
+        if cache_key:
+            extra_stats["cache_key"] = cache_key
+            extra_stats["cache_hit"] = bool(stored.get("cache_hit"))
         
-        await job_manager.update_job(job_id, {"status": "COMPLETED", "result": {"image_url": public_url, "cost": cost}})
-        await update_db_status(job_id, "COMPLETED", public_url, cost=cost, job_details=job, extra_stats=extra_stats)
-        print(f"✅ Job {job_id} Completed (Cost: ${cost:.6f}, Tier: {model_tier})")
+        with timer.stage("billing"):
+            reservations.begin_settle(job)
+            transaction_id = await record_completion(job, public_url, cost, credits_change, premium_credits_change, f"Gen {model_tier.upper()}", extra_stats)
+        if transaction_id:
+            reservations.settle(job)
+        else:
+            # No ledger debit was recorded, so the credit must not stay spent
+            reservations.release(job)
+
+        # Stage spans go on the job record (Redis + write-behind to the row) and into the histograms
+        timings = timer.finish("COMPLETED")
+        await job_manager.update_job(job_id, {"status": "COMPLETED", "result": {"image_url": public_url, "variants": variants, "cost": cost, "encoding": encoding, "pending_upload": pending_upload}, "timings": timings})
+        await update_db_status(job_id, "COMPLETED", extra_stats={"stage_timings": timings})
+        print(f"✅ Job {job_id} Completed (Cost: ${cost:.6f}, Tier: {model_tier}{f', Batch: {batch_size}' if batch_size > 1 else ''})")
 
     except Exception as e:
-        print(f"❌ Job {job_id} Failed: {e}")
-        await job_manager.update_job(job_id, {"status": "FAILED", "error": str(e)})
-        await update_db_status(job_id, "FAILED")
+        await fail_job(job_manager, job, timer, e)
+
+def batch_key(job: dict) -> tuple:
+    """
+    Jobs with equal keys can share one n>1 images call. Watermarking and
+    billing happen per image, so should_watermark is not part of the key.
+    """
+    model_config = job.get("model_config", {})
+    return (
+        job.get("prompt"),
+        model_config.get("model"),
+        model_config.get("size", "1024x1024"),
+        model_config.get("quality", "standard"),
+        model_config.get("init_image"),
+    )
+
+def batchable(job: dict) -> bool:
+    # Cacheable jobs are left to the result cache: one image serves every repeat
+    return IMAGE_BATCH_MAX > 1 and result_cache.cache_key(job["prompt"], job.get("model_config", {})) is None
+
+async def process_batch(job_manager: JobManager, jobs: list):
+    """
+    One images call with n=len(jobs) for jobs sharing a batch_key,
+    then the results fan out to the individual jobs.
+    """
+    lead = jobs[0]
+    timers = {job["id"]: StageTimer(job["id"]) for job in jobs}
+    print(f"🧺 Batched {len(jobs)} jobs into one n={len(jobs)} call: {lead['prompt'][:30]}...")
+    try:
+        for job in jobs:
+            await mark_processing(job_manager, job, timers[job["id"]])
+        with ExitStack() as stack:
+            for timer in timers.values():
+                stack.enter_context(timer.stage("openai"))
+            images = await generate_with_retry(lead["prompt"], lead.get("model_config", {}), n=len(jobs))
+    except Exception as e:
+        for job in jobs:
+            await fail_job(job_manager, job, timers[job["id"]], e)
+        return
+
+    for job, image in zip(jobs, images):
+        await process_job(job_manager, job, generated=image, timer=timers[job["id"]], batch_size=len(jobs))
+        # Done (and billed): a drain cutting off the rest of the batch must not re-queue it
+        in_flight.pop(job["id"], None)
+
+    # The API returned fewer images than asked for: the rest go back on the queue
+    for job in jobs[len(images):]:
+        print(f"↩️ Batch returned {len(images)}/{len(jobs)} images, re-queueing {job['id']}")
+        await job_manager.requeue_job(job)
+        in_flight.pop(job["id"], None)
+
+def reupload_spooled(meta):
+    """
+    Retries one spooled upload. Returns (public_url, variants) on success.
+    """
+    # Streamed from disk, the spooled bytes are never loaded whole
+    with upload_spool.open_data(meta["job_id"]) as f:
+        s3().upload_fileobj(
+            f,
+            BUCKET_NAME,
+            meta["s3_key"],
+            ExtraArgs={'ContentType': meta["content_type"]}
+        )
+        public_url = f"https://{BUCKET_NAME}.s3.amazonaws.com/{meta['s3_key']}"
+        try:
+            f.seek(0)
+            variants = upload_variants(meta["s3_key"], Image.open(f))
+        except Exception as e:
+            print(f"⚠️ Variant Rendering Failed (Skipping): {e}")
+            variants = {}
+    return public_url, variants
+
+async def spool_loop(job_manager: JobManager, interval: float = 5):
+    """
+    Background re-upload of spooled generations with exponential backoff.
+    Swaps the placeholder URL for the real one once S3 accepts the object.
+    """
+    print(f"💾 Upload spool watcher started ({upload_spool.SPOOL_DIR})")
+    while True:
+        try:
+            for meta in upload_spool.due_entries():
+                await recover_spooled(job_manager, meta)
+        except Exception as e:
+            # The watcher must outlive any error, or spooled images stay on the placeholder
+            print(f"⚠️ Upload Spool Pass Failed: {e}")
+        await asyncio.sleep(interval)
+
+async def recover_spooled(job_manager: JobManager, meta: dict):
+    job_id = meta["job_id"]
+    try:
+        public_url, variants = await asyncio.to_thread(reupload_spooled, meta)
+    except Exception as e:
+        meta = upload_spool.reschedule(meta)
+        print(f"⚠️ Spooled Upload Retry {meta['attempts']} Failed ({meta['s3_key']}): {e}. Next in {upload_spool.backoff_seconds(meta['attempts']):.0f}s")
+        return
+
+    print(f"✅ Spooled Upload Recovered: {meta['s3_key']}")
+    try:
+        job = await job_manager.get_job(job_id)
+        if job and job.get("result"):
+            result = dict(job["result"], image_url=public_url, variants=variants, pending_upload=False)
+            await job_manager.update_job(job_id, {"result": result})
+        await update_db_status(job_id, "COMPLETED", public_url, extra_stats={"variants": variants} if variants else None)
+        await status_buffer.flush()
+        content_versions.bump(meta.get("user_id"))
+    except Exception as e:
+        # Kept in the spool: the next attempt re-uploads (same key) and swaps the URL again
+        meta = upload_spool.reschedule(meta)
+        print(f"⚠️ Spooled Upload Swap Failed ({meta['s3_key']}): {e}. Next in {upload_spool.backoff_seconds(meta['attempts']):.0f}s")
+        return
+    upload_spool.remove(job_id)
+
+async def reconcile_loop(interval: float = RECONCILE_SECONDS):
+    """
+    Periodically refreshes cached credit balances from user_balances,
+    correcting any drift between the reservation cache and the ledger.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        if not supabase:
+            continue
+        try:
+            count = await db.run(reservations.reconcile, supabase, timeout=None)
+            if count:
+                print(f"🧮 Reconciled {count} cached balance(s)")
+        except Exception as e:
+            print(f"⚠️ Balance Reconcile Failed: {e}")
 
 async def worker_loop(job_manager_instance=None):
     print("👷 Worker started. Waiting for jobs...")
     job_manager = job_manager_instance or JobManager()
-    while True:
+    while not drain_state["draining"]:
         job = await job_manager.pop_job()
-        if job:
-            await process_job(job_manager, job)
+        if job and drain_state["draining"]:
+            # Popped while the drain started: hand it to another worker
+            await job_manager.requeue_job(job)
+            drain_state["requeued"] += 1
+        elif job:
+            # Identical queued requests ride along as one n>1 call
+            jobs = [job]
+            if batchable(job):
+                key = batch_key(job)
+                jobs += await job_manager.pop_similar(lambda j: batch_key(j) == key, IMAGE_BATCH_MAX - 1)
+
+            if len(jobs) > 1:
+                task = asyncio.create_task(process_batch(job_manager, jobs))
+            else:
+                task = asyncio.create_task(process_job(job_manager, job))
+            for queued in jobs:
+                in_flight[queued["id"]] = (task, queued)
+            try:
+                # Shielded: a cancelled loop must not take the job down with it
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    raise
+                break # Job was cut off by drain() and re-queued
+            finally:
+                if task.done():
+                    for queued in jobs:
+                        in_flight.pop(queued["id"], None)
         else:
             await asyncio.sleep(1) # Poll interval
+    print("👷 Worker stopped popping jobs (draining)")
+
+def worker_health() -> dict:
+    if drain_state["drained"]:
+        status = "drained"
+    elif drain_state["draining"]:
+        status = "draining"
+    else:
+        status = "ok"
+    return {"status": status, "in_flight": len(in_flight), "requeued": drain_state["requeued"]}
+
+async def drain(job_manager: JobManager, timeout: float = DRAIN_TIMEOUT_SECONDS) -> dict:
+    """
+    Stops taking jobs, waits up to `timeout` for in-flight jobs and re-queues
+    the ones that did not finish. Safe to call more than once.
+    Re-running a job is safe: completion is idempotent on the job id.
+    """
+    if not drain_state["draining"]:
+        drain_state["draining"] = True
+        print(f"🛑 Draining worker: {len(in_flight)} job(s) in flight, deadline {timeout:.0f}s")
+
+    tasks = [task for task, _ in in_flight.values()]
+    if tasks:
+        await asyncio.wait(tasks, timeout=timeout)
+
+    # Batched jobs share a task: decide what is unfinished before cancelling any
+    unfinished = [(job_id, task, job) for job_id, (task, job) in in_flight.items() if not task.done()]
+    for job_id in [job_id for job_id, (task, _) in in_flight.items() if task.done()]:
+        in_flight.pop(job_id, None)
+
+    for job_id, task, job in unfinished:
+        task.cancel()
+        # Let the cancellation land first so no late status write overtakes the re-queue
+        await asyncio.gather(task, return_exceptions=True)
+        try:
+            await job_manager.requeue_job(job)
+            drain_state["requeued"] += 1
+            print(f"↩️ Re-queued unfinished job {job_id}")
+        except Exception as e:
+            print(f"❌ Re-queue Failed for {job_id}: {e}")
+        in_flight.pop(job_id, None)
+
+    drain_state["drained"] = True
+    print(f"🛑 Worker drained ({drain_state['requeued']} job(s) re-queued)")
+    return worker_health()
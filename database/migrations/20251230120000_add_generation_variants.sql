@@ -0,0 +1,4 @@
+-- Responsive image variants (thumbnails / previews) stored next to the original
+-- Shape: {"thumb": {"webp": "https://..."}, "preview": {"webp": "https://..."}}
+ALTER TABLE public.generations
+ADD COLUMN IF NOT EXISTS variants JSONB DEFAULT '{}'::jsonb;
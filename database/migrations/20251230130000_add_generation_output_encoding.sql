@@ -0,0 +1,4 @@
+-- Output encoding chosen per tier (png / webp / avif) and stored object size
+ALTER TABLE public.generations
+ADD COLUMN IF NOT EXISTS output_format TEXT,
+ADD COLUMN IF NOT EXISTS output_bytes INT;
@@ -0,0 +1,4 @@
+-- Result cache bookkeeping: content address of the job and whether it was served from cache
+ALTER TABLE public.generations
+ADD COLUMN IF NOT EXISTS cache_key TEXT,
+ADD COLUMN IF NOT EXISTS cache_hit BOOLEAN DEFAULT FALSE;
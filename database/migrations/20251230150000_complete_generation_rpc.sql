@@ -0,0 +1,69 @@
+-- Single round trip completion: record usage, save the generation and link them atomically.
+-- Idempotent on the generation id (user_transactions.reference_id), so the worker can retry.
+CREATE OR REPLACE FUNCTION public.complete_generation(
+    p_generation_id TEXT,
+    p_user_id BIGINT,
+    p_prompt TEXT,
+    p_parameters JSONB,
+    p_image_url TEXT,
+    p_cost FLOAT,
+    p_credits_change INT,
+    p_premium_credits_change INT,
+    p_description TEXT,
+    p_extra JSONB DEFAULT '{}'::jsonb
+)
+RETURNS UUID AS $$
+DECLARE
+    v_transaction_id UUID;
+BEGIN
+    -- 1. Billing (trigger 'on_transaction_created' updates user_balances)
+    INSERT INTO public.user_transactions (user_id, amount, transaction_type, description, reference_id, credits_change, premium_credits_change)
+    VALUES (p_user_id, -p_cost, 'GENERATION_USAGE', p_description, p_generation_id, p_credits_change, p_premium_credits_change)
+    ON CONFLICT (reference_id) DO NOTHING
+    RETURNING id INTO v_transaction_id;
+
+    IF v_transaction_id IS NULL THEN
+        -- Already billed by a previous attempt
+        SELECT id INTO v_transaction_id FROM public.user_transactions WHERE reference_id = p_generation_id;
+    END IF;
+
+    -- 2. Generation row (created here if the PROCESSING write never landed)
+    INSERT INTO public.generations AS g (
+        id, user_id, prompt, parameters, status, image_url, cost,
+        input_tokens, output_tokens, model_tier, transaction_id,
+        variants, output_format, output_bytes, cache_key, cache_hit, updated_at
+    )
+    VALUES (
+        p_generation_id, p_user_id, p_prompt, COALESCE(p_parameters, '{}'::jsonb), 'COMPLETED', p_image_url, p_cost,
+        (p_extra->>'input_tokens')::INT,
+        (p_extra->>'output_tokens')::INT,
+        p_extra->>'model_tier',
+        v_transaction_id,
+        COALESCE(p_extra->'variants', '{}'::jsonb),
+        p_extra->>'output_format',
+        (p_extra->>'output_bytes')::INT,
+        p_extra->>'cache_key',
+        COALESCE((p_extra->>'cache_hit')::BOOLEAN, FALSE),
+        NOW()
+    )
+    ON CONFLICT (id) DO UPDATE SET
+        status = 'COMPLETED',
+        image_url = EXCLUDED.image_url,
+        cost = EXCLUDED.cost,
+        input_tokens = EXCLUDED.input_tokens,
+        output_tokens = EXCLUDED.output_tokens,
+        model_tier = EXCLUDED.model_tier,
+        transaction_id = EXCLUDED.transaction_id,
+        variants = EXCLUDED.variants,
+        output_format = EXCLUDED.output_format,
+        output_bytes = EXCLUDED.output_bytes,
+        cache_key = EXCLUDED.cache_key,
+        cache_hit = EXCLUDED.cache_hit,
+        updated_at = NOW();
+
+    RETURN v_transaction_id;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = public;
+
+REVOKE ALL ON FUNCTION public.complete_generation(TEXT, BIGINT, TEXT, JSONB, TEXT, FLOAT, INT, INT, TEXT, JSONB) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.complete_generation(TEXT, BIGINT, TEXT, JSONB, TEXT, FLOAT, INT, INT, TEXT, JSONB) TO service_role;
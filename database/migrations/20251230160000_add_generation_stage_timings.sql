@@ -0,0 +1,3 @@
+-- Per-stage pipeline durations in ms, e.g. {"openai": 41234.5, "upload": 812.0, "total": 43011.2}
+ALTER TABLE public.generations
+ADD COLUMN IF NOT EXISTS stage_timings JSONB DEFAULT '{}'::jsonb;
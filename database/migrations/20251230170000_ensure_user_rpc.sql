@@ -0,0 +1,31 @@
+-- Login path: create the user and grant the welcome gift in one idempotent round trip.
+-- Returns TRUE only for the call that actually created the user.
+CREATE OR REPLACE FUNCTION public.ensure_user(
+    p_id BIGINT,
+    p_username TEXT,
+    p_first_name TEXT,
+    p_last_name TEXT,
+    p_language_code TEXT,
+    p_is_premium BOOLEAN DEFAULT FALSE
+)
+RETURNS BOOLEAN AS $$
+BEGIN
+    INSERT INTO public.users (id, username, first_name, last_name, language_code, is_premium)
+    VALUES (p_id, p_username, p_first_name, p_last_name, p_language_code, COALESCE(p_is_premium, FALSE))
+    ON CONFLICT (id) DO NOTHING;
+
+    IF NOT FOUND THEN
+        RETURN FALSE;
+    END IF;
+
+    -- Welcome gift (trigger 'on_transaction_created' updates user_balances)
+    INSERT INTO public.user_transactions (user_id, amount, transaction_type, description, reference_id, credits_change)
+    VALUES (p_id, 0.0, 'GIFT', 'Welcome Gift', 'gift_' || p_id || '_init', 1)
+    ON CONFLICT (reference_id) DO NOTHING;
+
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = public;
+
+REVOKE ALL ON FUNCTION public.ensure_user(BIGINT, TEXT, TEXT, TEXT, TEXT, BOOLEAN) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.ensure_user(BIGINT, TEXT, TEXT, TEXT, TEXT, BOOLEAN) TO service_role;
@@ -0,0 +1,25 @@
+-- App-open path: profile and balance in one round trip, only the columns /api/user/me returns.
+-- Users without a balance row yet get zeros.
+CREATE OR REPLACE FUNCTION public.get_user_profile(p_user_id BIGINT)
+RETURNS TABLE (
+    username TEXT,
+    first_name TEXT,
+    is_premium BOOLEAN,
+    credits INTEGER,
+    premium_credits INTEGER,
+    balance DOUBLE PRECISION
+) AS $$
+    SELECT
+        u.username,
+        u.first_name,
+        COALESCE(u.is_premium, FALSE),
+        COALESCE(b.credits, 0),
+        COALESCE(b.premium_credits, 0),
+        COALESCE(b.balance, 0.0)
+    FROM (SELECT p_user_id AS id) AS k
+    LEFT JOIN public.users u ON u.id = k.id
+    LEFT JOIN public.user_balances b ON b.user_id = k.id;
+$$ LANGUAGE sql STABLE SECURITY DEFINER SET search_path = public;
+
+REVOKE ALL ON FUNCTION public.get_user_profile(BIGINT) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.get_user_profile(BIGINT) TO service_role;
@@ -0,0 +1,8 @@
+-- Gallery pages: WHERE user_id = ? AND status = 'COMPLETED' AND NOT is_archived AND image_url IS NOT NULL
+-- ORDER BY created_at DESC, id DESC, continuing after a (created_at, id) keyset cursor.
+-- The id column breaks created_at ties and matches the ORDER BY direction. The API sends
+-- created_at <= cursor next to the (created_at, id) OR, which gives the scan its start
+-- bound: each page is one index range scan that stops after limit + 1 rows.
+CREATE INDEX IF NOT EXISTS idx_generations_gallery
+    ON public.generations (user_id, created_at DESC, id DESC)
+    WHERE status = 'COMPLETED' AND NOT is_archived AND image_url IS NOT NULL;
@@ -0,0 +1,53 @@
+import fs from 'fs';
+import path from 'path';
+import zlib from 'zlib';
+import { fileURLToPath } from 'url';
+
+const __filename = fileURLToPath(import.meta.url);
+const __dirname = path.dirname(__filename);
+
+// Writes .br and .gz next to every compressible file in dist (run after `vite build`).
+// The backend serves them as-is when the client accepts the encoding, so
+// assets are compressed once at max level instead of on every request.
+const distDir = path.join(__dirname, '..', 'dist');
+const COMPRESSIBLE = new Set(['.js', '.mjs', '.css', '.html', '.svg', '.json', '.txt', '.xml', '.webmanifest', '.map']);
+const MIN_BYTES = 1024;
+
+function walk(dir) {
+    return fs.readdirSync(dir, { withFileTypes: true }).flatMap((entry) => {
+        const full = path.join(dir, entry.name);
+        return entry.isDirectory() ? walk(full) : [full];
+    });
+}
+
+if (!fs.existsSync(distDir)) {
+    console.error(`❌ ${distDir} not found. Run vite build first.`);
+    process.exit(1);
+}
+
+let written = 0;
+let saved = 0;
+for (const file of walk(distDir)) {
+    if (!COMPRESSIBLE.has(path.extname(file))) continue;
+    const source = fs.readFileSync(file);
+    if (source.length < MIN_BYTES) continue;
+
+    const variants = {
+        '.br': zlib.brotliCompressSync(source, {
+            params: {
+                [zlib.constants.BROTLI_PARAM_QUALITY]: zlib.constants.BROTLI_MAX_QUALITY,
+                [zlib.constants.BROTLI_PARAM_SIZE_HINT]: source.length,
+            },
+        }),
+        '.gz': zlib.gzipSync(source, { level: zlib.constants.Z_BEST_COMPRESSION }),
+    };
+    for (const [ext, data] of Object.entries(variants)) {
+        // Not worth a second file if it barely shrinks
+        if (data.length >= source.length * 0.9) continue;
+        fs.writeFileSync(file + ext, data);
+        written += 1;
+        saved += source.length - data.length;
+    }
+}
+
+console.log(`🗜️ Precompressed ${written} files (${(saved / 1024).toFixed(0)} KiB saved before negotiation)`);
@@ -65,7 +65,42 @@ export const getUser = async () => {
     }
 };
 
-export const generateImage = async (prompt, styleId, slug, extraConfig = {}) => {
+// Reads the job's Server-Sent Events stream (fetch, so the auth header can be sent).
+// Calls onPartial(dataUri) for each preview frame; resolves with the final job,
+// or null if the stream is unavailable and the caller should poll instead.
+const streamJob = async (jobId, token, onPartial) => {
+  const res = await fetch(`${API_BASE}/api/generation/${jobId}/stream`, {
+    headers: { 'Authorization': `Bearer ${token}`, 'Accept': 'text/event-stream' }
+  });
+  if (!res.ok || !res.body) return null;
+
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) return null;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const block = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      const event = block.match(/^event: (.*)$/m)?.[1];
+      const data = block.match(/^data: (.*)$/m)?.[1];
+      if (!event || !data) continue;
+
+      const payload = JSON.parse(data);
+      if (event === 'partial' && onPartial) onPartial(payload.image);
+      if (event === 'status' && ['COMPLETED', 'FAILED'].includes(payload.status)) {
+        reader.cancel();
+        return payload;
+      }
+    }
+  }
+};
+
+export const generateImage = async (prompt, styleId, slug, extraConfig = {}, { onPartial } = {}) => {
   try {
     const token = await login();
     
@@ -84,6 +119,7 @@ export const generateImage = async (prompt, styleId, slug, extraConfig = {}) =>
           quality: 'standard', // Was 'high' ($0.17). 'standard' is ~$0.04. Use 'low' for ~$0.009.
           size: '1024x1024',
           style_id: styleId,
+          stream_partials: Boolean(onPartial), // Partial frames are billed: only when shown
           ...extraConfig
         }
       })
@@ -100,19 +136,31 @@ export const generateImage = async (prompt, styleId, slug, extraConfig = {}) =>
     const { job_id } = await res.json();
     console.log(`Job Enqueued: ${job_id}`);
 
-    // 2. Poll for Status
+    // 2. Stream Status (partial previews), falling back to polling
+    let streamed = null;
+    try {
+      streamed = await streamJob(job_id, token, onPartial);
+    } catch (streamError) {
+      console.warn("Status stream failed, polling instead:", streamError);
+    }
+
     let attempts = 0;
     while (attempts < 60) { // Timeout after 60s
-      attempts++;
-      await delay(1000); // Wait 1s
-      
-      const statusRes = await fetch(`${API_BASE}/api/generation/${job_id}`, {
-         headers: { 'Authorization': `Bearer ${token}` }
-      });
-      
-      if (!statusRes.ok) continue;
-      
-      const job = await statusRes.json();
+      let job = streamed;
+      streamed = null;
+      if (!job) {
+        attempts++;
+        await delay(1000); // Wait 1s
+
+        const statusRes = await fetch(`${API_BASE}/api/generation/${job_id}`, {
+           headers: { 'Authorization': `Bearer ${token}` }
+        });
+
+        if (!statusRes.ok) continue;
+
+        job = await statusRes.json();
+        if (job.preview && onPartial) onPartial(job.preview.image);
+      }
       console.log(`Job Status: ${job.status}`);
       
       if (job.status === 'COMPLETED') {
@@ -17,7 +17,7 @@ const DiscoverStyles = () => {
 
     const pendingItemRef = React.useRef(null);
     const queryClient = useQueryClient();
-    const { startGeneration, stopGeneration } = useGeneration();
+    const { startGeneration, stopGeneration, showPartial } = useGeneration();
     const { user, openPaywall, isPremiumMode } = useUser();
 
     const handlePhotoSelected = async (file) => {
@@ -59,7 +59,7 @@ const DiscoverStyles = () => {
             await generateImage(prompt, item.title, item.slug || 'discover-style', {
                 init_image: url,
                 quality: isPremiumMode ? 'high' : 'standard'
-            });
+            }, { onPartial: showPartial });
 
             // 3. Refresh Gallery
             await queryClient.invalidateQueries({ queryKey: ['gallery'] });
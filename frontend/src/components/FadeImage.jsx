@@ -1,7 +1,7 @@
 import React, { useState } from 'react';
 import Skeleton from './Skeleton';
 
-const FadeImage = ({ src, alt, className, style, width, height, ...props }) => {
+const FadeImage = ({ src, srcSet, sizes, alt, className, style, width, height, ...props }) => {
     const [isLoaded, setIsLoaded] = useState(false);
     const [hasError, setHasError] = useState(false);
 
@@ -11,6 +11,11 @@ const FadeImage = ({ src, alt, className, style, width, height, ...props }) => {
         setHasError(false);
 
         const img = new Image();
+        // Match the rendered <img> so the browser picks (and caches) the same candidate
+        if (srcSet) {
+            img.srcset = srcSet;
+            img.sizes = sizes || '';
+        }
         img.src = src;
 
         // Use decode() to ensure it's ready for painting
@@ -30,7 +35,7 @@ const FadeImage = ({ src, alt, className, style, width, height, ...props }) => {
             img.onload = null;
             img.onerror = null;
         };
-    }, [src]);
+    }, [src, srcSet, sizes]);
 
     return (
         <div className={`fade-image-container ${className || ''}`} style={{ position: 'relative', width: width || '100%', height: height || '100%', overflow: 'hidden', ...style }}>
@@ -44,6 +49,8 @@ const FadeImage = ({ src, alt, className, style, width, height, ...props }) => {
             {/* 2. Actual Image */}
             <img
                 src={src}
+                srcSet={srcSet}
+                sizes={sizes}
                 alt={alt}
                 {...props}
                 // No onLoad handler needed here as we pre-loaded it
@@ -19,7 +19,7 @@ const Gallery = () => {
     // State for gallery images
     const [images, setImages] = useState([]);
     // Global generation state
-    const { isGenerating, loadingWord, dots, previewUrl, startGeneration, stopGeneration } = useGeneration();
+    const { isGenerating, loadingWord, dots, previewUrl, partialUrl, showPartial, startGeneration, stopGeneration } = useGeneration();
     const [selectedImage, setSelectedImage] = useState(null); // Preview State
     const [, setShowDebug] = useState(false); // Debug State
 
@@ -44,7 +44,8 @@ const Gallery = () => {
                 headerData.specialPrompt,
                 'header-special',
                 'header-cta',
-                { init_image: imageUrl, size: genSize }
+                { init_image: imageUrl, size: genSize },
+                { onPartial: showPartial }
             );
 
             // 4. Update Images
@@ -166,21 +167,23 @@ const Gallery = () => {
                     {/* Loading Placeholder for Generation */}
                     {isGenerating && (
                         <div className="gallery-item loading-placeholder animate-enter">
-                            {previewUrl && (
+                            {(partialUrl || previewUrl) && (
                                 <img
-                                    src={previewUrl}
+                                    src={partialUrl || previewUrl}
                                     alt="Preview"
                                     style={{
                                         position: 'absolute',
                                         width: '100%',
                                         height: '100%',
                                         objectFit: 'cover',
-                                        filter: 'blur(4px) brightness(0.7)'
+                                        // Partial frames are low-res renders of the result: show them sharper
+                                        filter: partialUrl ? 'blur(2px) brightness(0.85)' : 'blur(4px) brightness(0.7)',
+                                        transition: 'filter 0.4s ease'
                                     }}
                                 />
                             )}
 
-                            <div className="loading-blur" style={previewUrl ? { backdropFilter: 'none', background: 'transparent' } : {}}>
+                            <div className="loading-blur" style={(partialUrl || previewUrl) ? { backdropFilter: 'none', background: 'transparent' } : {}}>
                                 <Lollipop size={48} color="#ffffff" className="lollipop-spinner" />
                                 <div className="loading-text-wrapper" style={{ position: 'relative', display: 'flex', alignItems: 'center', justifyContent: 'center' }}>
                                     <span className="loading-text">{loadingWord}</span>
@@ -212,7 +215,9 @@ const Gallery = () => {
                                 />
                             ) : (
                                 <FadeImage
-                                    src={img.src}
+                                    src={img.preview || img.src}
+                                    srcSet={img.thumb && img.preview ? `${img.thumb} 384w, ${img.preview} 768w` : undefined}
+                                    sizes="(min-width: 768px) 33vw, 50vw"
                                     alt={`Gallery ${img.id}`}
                                     loading="lazy"
                                 />
@@ -1,6 +1,19 @@
 import { X, Download, Share2, Trash2, ThumbsUp, ThumbsDown } from 'lucide-react';
 import './MainScreen.css';
 
+// Stored format depends on the tier (WebP for standard, PNG for premium):
+// name the download after the URL's actual extension
+const IMAGE_EXTENSIONS = ['png', 'webp', 'jpg', 'jpeg', 'avif'];
+const extensionOf = (src) => {
+    try {
+        const match = new URL(src, window.location.href).pathname.match(/\.([a-z0-9]+)$/i);
+        const ext = match && match[1].toLowerCase();
+        return IMAGE_EXTENSIONS.includes(ext) ? ext : 'png';
+    } catch {
+        return 'png';
+    }
+};
+
 const PreviewModal = ({ image, onClose, onDelete, onFeedback }) => {
     if (!image) return null;
 
@@ -12,7 +25,7 @@ const PreviewModal = ({ image, onClose, onDelete, onFeedback }) => {
     };
 
     const handleDownload = () => {
-        const fileName = `pixel-pop-${image.id || 'image'}.png`;
+        const fileName = `pixel-pop-${image.id || 'image'}.${extensionOf(image.src)}`;
 
         // Check if Telegram WebApp downloadFile is available (Bot API 8.0+)
         if (window.Telegram?.WebApp?.downloadFile) {
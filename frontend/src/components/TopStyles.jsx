@@ -13,7 +13,7 @@ export default function TopStyles() {
 
     const pendingStyleRef = React.useRef(null);
     const queryClient = useQueryClient();
-    const { startGeneration, stopGeneration } = useGeneration();
+    const { startGeneration, stopGeneration, showPartial } = useGeneration();
 
     // Handler for when user selects/takes a photo
     const handlePhotoSelected = async (file) => {
@@ -40,7 +40,7 @@ export default function TopStyles() {
             await generateImage(prompt, style.title, 'style-transfer', {
                 init_image: url,
                 quality: isPremiumMode ? 'high' : 'standard'
-            });
+            }, { onPartial: showPartial });
 
             // 3. Refresh Gallery
             await queryClient.invalidateQueries({ queryKey: ['gallery'] });
@@ -13,9 +13,12 @@ export const GenerationProvider = ({ children }) => {
     const dotIntervalRef = useRef(null);
 
     const [previewUrl, setPreviewUrl] = useState(null);
+    // Latest streamed partial frame of the image being generated (data URI)
+    const [partialUrl, setPartialUrl] = useState(null);
 
     const startGeneration = (preview = null) => {
         setPreviewUrl(preview);
+        setPartialUrl(null);
         const phrases = headerData.loadingPhrases || ["Loading"];
         const wordIndex = Math.floor(Math.random() * phrases.length);
         setLoadingWord(phrases[wordIndex]);
@@ -74,7 +77,7 @@ export const GenerationProvider = ({ children }) => {
     }, [previewUrl]);
 
     return (
-        <GenerationContext.Provider value={{ isGenerating, loadingWord, dots, previewUrl, startGeneration, stopGeneration }}>
+        <GenerationContext.Provider value={{ isGenerating, loadingWord, dots, previewUrl, partialUrl, showPartial: setPartialUrl, startGeneration, stopGeneration }}>
             {children}
         </GenerationContext.Provider>
     );
@@ -0,0 +1,155 @@
+import os
+import sys
+import json
+import time
+import statistics
+import psycopg2
+
+# Gallery query benchmark: legacy (select *, created_at-only cursor) vs keyset
+# (projected columns, (created_at, id) cursor, idx_generations_gallery).
+# Seeds a TEMP table, so nothing outlives the session. Run against a dev database:
+#   DATABASE_URL=postgresql://... python scripts/bench_gallery_query.py [rows]
+DATABASE_URL = os.getenv("DATABASE_URL")
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 3_000_000
+USERS = 20_000
+HEAVY_USER = 1 # ~5% of all rows, the worst case for deep pages
+PAGE_SIZE = 20
+PAGES = 50
+REPEATS = 5
+
+SEED_SQL = """
+CREATE TEMP TABLE generations (
+    id TEXT PRIMARY KEY,
+    user_id BIGINT,
+    prompt TEXT,
+    status TEXT,
+    image_url TEXT,
+    cost FLOAT,
+    error TEXT,
+    parameters JSONB,
+    variants JSONB,
+    input_tokens INT,
+    output_tokens INT,
+    is_archived BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP WITH TIME ZONE,
+    updated_at TIMESTAMP WITH TIME ZONE
+);
+
+INSERT INTO generations
+SELECT
+    md5(g::text),
+    CASE WHEN g %% 20 = 0 THEN %(heavy)s ELSE 2 + g %% %(users)s END,
+    'A cute cat in style ' || (g %% 500),
+    CASE WHEN g %% 10 = 0 THEN 'FAILED' ELSE 'COMPLETED' END,
+    CASE WHEN g %% 10 = 0 THEN NULL ELSE 'https://bucket.s3.amazonaws.com/generations/' || md5(g::text) || '.webp' END,
+    0.04,
+    NULL,
+    jsonb_build_object('quality', 'medium', 'size', '1024x1024', 'init_image', repeat('x', 400)),
+    jsonb_build_object('thumb', jsonb_build_object('webp', 'https://bucket.s3.amazonaws.com/thumb/' || md5(g::text) || '.webp')),
+    40, 1250,
+    g %% 17 = 0,
+    -- Second resolution and batched inserts: plenty of equal timestamps
+    date_trunc('second', now() - (g / 60) * interval '1 second'),
+    now()
+FROM generate_series(1, %(rows)s) AS g;
+
+CREATE INDEX idx_generations_is_archived ON generations (is_archived);
+ANALYZE generations;
+"""
+
+GALLERY_INDEX_SQL = """
+CREATE INDEX idx_generations_gallery ON generations (user_id, created_at DESC, id DESC)
+    WHERE status = 'COMPLETED' AND NOT is_archived AND image_url IS NOT NULL;
+ANALYZE generations;
+"""
+
+LEGACY_SQL = """
+SELECT * FROM generations
+WHERE user_id = %(user_id)s AND status = 'COMPLETED' AND is_archived = false
+  AND (%(created_at)s::timestamptz IS NULL OR created_at < %(created_at)s::timestamptz)
+ORDER BY created_at DESC
+LIMIT %(limit)s
+"""
+
+# Exactly what fetch_completed_generations sends through PostgREST:
+# created_at=lte.X&or=(created_at.lt.X,and(created_at.eq.X,id.lt.Y))
+KEYSET_SQL = """
+SELECT id, image_url, variants, prompt, cost, created_at FROM generations
+WHERE user_id = %(user_id)s AND status = 'COMPLETED' AND is_archived = false AND image_url IS NOT NULL
+  AND (%(created_at)s::timestamptz IS NULL OR (
+      created_at <= %(created_at)s::timestamptz
+      AND (created_at < %(created_at)s::timestamptz OR (created_at = %(created_at)s::timestamptz AND id < %(id)s))
+  ))
+ORDER BY created_at DESC, id DESC
+LIMIT %(limit)s
+"""
+
+
+def walk_pages(cur, sql, cursor_of):
+    """
+    Fetches PAGES pages the way the endpoint does.
+    Returns per-page ms, the seen ids and the params of the deepest page.
+    """
+    timings, seen, params = [], [], {"user_id": HEAVY_USER, "created_at": None, "id": None, "limit": PAGE_SIZE + 1}
+    deepest = dict(params)
+    for _ in range(PAGES):
+        deepest = dict(params)
+        started = time.perf_counter()
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+        page = rows[:PAGE_SIZE]
+        seen.extend(row[0] for row in page)
+        if len(rows) <= PAGE_SIZE:
+            break
+        params.update(cursor_of(page[-1]))
+    return timings, seen, deepest
+
+
+def explain(cur, sql, params):
+    # Deepest page: a scan that does not start at the cursor shows up here as buffers
+    cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, params)
+    plan = cur.fetchone()[0][0]
+    root = plan["Plan"]
+    return {
+        "ms": plan["Execution Time"],
+        "node": root["Plans"][0]["Node Type"] if root.get("Plans") else root["Node Type"],
+        "shared_buffers": root.get("Shared Hit Blocks", 0) + root.get("Shared Read Blocks", 0),
+    }
+
+
+def run(label, cur, sql, cursor_of):
+    runs = [walk_pages(cur, sql, cursor_of) for _ in range(REPEATS)]
+    first_page = statistics.median(r[0][0] for r in runs)
+    per_page = statistics.median(statistics.mean(r[0]) for r in runs)
+    seen = runs[0][1]
+    plan = explain(cur, sql, runs[0][2])
+    print(f"{label:8} first page {first_page:8.2f} ms | avg page {per_page:8.2f} ms | "
+          f"{len(seen)} rows, {len(seen) - len(set(seen))} duplicates | last page: {plan['node']}, {plan['ms']:.2f} ms, {plan['shared_buffers']} buffers")
+    return seen
+
+
+def main():
+    if not DATABASE_URL:
+        sys.exit("DATABASE_URL is not set")
+    conn = psycopg2.connect(DATABASE_URL)
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    print(f"🌱 Seeding {ROWS:,} generations...")
+    started = time.perf_counter()
+    cur.execute(SEED_SQL, {"rows": ROWS, "users": USERS, "heavy": HEAVY_USER})
+    print(f"   done in {time.perf_counter() - started:.1f}s")
+
+    legacy = run("legacy", cur, LEGACY_SQL, lambda row: {"created_at": row[-2]})
+    cur.execute(GALLERY_INDEX_SQL)
+    keyset = run("keyset", cur, KEYSET_SQL, lambda row: {"created_at": row[5], "id": row[0]})
+
+    # Rows the legacy cursor skipped because they shared the boundary timestamp
+    print(f"📉 Legacy pagination missed {len(set(keyset) - set(legacy))} of {len(keyset)} rows")
+    print(json.dumps({"rows": ROWS, "pages": PAGES, "page_size": PAGE_SIZE}))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
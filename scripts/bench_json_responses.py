@@ -0,0 +1,70 @@
+import os
+import sys
+import gzip
+import time
+import statistics
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+from fastapi.responses import JSONResponse
+from http_encoding import FastJSONResponse, GZIP_LEVEL, BROTLI_QUALITY, brotli
+
+# Serialization time and bytes on the wire for representative API payloads:
+# a gallery page (20 items) and /api/results pages of 100 and 500 items.
+#   python scripts/bench_json_responses.py
+REPEATS = 200
+BUCKET = "https://pixelpop-generations.s3.amazonaws.com"
+
+
+def generation(i: int) -> dict:
+    key = f"generations/{100000 + i}/{'%032x' % (i * 7919)}"
+    variants = {
+        name: {fmt: f"{BUCKET}/{key}_{name}.{fmt}" for fmt in ("webp", "avif")}
+        for name in ("thumb", "preview")
+    }
+    return {
+        "id": "%08x-4b1d-4c2a-9f00-%012x" % (i, i * 31),
+        "src": f"{BUCKET}/{key}.png",
+        "thumb": variants["thumb"]["webp"],
+        "preview": variants["preview"]["webp"],
+        "variants": variants,
+        "prompt": f"Portrait of a cat as a Renaissance noble, oil painting, dramatic lighting, style {i % 40}",
+        "cost": 0.04226,
+        "created_at": f"2025-12-30T10:{i % 60:02d}:{i % 59:02d}.123456+00:00",
+    }
+
+
+PAYLOADS = {
+    "gallery (20)": {"items": [generation(i) for i in range(20)], "next_cursor": "eyJjcmVhdGVkX2F0IjogIjIwMjUtMTItMzAifQ==", "has_more": True},
+    "results (100)": [generation(i) for i in range(100)],
+    "results (500)": [generation(i) for i in range(500)],
+}
+
+
+def timed(fn, payload) -> float:
+    samples = []
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        fn(payload)
+        samples.append((time.perf_counter() - started) * 1e6)
+    return statistics.median(samples)
+
+
+def main():
+    print(f"{'payload':14} {'json µs':>9} {'orjson µs':>10} {'raw B':>8} {'gzip B':>8} {'br B':>8} {'gzip µs':>8} {'br µs':>8}")
+    for name, payload in PAYLOADS.items():
+        body = FastJSONResponse(payload).body
+        stdlib_us = timed(lambda p: JSONResponse(p).body, payload)
+        fast_us = timed(lambda p: FastJSONResponse(p).body, payload)
+        gzipped = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        gzip_us = timed(lambda b: gzip.compress(b, compresslevel=GZIP_LEVEL), body)
+        if brotli:
+            br_size = len(brotli.compress(body, quality=BROTLI_QUALITY))
+            br_us = f"{timed(lambda b: brotli.compress(b, quality=BROTLI_QUALITY), body):8.0f}"
+        else:
+            br_size, br_us = "-", "-"
+        print(f"{name:14} {stdlib_us:9.0f} {fast_us:10.0f} {len(body):8} {len(gzipped):8} {br_size:>8} {gzip_us:8.0f} {br_us:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+
+# Import time of the API process per APP_ROLE, from `python -X importtime`.
+# Lists the slowest top-level packages; --budget-ms fails (exit 1) when the
+# api role takes longer, for use as a CI regression check.
+#   python scripts/profile_startup.py
+#   python scripts/profile_startup.py --roles api --budget-ms 1500
+TOP = 15
+
+
+def profile(role: str) -> dict:
+    env = {**os.environ, "APP_ROLE": role}
+    env.setdefault("JWT_SECRET", "profile-startup")
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True,
+    )
+    wall = time.perf_counter() - started
+    if proc.returncode != 0:
+        print(proc.stderr[-2000:])
+        raise SystemExit(f"❌ import main failed for APP_ROLE={role}")
+
+    packages = {} # top-level package -> self us, summed over its modules
+    total = 0
+    for line in proc.stderr.splitlines():
+        # import time:       self [us] |  cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        name = name.strip()
+        if name == "main":
+            total = int(cumulative)
+        top = name.split(".")[0]
+        packages[top] = packages.get(top, 0) + int(own)
+    return {"wall": wall, "main": total, "packages": packages}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time of the API process per APP_ROLE")
+    parser.add_argument("--roles", default="api,all", help="Comma separated APP_ROLE values")
+    parser.add_argument("--budget-ms", type=float, default=None, help="Fail if importing main (api role) exceeds this")
+    args = parser.parse_args()
+
+    failed = False
+    for role in [r.strip() for r in args.roles.split(",") if r.strip()]:
+        result = profile(role)
+        print(f"\n=== APP_ROLE={role}: import main {result['main'] / 1000:.0f} ms (process {result['wall'] * 1000:.0f} ms) ===")
+        ranked = sorted(result["packages"].items(), key=lambda item: item[1], reverse=True)
+        for name, us in ranked[:TOP]:
+            print(f"{us / 1000:>9.1f} ms  {name}")
+        if role == "api" and args.budget_ms is not None and result["main"] / 1000 > args.budget_ms:
+            print(f"❌ Over budget: {result['main'] / 1000:.0f} ms > {args.budget_ms:.0f} ms")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()